@@ -13,21 +13,49 @@
 # under the License.
 
 
-import ConfigParser
 import flask
 from flask import request
 import flask_restful
 import functools
 import sys
+import time
 
+from eowyn import codec
+from eowyn import config
 import eowyn.exceptions as eowyn_exc
+from eowyn import metrics
 from eowyn.model import managers
+from eowyn import server
 
 app = flask.Flask(__name__)
 api = flask_restful.Api(app)
 
 manager = None
 
+# Content type of a batch of newline-delimited messages
+BATCH_CONTENT_TYPE = 'application/x-eowyn-batch'
+
+# Maximum number of messages popped at once for event streams, and seconds
+# between keep-alive comments on idle streams
+STREAM_BATCH = 100
+STREAM_KEEPALIVE = 15
+
+# Maximum seconds requests wait for messages, so that they end while the
+# workers of the server stop gracefully. Half the graceful_timeout in the
+# [server] config section, and at least a second.
+MAX_WAIT = max(server.DEFAULTS['graceful_timeout'] // 2, 1)
+
+# Maximum number of messages popped at once from all the topics of a user,
+# unless specified
+USER_BATCH = 100
+
+# Seconds messages are leased for, unless specified
+DEFAULT_VISIBILITY = 30
+
+# Minimum size in bytes of the messages compressed in storage, 0 disables
+# compression. Set via compress_threshold in the [api] config section.
+COMPRESS_THRESHOLD = 0
+
 
 def handle_validate(f):
     """A decorator to apply handle data validation errors"""
@@ -41,14 +69,77 @@ def handle_validate(f):
     return wrapper
 
 
+@app.before_request
+def start_timer():
+    flask.g.start = time.time()
+
+
+@app.after_request
+def record_request(response):
+    # Requests are measured by route, rather than by path, so that topics
+    # and usernames do not make series. Streams are measured until their
+    # response starts.
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.REQUESTS.observe(time.time() - flask.g.start, route,
+                             request.method, str(response.status_code))
+    return response
+
+
+def get_int_arg(name):
+    """Get an integer query string argument, None if not specified"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise eowyn_exc.InvalidDataException(key=name, value=value)
+
+
+def get_wait():
+    """Get the seconds to wait for messages, up to MAX_WAIT"""
+    return min(get_int_arg('wait') or 0, MAX_WAIT)
+
+
+def get_lines(name):
+    """Get the non empty lines of the body of the request"""
+    try:
+        body = request.data.decode('utf-8')
+    except UnicodeDecodeError:
+        raise eowyn_exc.InvalidDataException(key=name, value='not UTF-8')
+    return [line for line in body.split('\n') if line]
+
+
+def message_response(message):
+    """Response for a stored message
+
+    Compressed messages are sent as they are to clients accepting gzip
+    """
+    if (codec.is_compressed(message) and
+            request.accept_encodings.quality('gzip') > 0):
+        return flask.Response(codec.compressed_body(message),
+                              content_type='application/json',
+                              headers={'Content-Encoding': 'gzip',
+                                       'Vary': 'Accept-Encoding'})
+    return codec.decode(message), 200
+
+
 class Subscription(flask_restful.Resource):
 
     @handle_validate
     def get(self, topic, username):
-        # Get next message on a topic
+        # Get next message on a topic, or a list of up to `max` messages.
+        # If there are no messages, wait up to `wait` seconds for one.
+        max_count = get_int_arg('max')
+        wait = get_wait()
         try:
-            message = manager.pop_message(topic=topic, username=username)
-            return message, 200
+            if max_count is None:
+                message = manager.pop_message(topic=topic, username=username,
+                                              wait=wait)
+                return message_response(message)
+            messages = manager.pop_messages(topic=topic, username=username,
+                                            max_count=max_count, wait=wait)
+            return [codec.decode(m) for m in messages], 200
         except eowyn_exc.NoMessageFoundException:
             # If no message is found simply return 204
             return '', 204
@@ -76,6 +167,173 @@ class Subscription(flask_restful.Resource):
             flask_restful.abort(404, message=str(snfe))
 
 
+class SubscriptionLeases(flask_restful.Resource):
+
+    @handle_validate
+    def post(self, topic, username):
+        # Lease up to `max` messages to one of the consumers sharing the
+        # subscription, for `visibility` seconds. If there are no messages,
+        # wait up to `wait` seconds for one.
+        max_count = get_int_arg('max')
+        if max_count is None:
+            max_count = 1
+        visibility = get_int_arg('visibility')
+        if visibility is None:
+            visibility = DEFAULT_VISIBILITY
+        wait = get_wait()
+        try:
+            leased = manager.lease_messages(
+                topic=topic, username=username, max_count=max_count,
+                visibility=visibility, wait=wait)
+        except eowyn_exc.NoMessageFoundException:
+            return '', 204
+        except eowyn_exc.SubscriptionNotFoundException as snfe:
+            flask_restful.abort(404, message=str(snfe))
+        if leased is None:
+            flask_restful.abort(501, message='Leases are not supported')
+        return [{'lease': lease, 'message': codec.decode(message)}
+                for lease, message in leased], 200
+
+
+class SubscriptionAcks(flask_restful.Resource):
+
+    @handle_validate
+    def post(self, topic, username):
+        # Acknowledge leased messages, one lease per line
+        leases = get_lines('leases')
+        try:
+            acked = manager.ack_messages(topic=topic, username=username,
+                                         leases=leases)
+        except eowyn_exc.SubscriptionNotFoundException as snfe:
+            flask_restful.abort(404, message=str(snfe))
+        if acked is None:
+            flask_restful.abort(501, message='Leases are not supported')
+        return {'acked': acked}, 200
+
+
+class UserTopics(flask_restful.Resource):
+
+    @handle_validate
+    def get(self, username):
+        # List the topics of a user
+        topics = manager.get_topics(username=username)
+        if topics is None:
+            flask_restful.abort(501, message='User topics are not supported')
+        return topics, 200
+
+    @handle_validate
+    def post(self, username):
+        # Subscribe a user to many topics, one topic per line
+        topics = get_lines('topics')
+        created = manager.create_subscriptions(username=username,
+                                               topics=topics)
+        if created is None:
+            flask_restful.abort(501, message='User topics are not supported')
+        return {'subscribed': created}, 200
+
+    @handle_validate
+    def delete(self, username):
+        # Unsubscribe a user from all the topics subscribed to
+        deleted = manager.delete_subscriptions(username=username)
+        if deleted is None:
+            flask_restful.abort(501, message='User topics are not supported')
+        return {'unsubscribed': deleted}, 200
+
+
+class UserMessages(flask_restful.Resource):
+
+    @handle_validate
+    def get(self, username):
+        # Get up to `max` messages from all the topics of a user, as a
+        # list of topics and messages. If there are no messages, wait up
+        # to `wait` seconds for one.
+        max_count = get_int_arg('max')
+        if max_count is None:
+            max_count = USER_BATCH
+        wait = get_wait()
+        try:
+            popped = manager.pop_user_messages(
+                username=username, max_count=max_count, wait=wait)
+        except eowyn_exc.NoMessageFoundException:
+            return '', 204
+        if popped is None:
+            flask_restful.abort(501,
+                                message='User messages are not supported')
+        return [{'topic': topic, 'message': codec.decode(message)}
+                for topic, message in popped], 200
+
+
+def pop_stream(topic, username, wait=0):
+    """Pop the next messages of a stream, with the position of the last one
+
+    The position is None if the manager does not track positions.
+    """
+    popped = manager.pop_messages_with_position(
+        topic=topic, username=username, max_count=STREAM_BATCH, wait=wait)
+    if popped is None:
+        return manager.pop_messages(topic=topic, username=username,
+                                    max_count=STREAM_BATCH, wait=wait), None
+    return popped
+
+
+def format_event(message, event_id=None):
+    """Format a message as a server-sent event"""
+    lines = ['id: %s' % event_id] if event_id is not None else []
+    lines.extend('data: %s' % line for line in message.split('\n'))
+    return '\n'.join(lines) + '\n\n'
+
+
+class SubscriptionStream(flask_restful.Resource):
+
+    def _events(self, topic, username, messages, position, stopping):
+        while True:
+            for index, message in enumerate(messages):
+                # The ID of an event is the position of its message, so
+                # that clients may resume from it via Last-Event-ID
+                event_id = None
+                if position is not None:
+                    event_id = position - len(messages) + index + 1
+                yield format_event(codec.decode(message), event_id)
+            if stopping is not None and stopping.is_set():
+                # The server stops, clients reconnect to another worker
+                return
+            try:
+                messages, position = pop_stream(
+                    topic, username, wait=min(STREAM_KEEPALIVE, MAX_WAIT))
+            except eowyn_exc.NoMessageFoundException:
+                messages = []
+                yield ':\n\n'
+            except eowyn_exc.SubscriptionNotFoundException:
+                # Subscription deleted, end the stream
+                return
+
+    @handle_validate
+    def get(self, topic, username):
+        # Stream messages on a topic as server-sent events
+        last_event_id = request.headers.get('Last-Event-ID')
+        try:
+            if last_event_id:
+                # Only some managers can deliver messages again
+                try:
+                    manager.rewind(topic=topic, username=username,
+                                   position=int(last_event_id))
+                except ValueError:
+                    raise eowyn_exc.InvalidDataException(
+                        key='Last-Event-ID', value=last_event_id)
+            messages, position = pop_stream(topic, username)
+        except eowyn_exc.NoMessageFoundException:
+            messages, position = [], None
+        except eowyn_exc.SubscriptionNotFoundException as snfe:
+            flask_restful.abort(404, message=str(snfe))
+        return flask.Response(
+            flask.stream_with_context(
+                self._events(topic, username, messages, position,
+                             request.environ.get(server.STOPPING))),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache',
+                     'X-Accel-Buffering': 'no'})
+
+
 class Message(flask_restful.Resource):
 
     @handle_validate
@@ -86,45 +344,80 @@ class Message(flask_restful.Resource):
         # ImmutableMultiDIct returned by flask
         # message = request.form.keys()[0]
         message = request.data
+        codec.check(message)
         try:
-            manager.publish_message(topic, message)
+            if request.mimetype == BATCH_CONTENT_TYPE:
+                # One message per line, empty lines are skipped
+                messages = [codec.encode(m, COMPRESS_THRESHOLD)
+                            for m in message.split('\n') if m]
+                manager.publish_messages(topic, messages)
+            else:
+                manager.publish_message(
+                    topic, codec.encode(message, COMPRESS_THRESHOLD))
         except eowyn_exc.TopicNotFoundException:
             # NOTE(andreaf) When no topic is not found it means no subscription
             # exists so the message is discarded right away. We still need to
             # capture this exception, and do nothing for now. We may have
             # logging or reporting logic in future here.
             pass
+        except eowyn_exc.QueueFullException as qfe:
+            # Rejected by the retention policy of the topic
+            flask_restful.abort(503, message=str(qfe))
         return '', 200
 
 
+@app.route('/metrics')
+def get_metrics():
+    # Metrics in the Prometheus text format
+    return flask.Response(metrics.render(manager),
+                          content_type=metrics.CONTENT_TYPE)
+
+
 # Handle Subscriber API (subscribe, un-subscribe and get message)
 api.add_resource(Subscription, '/<string:topic>/<string:username>')
+api.add_resource(SubscriptionStream,
+                 '/<string:topic>/<string:username>/stream')
+api.add_resource(SubscriptionLeases,
+                 '/<string:topic>/<string:username>/leases')
+api.add_resource(SubscriptionAcks, '/<string:topic>/<string:username>/acks')
+
+# Handle the subscriptions of a user at once (list, subscribe to many
+# topics and un-subscribe from all), and get messages from all of them
+api.add_resource(UserTopics, '/_user/<string:username>/topics')
+api.add_resource(UserMessages, '/_user/<string:username>')
 
 # Handle Publisher API (post message)
 api.add_resource(Message, '/<string:topic>')
 
 
-def main():
-    config = ConfigParser.ConfigParser()
-    try:
-        # Read config file as first command line parameter
-        config_file = sys.argv[1]
-        config.read(config_file)
-        # Use the configured manager
-        manager_type = config.get('default', 'manager')
-        manager_configs = config.items(manager_type)
-        # In case of duplicated configs, the last one wins
-        manager_configs = {k: v for (k, v) in manager_configs}
-        # Other configs
-        debug = config.get('default', 'debug')
-    except IndexError:
-        # Or else use defaults
-        debug = False
-        manager_type = 'redis'
-        manager_configs = {'host': 'localhost', 'port': 6379}
-    global manager
+def setup(argv):
+    """Create the manager from the configuration, and return the app
+
+    Called by each worker of the server, once forked.
+    """
+    manager_type, manager_configs, _ = config.load(argv)
+    global manager, COMPRESS_THRESHOLD, MAX_WAIT
     manager = managers.get_manager(manager_type, **manager_configs)
-    app.run(debug=debug)
+    COMPRESS_THRESHOLD = int(config.load_section(argv, 'api').get(
+        'compress_threshold', 0))
+    options = server.load_options(config.load_section(argv, 'server'))
+    MAX_WAIT = max(options['graceful_timeout'] // 2, 1)
+    return app
+
+
+def main():
+    manager_type, _, debug = config.load(sys.argv)
+    if debug:
+        # The development server reloads the code, and runs the debugger
+        setup(sys.argv)
+        app.run(debug=debug)
+        return
+    options = server.load_options(config.load_section(sys.argv, 'server'))
+    # Workers would not see the subscriptions and messages of each other
+    if options['workers'] > 1 and not managers.is_shared(manager_type):
+        raise eowyn_exc.InvalidDataException(key='workers',
+                                             value=options['workers'])
+    sys.exit(server.serve(functools.partial(setup, sys.argv), options))
 
 if __name__ == '__main__':
     main()
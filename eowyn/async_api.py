@@ -0,0 +1,335 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Asynchronous Eowyn API
+
+Exposes the same API as eowyn.api, on an aiohttp server backed by an
+asynchronous manager, so that a single process can hold many concurrent
+connections, including subscribers waiting for messages.
+Requires Python 3.
+"""
+
+import functools
+import sys
+import time
+
+from aiohttp import web
+
+from eowyn import codec
+from eowyn import config
+import eowyn.exceptions as eowyn_exc
+from eowyn import metrics
+from eowyn.model import async_managers
+from eowyn import server
+
+manager = None
+
+# Same as in eowyn.api
+BATCH_CONTENT_TYPE = 'application/x-eowyn-batch'
+STREAM_BATCH = 100
+STREAM_KEEPALIVE = 15
+USER_BATCH = 100
+COMPRESS_THRESHOLD = 0
+
+
+def abort(status, message):
+    return web.json_response({'message': message}, status=status)
+
+
+def handle_validate(f):
+    """A decorator to apply handle data validation errors"""
+
+    @functools.wraps(f)
+    async def wrapper(request):
+        try:
+            return await f(request)
+        except eowyn_exc.InvalidDataException as ida:
+            return abort(400, str(ida))
+    return wrapper
+
+
+def get_int_arg(request, name):
+    """Get an integer query string argument, None if not specified"""
+    value = request.query.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise eowyn_exc.InvalidDataException(key=name, value=value)
+
+
+async def get_lines(request, name):
+    """Get the non empty lines of the body of the request"""
+    body = await request.read()
+    try:
+        text = body.decode('utf-8')
+    except UnicodeDecodeError:
+        raise eowyn_exc.InvalidDataException(key=name, value='not UTF-8')
+    return [line for line in text.split('\n') if line]
+
+
+def decode(message):
+    # Messages are stored as bytes, responses are JSON
+    return codec.decode(message).decode('utf-8')
+
+
+def message_response(request, message):
+    # Compressed messages are sent as they are to clients accepting gzip
+    if (codec.is_compressed(message) and
+            codec.accepts_gzip(request.headers.get('Accept-Encoding', ''))):
+        return web.Response(body=codec.compressed_body(message),
+                            content_type='application/json',
+                            headers={'Content-Encoding': 'gzip',
+                                     'Vary': 'Accept-Encoding'})
+    return web.json_response(decode(message))
+
+
+@handle_validate
+async def get_subscription(request):
+    # Get next message on a topic, or a list of up to `max` messages.
+    # If there are no messages, wait up to `wait` seconds for one.
+    topic = request.match_info['topic']
+    username = request.match_info['username']
+    max_count = get_int_arg(request, 'max')
+    wait = get_int_arg(request, 'wait') or 0
+    try:
+        if max_count is None:
+            message = await manager.pop_message(topic, username, wait=wait)
+            return message_response(request, message)
+        messages = await manager.pop_messages(topic, username, max_count,
+                                              wait=wait)
+        return web.json_response([decode(m) for m in messages])
+    except eowyn_exc.NoMessageFoundException:
+        return web.Response(status=204)
+    except eowyn_exc.SubscriptionNotFoundException as snfe:
+        return abort(404, str(snfe))
+
+
+@handle_validate
+async def post_subscription(request):
+    # Subscribe to a topic
+    topic = request.match_info['topic']
+    username = request.match_info['username']
+    try:
+        await manager.create_subscription(topic, username)
+        return web.json_response('')
+    except eowyn_exc.SubscriptionAlreadyExistsException:
+        return web.json_response('', status=201)
+
+
+@handle_validate
+async def delete_subscription(request):
+    # Unsubscribe from a topic
+    topic = request.match_info['topic']
+    username = request.match_info['username']
+    try:
+        await manager.delete_subscription(topic, username)
+        return web.json_response('')
+    except eowyn_exc.SubscriptionNotFoundException as snfe:
+        return abort(404, str(snfe))
+
+
+@handle_validate
+async def get_user_topics(request):
+    # List the topics of a user
+    topics = await manager.get_topics(request.match_info['username'])
+    if topics is None:
+        return abort(501, 'User topics are not supported')
+    return web.json_response(topics)
+
+
+@handle_validate
+async def post_user_topics(request):
+    # Subscribe a user to many topics, one topic per line
+    topics = await get_lines(request, 'topics')
+    created = await manager.create_subscriptions(
+        request.match_info['username'], topics)
+    if created is None:
+        return abort(501, 'User topics are not supported')
+    return web.json_response({'subscribed': created})
+
+
+@handle_validate
+async def delete_user_topics(request):
+    # Unsubscribe a user from all the topics subscribed to
+    deleted = await manager.delete_subscriptions(
+        request.match_info['username'])
+    if deleted is None:
+        return abort(501, 'User topics are not supported')
+    return web.json_response({'unsubscribed': deleted})
+
+
+@handle_validate
+async def get_user_messages(request):
+    # Get up to `max` messages from all the topics of a user, as a list of
+    # topics and messages. If there are no messages, wait up to `wait`
+    # seconds for one.
+    max_count = get_int_arg(request, 'max')
+    if max_count is None:
+        max_count = USER_BATCH
+    wait = get_int_arg(request, 'wait') or 0
+    try:
+        popped = await manager.pop_user_messages(
+            request.match_info['username'], max_count, wait=wait)
+    except eowyn_exc.NoMessageFoundException:
+        return web.Response(status=204)
+    if popped is None:
+        return abort(501, 'User messages are not supported')
+    return web.json_response([{'topic': topic, 'message': decode(message)}
+                              for topic, message in popped])
+
+
+async def pop_stream(topic, username, wait=0):
+    """See eowyn.api.pop_stream"""
+    popped = await manager.pop_messages_with_position(
+        topic, username, STREAM_BATCH, wait=wait)
+    if popped is None:
+        return await manager.pop_messages(topic, username, STREAM_BATCH,
+                                          wait=wait), None
+    return popped
+
+
+def format_event(message, event_id=None):
+    """Format a message as a server-sent event"""
+    lines = [b'id: %d' % event_id] if event_id is not None else []
+    lines.extend(b'data: ' + line for line in message.split(b'\n'))
+    return b'\n'.join(lines) + b'\n\n'
+
+
+@handle_validate
+async def get_subscription_stream(request):
+    # Stream messages on a topic as server-sent events
+    topic = request.match_info['topic']
+    username = request.match_info['username']
+    last_event_id = request.headers.get('Last-Event-ID')
+    try:
+        if last_event_id:
+            try:
+                await manager.rewind(topic, username, int(last_event_id))
+            except ValueError:
+                raise eowyn_exc.InvalidDataException(
+                    key='Last-Event-ID', value=last_event_id)
+        messages, position = await pop_stream(topic, username)
+    except eowyn_exc.NoMessageFoundException:
+        messages, position = [], None
+    except eowyn_exc.SubscriptionNotFoundException as snfe:
+        return abort(404, str(snfe))
+    response = web.StreamResponse(headers={'Cache-Control': 'no-cache',
+                                           'X-Accel-Buffering': 'no'})
+    response.content_type = 'text/event-stream'
+    await response.prepare(request)
+    while True:
+        for index, message in enumerate(messages):
+            event_id = None
+            if position is not None:
+                event_id = position - len(messages) + index + 1
+            await response.write(format_event(codec.decode(message),
+                                              event_id))
+        try:
+            messages, position = await pop_stream(topic, username,
+                                                  wait=STREAM_KEEPALIVE)
+        except eowyn_exc.NoMessageFoundException:
+            messages = []
+            await response.write(b':\n\n')
+        except eowyn_exc.SubscriptionNotFoundException:
+            # Subscription deleted, end the stream
+            return response
+
+
+@handle_validate
+async def post_message(request):
+    # Post a message to a topic
+    topic = request.match_info['topic']
+    message = await request.read()
+    codec.check(message)
+    try:
+        if request.content_type == BATCH_CONTENT_TYPE:
+            # One message per line, empty lines are skipped
+            messages = [codec.encode(m, COMPRESS_THRESHOLD)
+                        for m in message.split(b'\n') if m]
+            await manager.publish_messages(topic, messages)
+        else:
+            await manager.publish_message(
+                topic, codec.encode(message, COMPRESS_THRESHOLD))
+    except eowyn_exc.TopicNotFoundException:
+        # No subscription, the message is discarded
+        pass
+    except eowyn_exc.QueueFullException as qfe:
+        # Rejected by the retention policy of the topic
+        return abort(503, str(qfe))
+    return web.json_response('')
+
+
+@web.middleware
+async def record_request(request, handler):
+    # Requests are measured by route, as in eowyn.api. Streams are
+    # measured until they end.
+    start = time.time()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as exc:
+        status = exc.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource else 'unmatched'
+        metrics.REQUESTS.observe(time.time() - start, route, request.method,
+                                 str(status))
+
+
+async def get_metrics(request):
+    # Metrics in the Prometheus text format
+    if metrics.sample_due():
+        metrics.set_depths(
+            await manager.get_queue_depths(metrics.SAMPLE_TOPICS))
+    return web.Response(body=metrics.render().encode('utf-8'),
+                        headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+def create_app():
+    app = web.Application(middlewares=[record_request])
+    app.router.add_get('/metrics', get_metrics)
+    app.router.add_get('/_user/{username}/topics', get_user_topics)
+    app.router.add_post('/_user/{username}/topics', post_user_topics)
+    app.router.add_delete('/_user/{username}/topics', delete_user_topics)
+    app.router.add_get('/_user/{username}', get_user_messages)
+    app.router.add_get('/{topic}/{username}', get_subscription)
+    app.router.add_post('/{topic}/{username}', post_subscription)
+    app.router.add_delete('/{topic}/{username}', delete_subscription)
+    app.router.add_get('/{topic}/{username}/stream',
+                       get_subscription_stream)
+    app.router.add_post('/{topic}', post_message)
+    return app
+
+
+def main():
+    manager_type, manager_configs, debug = config.load(sys.argv)
+    global manager, COMPRESS_THRESHOLD
+    manager = async_managers.get_manager(manager_type, **manager_configs)
+    COMPRESS_THRESHOLD = int(config.load_section(sys.argv, 'api').get(
+        'compress_threshold', 0))
+    # Options of the [server] section, as for eowyn.api. A single process
+    # serves all connections, workers and threads do not apply.
+    options = server.load_options(config.load_section(sys.argv, 'server'))
+    web.run_app(create_app(), host=options['host'], port=options['port'],
+                backlog=options['backlog'],
+                keepalive_timeout=options['keep_alive'],
+                shutdown_timeout=options['graceful_timeout'])
+
+if __name__ == '__main__':
+    main()
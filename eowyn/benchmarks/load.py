@@ -0,0 +1,340 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Load generation against managers and the API
+
+A scenario subscribes `fanout` usernames to each of its topics, then runs
+concurrent publishers and subscribers until all messages are delivered,
+or the scenario times out. Subscriptions are shared round robin by the
+subscribers. Messages carry the time they were published at, so that
+their delivery latency is measured along with the latency of requests.
+"""
+
+import collections
+import json
+import socket
+import threading
+import time
+
+from six.moves import http_client
+
+from eowyn import exceptions as eowyn_exc
+
+# Same as in eowyn.api
+BATCH_CONTENT_TYPE = 'application/x-eowyn-batch'
+
+
+class Scenario(object):
+    """Shape of the load of a benchmark
+
+    :param topics: number of topics
+    :param fanout: number of subscriptions to each topic
+    :param publishers: number of concurrent publishers
+    :param subscribers: number of concurrent subscribers
+    :param messages: number of messages published by each publisher
+    :param size: size of messages in bytes
+    :param publish_batch: messages published per request
+    :param pop_batch: maximum number of messages popped per request
+    :param timeout: seconds after which undelivered messages are lost
+    """
+
+    def __init__(self, topics=1, fanout=1, publishers=1, subscribers=1,
+                 messages=1000, size=100, publish_batch=1, pop_batch=1,
+                 timeout=60):
+        self.topics = int(topics)
+        self.fanout = int(fanout)
+        self.publishers = int(publishers)
+        self.subscribers = int(subscribers)
+        self.messages = int(messages)
+        self.size = int(size)
+        self.publish_batch = int(publish_batch)
+        self.pop_batch = int(pop_batch)
+        self.timeout = float(timeout)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def plan(self, publisher):
+        """Batches published by a publisher, as (topic index, count)
+
+        Publishers go through the topics round robin, each starting from
+        a different one.
+        """
+        batches = []
+        for first in range(0, self.messages, self.publish_batch):
+            count = min(self.publish_batch, self.messages - first)
+            index = (publisher + first // self.publish_batch) % self.topics
+            batches.append((index, count))
+        return batches
+
+
+def make_message(size):
+    # The time of publishing, padded to size
+    stamp = '%.6f ' % time.time()
+    return (stamp + 'x' * max(0, size - len(stamp))).encode('ascii')
+
+
+def message_time(message):
+    if isinstance(message, bytes):
+        message = message.decode('ascii')
+    return float(message.split(' ', 1)[0])
+
+
+def summarize(samples):
+    """Count, mean, percentiles and maximum of latencies, in seconds"""
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+    return {'count': len(samples),
+            'mean': sum(samples) / len(samples),
+            'p50': percentile(50),
+            'p90': percentile(90),
+            'p99': percentile(99),
+            'max': samples[-1]}
+
+
+class ManagerClient(object):
+    """Drives a manager directly, in process"""
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def connect(self):
+        # Managers are thread safe, threads share the client
+        return self
+
+    def subscribe(self, topic, username):
+        self.manager.create_subscription(topic, username)
+
+    def unsubscribe(self, topic, username):
+        self.manager.delete_subscription(topic, username)
+
+    def publish(self, topic, messages):
+        if len(messages) == 1:
+            self.manager.publish_message(topic, messages[0])
+        else:
+            self.manager.publish_messages(topic, messages)
+
+    def pop(self, topic, username, max_count, wait=0):
+        try:
+            if max_count == 1:
+                return [self.manager.pop_message(topic, username, wait)]
+            return self.manager.pop_messages(topic, username, max_count,
+                                             wait)
+        except eowyn_exc.NoMessageFoundException:
+            return []
+
+
+class HTTPClient(object):
+    """Drives the API over HTTP
+
+    Each thread connects with its own client, which reuses its connection
+    as long as the server keeps it alive.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = int(port)
+        self._connection = None
+
+    def connect(self):
+        return HTTPClient(self.host, self.port)
+
+    def _request(self, method, path, body=None, headers=None,
+                 expected=(200,)):
+        reused = self._connection is not None
+        if not reused:
+            self._connection = http_client.HTTPConnection(self.host,
+                                                          self.port)
+        try:
+            self._connection.request(method, path, body, headers or {})
+            response = self._connection.getresponse()
+        except (http_client.HTTPException, socket.error):
+            if not reused:
+                raise
+            # The server closed the connection kept alive, retry once on
+            # a new one
+            self._connection.close()
+            self._connection.request(method, path, body, headers or {})
+            response = self._connection.getresponse()
+        data = response.read()
+        if response.status not in expected:
+            raise eowyn_exc.EowynException(
+                '%s %s returned %d' % (method, path, response.status))
+        return response.status, data
+
+    def subscribe(self, topic, username):
+        self._request('POST', '/%s/%s' % (topic, username))
+
+    def unsubscribe(self, topic, username):
+        self._request('DELETE', '/%s/%s' % (topic, username))
+
+    def publish(self, topic, messages):
+        if len(messages) == 1:
+            self._request('POST', '/' + topic, messages[0],
+                          {'Content-Type': 'text/plain'})
+        else:
+            self._request('POST', '/' + topic, b'\n'.join(messages),
+                          {'Content-Type': BATCH_CONTENT_TYPE})
+
+    def pop(self, topic, username, max_count, wait=0):
+        path = '/%s/%s?wait=%d' % (topic, username, wait)
+        if max_count > 1:
+            path += '&max=%d' % max_count
+        status, data = self._request('GET', path, expected=(200, 204))
+        if status == 204:
+            return []
+        messages = json.loads(data.decode('utf-8'))
+        return messages if max_count > 1 else [messages]
+
+
+class _Worker(threading.Thread):
+
+    def __init__(self, client):
+        super(_Worker, self).__init__()
+        self.daemon = True
+        self.client = client
+        self.latencies = []
+        self.error = None
+
+    def run(self):
+        try:
+            self.work()
+        except Exception as exc:
+            self.error = exc
+
+
+class _Publisher(_Worker):
+
+    def __init__(self, client, topics, plan, size):
+        super(_Publisher, self).__init__(client)
+        self.topics = topics
+        self.plan = plan
+        self.size = size
+
+    def work(self):
+        for index, count in self.plan:
+            messages = [make_message(self.size) for _ in range(count)]
+            start = time.time()
+            self.client.publish(self.topics[index], messages)
+            self.latencies.append(time.time() - start)
+
+
+class _Subscriber(_Worker):
+
+    def __init__(self, client, remaining, pop_batch, deadline):
+        super(_Subscriber, self).__init__(client)
+        # Messages still expected, by subscription
+        self.remaining = remaining
+        self.pop_batch = pop_batch
+        self.deadline = deadline
+        self.delivery = []
+        self.delivered = 0
+        self.empty = 0
+
+    def _pop(self, subscription, wait):
+        start = time.time()
+        messages = self.client.pop(subscription[0], subscription[1],
+                                   self.pop_batch, wait)
+        now = time.time()
+        if not messages:
+            self.empty += 1
+            return False
+        self.latencies.append(now - start)
+        self.delivery.extend(now - message_time(m) for m in messages)
+        self.delivered += len(messages)
+        self.remaining[subscription] -= len(messages)
+        if self.remaining[subscription] <= 0:
+            del self.remaining[subscription]
+        return True
+
+    def work(self):
+        while self.remaining and time.time() < self.deadline:
+            if len(self.remaining) == 1:
+                # Nothing else to poll, wait for messages
+                self._pop(next(iter(self.remaining)), 1)
+                continue
+            popped = [self._pop(subscription, 0)
+                      for subscription in list(self.remaining)]
+            if not any(popped):
+                time.sleep(0.001)
+
+
+def run(client, scenario, prefix='bench'):
+    """Run a scenario, and return its results
+
+    :param client: a ManagerClient or an HTTPClient
+    :param scenario: the Scenario to run
+    :param prefix: prefix of the names of topics, which must not be in use
+    :returns: a dict of results, with latencies in seconds and throughputs
+        in messages per second
+    """
+    topics = ['%s%d' % (prefix, index) for index in range(scenario.topics)]
+    subscriptions = [(topic, 'user%d' % index) for topic in topics
+                     for index in range(scenario.fanout)]
+    plans = [scenario.plan(publisher)
+             for publisher in range(scenario.publishers)]
+    expected = collections.Counter()
+    for plan in plans:
+        for index, count in plan:
+            expected[topics[index]] += count
+    setup = client.connect()
+    for topic, username in subscriptions:
+        setup.subscribe(topic, username)
+    try:
+        start = time.time()
+        subscribers = [
+            _Subscriber(client.connect(),
+                        dict((s, expected[s[0]]) for s in
+                             subscriptions[index::scenario.subscribers]
+                             if expected[s[0]]),
+                        scenario.pop_batch, start + scenario.timeout)
+            for index in range(scenario.subscribers)]
+        publishers = [_Publisher(client.connect(), topics, plan,
+                                 scenario.size) for plan in plans]
+        for worker in subscribers + publishers:
+            worker.start()
+        for worker in publishers:
+            worker.join()
+        published = time.time()
+        for worker in subscribers:
+            worker.join()
+        end = time.time()
+    finally:
+        for topic, username in subscriptions:
+            setup.unsubscribe(topic, username)
+    for worker in subscribers + publishers:
+        if worker.error is not None:
+            raise worker.error
+    total = scenario.publishers * scenario.messages
+    delivered = sum(worker.delivered for worker in subscribers)
+
+    def merge(workers, attribute='latencies'):
+        return [sample for worker in workers
+                for sample in getattr(worker, attribute)]
+    return {
+        'duration': end - start,
+        'published': total,
+        'delivered': delivered,
+        'lost': sum(expected.values()) * scenario.fanout - delivered,
+        'empty_pops': sum(worker.empty for worker in subscribers),
+        'throughput': {'publish': total / max(published - start, 1e-9),
+                       'deliver': delivered / max(end - start, 1e-9)},
+        'latency': {'publish': summarize(merge(publishers)),
+                    'pop': summarize(merge(subscribers)),
+                    'delivery': summarize(merge(subscribers, 'delivery'))},
+    }
@@ -0,0 +1,206 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmark the routing of messages to subscriptions to patterns
+
+Many patterns, 100000 by default, are drawn from the same segments as the
+topics published to, so that topics match a few patterns each. Matching
+topics against the trie of patterns is timed in process, and compared
+with a scan of all the patterns for a few topics. Publishing is timed via
+a manager, with a subscription to each pattern.
+
+Examples:
+
+    eowyn-benchmark-patterns
+    eowyn-benchmark-patterns --manager redis --option patterns=true \\
+        --option db=1 --output new.json --baseline old.json
+"""
+
+import argparse
+import platform
+import random
+import sys
+import time
+
+from eowyn.benchmarks import load
+from eowyn.benchmarks import run
+from eowyn import exceptions as eowyn_exc
+from eowyn.model import managers
+from eowyn.model import topics
+
+# Results compared across runs, and whether higher is better
+COMPARED = [(('throughput', 'publish'), True)] + [
+    (('latency', operation, statistic), False)
+    for operation in ('match', 'publish')
+    for statistic in ('p50', 'p99')]
+
+
+def make_topics(rand, count, depth, width):
+    """Topics of depth segments, each one of width values"""
+    return ['.'.join('s%d' % rand.randrange(width) for _ in range(depth))
+            for _ in range(count)]
+
+
+def make_patterns(rand, count, depth, width, wildcards):
+    """Distinct patterns, shaped as the topics
+
+    Each segment is the ANY wildcard with a probability of wildcards, and
+    patterns end with the REST wildcard early with the same probability.
+    """
+    # Patterns of depth segments, and patterns cut short by REST
+    possible = ((width + 1) ** depth - width ** depth +
+                sum((width + 1) ** cut for cut in range(depth)))
+    if count > possible:
+        raise ValueError('%d patterns do not fit in %d segments of %d '
+                         'values' % (count, depth, width))
+    patterns = set()
+    while len(patterns) < count:
+        segments = make_topics(rand, 1, depth, width)[0].split('.')
+        for index in range(depth):
+            if rand.random() < wildcards:
+                segments[index] = topics.ANY
+        if rand.random() < wildcards:
+            cut = rand.randrange(depth)
+            segments[cut:] = [topics.REST]
+        pattern = '.'.join(segments)
+        if topics.is_pattern(pattern):
+            patterns.add(pattern)
+    return sorted(patterns)
+
+
+def _scan_match(pattern, topic):
+    # Match a topic against a single pattern
+    segments = topic.split('.')
+    for index, segment in enumerate(pattern.split('.')):
+        if segment == topics.REST:
+            return index < len(segments)
+        if index >= len(segments):
+            return False
+        if segment not in (topics.ANY, segments[index]):
+            return False
+    return len(pattern.split('.')) == len(segments)
+
+
+def bench_match(patterns, published, scanned):
+    """Time matching topics with the trie, and with a scan of patterns"""
+    trie = topics.TopicTrie()
+    start = time.time()
+    for pattern in patterns:
+        trie.add(pattern)
+    indexed = time.time() - start
+    latencies = []
+    matches = 0
+    for topic in published:
+        start = time.time()
+        matches += len(trie.match(topic))
+        latencies.append(time.time() - start)
+    scans = []
+    for topic in published[:scanned]:
+        start = time.time()
+        [pattern for pattern in patterns if _scan_match(pattern, topic)]
+        scans.append(time.time() - start)
+    return {'index': indexed,
+            'matches': float(matches) / max(len(published), 1),
+            'match': load.summarize(latencies),
+            'scan': load.summarize(scans)}
+
+
+def bench_publish(manager, patterns, published):
+    """Time publishing to topics, with a subscription to each pattern"""
+    start = time.time()
+    for pattern in patterns:
+        manager.create_subscription(pattern, 'user')
+    subscribed = time.time() - start
+    latencies = []
+    unmatched = 0
+    try:
+        start = time.time()
+        for topic in published:
+            before = time.time()
+            try:
+                manager.publish_message(topic, 'message')
+            except eowyn_exc.TopicNotFoundException:
+                unmatched += 1
+            latencies.append(time.time() - before)
+        duration = time.time() - start
+    finally:
+        for pattern in patterns:
+            manager.delete_subscription(pattern, 'user')
+    return {'subscribe': subscribed,
+            'unmatched': unmatched,
+            'throughput': len(published) / max(duration, 1e-9),
+            'publish': load.summarize(latencies)}
+
+
+def benchmark(manager_type, options, count=100000, depth=5, width=20,
+              wildcards=0.2, published=1000, scanned=10, seed=0):
+    """Run the benchmark, and return its results along with its settings
+
+    :param count: number of patterns
+    :param published: number of topics published to
+    :param scanned: number of topics matched by a scan of the patterns
+    """
+    settings = {'patterns': count, 'depth': depth, 'width': width,
+                'wildcards': wildcards, 'topics': published,
+                'scanned': scanned, 'seed': seed}
+    rand = random.Random(seed)
+    patterns = make_patterns(rand, count, depth, width, wildcards)
+    topic_names = make_topics(rand, published, depth, width)
+    matched = bench_match(patterns, topic_names, scanned)
+    manager = managers.get_manager(manager_type, **options)
+    publish = bench_publish(manager, patterns, topic_names)
+    return {'manager': manager_type,
+            'options': options,
+            'settings': settings,
+            'python': platform.python_version(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'results': {
+                'patterns': {'index': matched['index'],
+                             'subscribe': publish['subscribe'],
+                             'matches': matched['matches'],
+                             'unmatched': publish['unmatched']},
+                'throughput': {'publish': publish['throughput']},
+                'latency': {'match': matched['match'],
+                            'scan': matched['scan'],
+                            'publish': publish['publish']}}}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    run.add_manager_args(parser)
+    parser.add_argument('--patterns', type=int, default=100000)
+    parser.add_argument('--depth', type=int, default=5,
+                        help='segments of topics')
+    parser.add_argument('--width', type=int, default=20,
+                        help='values of each segment')
+    parser.add_argument('--wildcards', type=float, default=0.2,
+                        help='probability of wildcards in patterns')
+    parser.add_argument('--topics', type=int, default=1000,
+                        help='topics published to')
+    parser.add_argument('--scanned', type=int, default=10,
+                        help='topics matched by a scan of the patterns')
+    parser.add_argument('--seed', type=int, default=0)
+    run.add_report_args(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    results = benchmark(args.manager, dict(args.option), args.patterns,
+                        args.depth, args.width, args.wildcards, args.topics,
+                        args.scanned, args.seed)
+    return run.report(results, args, COMPARED)
+
+if __name__ == '__main__':
+    sys.exit(main())
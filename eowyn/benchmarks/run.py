@@ -0,0 +1,260 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Run a benchmark of Eowyn, and compare it with a previous run
+
+The benchmark drives a manager directly, or the API over HTTP, served in
+process by the threaded development server, or by the pre-fork server of
+eowyn-api in forked processes. The simple manager runs in process, other
+managers need their backend, e.g. a local Redis.
+
+Examples:
+
+    eowyn-benchmark --target manager --manager simple
+    eowyn-benchmark --target api --manager redis --option port=6379 \\
+        --publishers 4 --subscribers 4 --fanout 10 --output new.json \\
+        --baseline old.json
+    eowyn-benchmark --target api --manager redis --output dev.json
+    eowyn-benchmark --target api --manager redis --server prefork \\
+        --workers 4 --baseline dev.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import signal
+import sys
+import threading
+import time
+
+from werkzeug import serving
+
+from eowyn.benchmarks import load
+from eowyn import exceptions as eowyn_exc
+from eowyn.model import managers
+from eowyn import server as prefork
+
+TARGETS = ('manager', 'api')
+SERVERS = ('dev', 'prefork')
+
+# Results compared across runs, and whether higher is better
+COMPARED = [(('throughput', 'publish'), True),
+            (('throughput', 'deliver'), True)] + [
+    (('latency', operation, statistic), False)
+    for operation in ('publish', 'pop', 'delivery')
+    for statistic in ('p50', 'p99')]
+
+
+class _QuietRequestHandler(serving.WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+        # Logging each request would slow the server down
+        pass
+
+
+def serve(app):
+    """Serve a WSGI app on a free local port, in a thread"""
+    server = serving.make_server('127.0.0.1', 0, app, threaded=True,
+                                 request_handler=_QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def serve_prefork(make_app, workers, threads):
+    """Serve a WSGI app on a free local port, with pre-forked workers
+
+    :param make_app: function creating the app, called by the workers
+    :returns: the port, and the pid of the master, to be stopped with
+        SIGTERM
+    """
+    listener = prefork.listen('127.0.0.1', 0, 128)
+    options = dict(prefork.DEFAULTS, workers=workers, threads=threads)
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            code = prefork.Master(listener, make_app, options).run()
+        finally:
+            os._exit(code)
+    port = listener.getsockname()[1]
+    listener.close()
+    return port, pid
+
+
+def benchmark(target, manager_type, options, scenario, server='dev',
+              workers=1, threads=prefork.DEFAULTS['threads']):
+    """Run a scenario against a target, backed by a manager
+
+    :param target: 'manager' or 'api'
+    :param manager_type: name of the manager, as in the configuration
+    :param options: options of the manager
+    :param scenario: the load.Scenario to run
+    :param server: server of the api, 'dev' or 'prefork'
+    :param workers: workers of the pre-fork server
+    :param threads: threads of each worker of the pre-fork server
+    :returns: the results, along with what was run
+    """
+    # Topics of concurrent runs do not collide
+    prefix = 'bench%d_%d_' % (os.getpid(), int(time.time()))
+    dev = master = None
+    if target == 'api':
+        from eowyn import api
+        if server == 'prefork':
+            if workers > 1 and not managers.is_shared(manager_type):
+                raise eowyn_exc.InvalidDataException(key='workers',
+                                                     value=workers)
+
+            def make_app():
+                # Each worker has a manager of its own
+                api.manager = managers.get_manager(manager_type, **options)
+                return api.app
+            port, master = serve_prefork(make_app, workers, threads)
+        else:
+            api.manager = managers.get_manager(manager_type, **options)
+            dev = serve(api.app)
+            port = dev.server_port
+        client = load.HTTPClient('127.0.0.1', port)
+    else:
+        client = load.ManagerClient(
+            managers.get_manager(manager_type, **options))
+    try:
+        results = load.run(client, scenario, prefix)
+    finally:
+        if dev is not None:
+            dev.shutdown()
+        if master is not None:
+            os.kill(master, signal.SIGTERM)
+            os.waitpid(master, 0)
+    served = {}
+    if target == 'api':
+        served = {'type': server}
+        if server == 'prefork':
+            served.update(workers=workers, threads=threads)
+    return {'target': target,
+            'manager': manager_type,
+            'options': options,
+            'server': served,
+            'scenario': scenario.to_dict(),
+            'python': platform.python_version(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'results': results}
+
+
+def _get(results, path):
+    for key in path:
+        results = results.get(key, {})
+    return results or None
+
+
+def compare(baseline, current, threshold=0.1, compared=COMPARED):
+    """Compare the results of a run with those of a baseline run
+
+    :param threshold: relative change beyond which a result regressed
+    :param compared: paths of the results compared, and whether higher
+        is better
+    :returns: a list of (name, baseline, current, change, regressed),
+        for the results found in both runs
+    """
+    comparison = []
+    for path, higher_is_better in compared:
+        old = _get(baseline['results'], path)
+        new = _get(current['results'], path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old
+        regressed = (-change if higher_is_better else change) > threshold
+        comparison.append(('.'.join(path), old, new, change, regressed))
+    return comparison
+
+
+def _option(value):
+    key, sep, option = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('%s is not key=value' % value)
+    return key, option
+
+
+def add_manager_args(parser):
+    parser.add_argument('--manager', default='simple',
+                        help='manager type, e.g. simple or redis')
+    parser.add_argument('--option', type=_option, action='append',
+                        default=[], metavar='KEY=VALUE',
+                        help='option of the manager, may be repeated')
+
+
+def add_report_args(parser):
+    parser.add_argument('--output', help='file to write results to, as '
+                        'JSON, instead of standard output')
+    parser.add_argument('--baseline', help='results of a previous run to '
+                        'compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change reported as a regression')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--target', choices=TARGETS, default='manager')
+    parser.add_argument('--server', choices=SERVERS, default='dev',
+                        help='server of the api target')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='workers of the prefork server')
+    parser.add_argument('--threads', type=int,
+                        default=prefork.DEFAULTS['threads'],
+                        help='threads of each worker of the prefork server')
+    add_manager_args(parser)
+    defaults = load.Scenario()
+    for name in sorted(defaults.to_dict()):
+        parser.add_argument('--' + name.replace('_', '-'),
+                            type=type(getattr(defaults, name)),
+                            default=getattr(defaults, name))
+    add_report_args(parser)
+    return parser.parse_args(argv)
+
+
+def report(results, args, compared=COMPARED):
+    """Write results out, and compare them with the baseline, if any
+
+    :returns: the exit code, 1 if any result regressed
+    """
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as baseline:
+        comparison = compare(json.load(baseline), results, args.threshold,
+                             compared)
+    for name, old, new, change, regressed in comparison:
+        sys.stderr.write('%-24s %12.6g %12.6g %+8.1f%%%s\n' % (
+            name, old, new, change * 100, '  REGRESSED' if regressed else ''))
+    # A non zero exit code lets CI fail on regressions
+    return 1 if any(c[-1] for c in comparison) else 0
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    scenario = load.Scenario(**dict(
+        (name, getattr(args, name)) for name in load.Scenario().to_dict()))
+    results = benchmark(args.target, args.manager, dict(args.option),
+                        scenario, args.server, args.workers, args.threads)
+    return report(results, args)
+
+if __name__ == '__main__':
+    sys.exit(main())
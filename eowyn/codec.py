@@ -0,0 +1,103 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Encoding of messages in storage
+
+Messages larger than a threshold are compressed once, when published.
+Compressed entries start with a two bytes header, a marker followed by the
+codec. Messages are UTF-8 text, which never contains the marker, so plain
+messages are stored as they are, and both kinds coexist in a queue.
+
+The JSON representation of the message is compressed, in gzip format, so
+that it can be sent as is to clients that accept gzip content encoding.
+"""
+
+import json
+import zlib
+
+import eowyn.exceptions as eowyn_exc
+
+MARKER = b'\xff'
+GZIP = b'g'
+
+# zlib window bits for the gzip format
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def check(message):
+    """Check that a message is UTF-8 text
+
+    Messages are sent to subscribers as JSON strings, and entries which
+    start with the marker are decompressed, so any other body is rejected.
+    """
+    try:
+        message.decode('utf-8')
+    except UnicodeDecodeError:
+        raise eowyn_exc.InvalidDataException(key='message',
+                                             value='not UTF-8')
+
+
+def encode(message, threshold):
+    """Encode a message for storage
+
+    :param message: the message, UTF-8 encoded
+    :param threshold: minimum size of compressed messages, 0 to disable
+    :returns: the entry to store
+    """
+    if not threshold or len(message) < threshold:
+        return message
+    try:
+        body = json.dumps(message.decode('utf-8')).encode('utf-8')
+    except UnicodeDecodeError:
+        # Not text, the marker could be part of the message
+        return message
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  _GZIP_WBITS)
+    entry = MARKER + GZIP + compressor.compress(body) + compressor.flush()
+    # Messages that do not compress are kept plain
+    if len(entry) >= len(message):
+        return message
+    return entry
+
+
+def is_compressed(entry):
+    return entry[:2] == MARKER + GZIP
+
+
+def accepts_gzip(accept_encoding):
+    """Whether an Accept-Encoding header value allows gzip"""
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        if name.strip() in ('gzip', '*'):
+            params = params.replace(' ', '')
+            if not params.startswith('q='):
+                return True
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+    return False
+
+
+def compressed_body(entry):
+    """JSON representation of a compressed entry, in gzip format"""
+    return entry[2:]
+
+
+def decode(entry):
+    """Decode a stored entry into the message, UTF-8 encoded"""
+    if not is_compressed(entry):
+        return entry
+    body = zlib.decompress(compressed_body(entry), _GZIP_WBITS)
+    return json.loads(body.decode('utf-8')).encode('utf-8')
@@ -0,0 +1,57 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from six.moves import configparser
+
+
+def load(argv):
+    """Load the configuration of Eowyn
+
+    :param argv: command line arguments, the first one is the config file
+    :returns: a tuple (manager_type, manager_configs, debug)
+    """
+    config = configparser.ConfigParser()
+    try:
+        # Read config file as first command line parameter
+        config_file = argv[1]
+        config.read(config_file)
+        # Use the configured manager
+        manager_type = config.get('default', 'manager')
+        manager_configs = config.items(manager_type)
+        # In case of duplicated configs, the last one wins
+        manager_configs = {k: v for (k, v) in manager_configs}
+        # Other configs
+        debug = config.getboolean('default', 'debug')
+    except IndexError:
+        # Or else use defaults
+        debug = False
+        manager_type = 'redis'
+        manager_configs = {'host': 'localhost', 'port': 6379}
+    return manager_type, manager_configs, debug
+
+
+def load_section(argv, section):
+    """Load the options of a section of the configuration of Eowyn
+
+    :param argv: command line arguments, the first one is the config file
+    :param section: name of the section
+    :returns: a dict of options, empty if there is no such section
+    """
+    config = configparser.ConfigParser()
+    if len(argv) < 2:
+        return {}
+    config.read(argv[1])
+    if not config.has_section(section):
+        return {}
+    return dict(config.items(section))
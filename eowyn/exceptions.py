@@ -55,5 +55,9 @@ class NoMessageFoundException(EowynException):
     message = 'No message found for username {username} on topic {topic}'
 
 
+class QueueFullException(EowynException):
+    message = 'Queue of {username} on topic {topic} is full'
+
+
 class InvalidDataException(EowynException):
     message = 'Invalid value {value} for {key}'
@@ -0,0 +1,262 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Metrics of Eowyn, in the Prometheus text format
+
+Metrics are aggregated in process, as they are recorded. Each series of
+a metric, i.e. each combination of label values, has its own lock, so
+recording only contends with recording on the same series, and takes a
+few dictionary lookups and arithmetic operations.
+"""
+
+import bisect
+import threading
+import time
+
+# Latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _new_series(self):
+        raise NotImplementedError()
+
+    def series(self, *values):
+        """Series of the metric for a combination of label values"""
+        series = self._series.get(values)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(values, self._new_series())
+        return series
+
+    def clear(self):
+        with self._lock:
+            self._series = {}
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        # Series may be added while rendering
+        with self._lock:
+            items = list(self._series.items())
+        for values, series in sorted(items):
+            lines.extend(self._render_series(values, series))
+        return lines
+
+
+class _CounterSeries(object):
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+
+    kind = 'counter'
+
+    def _new_series(self):
+        return _CounterSeries()
+
+    def inc(self, *values, **kwargs):
+        self.series(*values).inc(kwargs.get('amount', 1))
+
+    def _render_series(self, values, series):
+        yield '%s%s %s' % (self.name, _format_labels(self.labels, values),
+                           _format_value(series.value))
+
+
+class _GaugeSeries(object):
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Gauge(_Metric):
+
+    kind = 'gauge'
+
+    def _new_series(self):
+        return _GaugeSeries()
+
+    def set(self, value, *values):
+        self.series(*values).set(value)
+
+    def _render_series(self, values, series):
+        yield '%s%s %s' % (self.name, _format_labels(self.labels, values),
+                           _format_value(series.value))
+
+
+class _HistogramSeries(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Observations by bucket, the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def _new_series(self):
+        return _HistogramSeries(self.buckets)
+
+    def observe(self, value, *values):
+        self.series(*values).observe(value)
+
+    def _render_series(self, values, series):
+        with series._lock:
+            counts = list(series.counts)
+            total = series.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield '%s_bucket%s %d' % (
+                self.name,
+                _format_labels(self.labels, values,
+                               [('le', _format_value(float(bound)))]),
+                cumulative)
+        labels = _format_labels(self.labels, values)
+        yield '%s_sum%s %s' % (self.name, labels, _format_value(total))
+        yield '%s_count%s %d' % (self.name, labels, cumulative)
+
+
+REQUESTS = Histogram(
+    'eowyn_http_request_duration_seconds',
+    'Latency of HTTP requests, by route, method and status',
+    ['route', 'method', 'status'])
+MANAGER_CALLS = Histogram(
+    'eowyn_manager_call_duration_seconds',
+    'Latency of manager calls, by manager, operation and outcome',
+    ['manager', 'operation', 'outcome'])
+PUBLISHED = Counter('eowyn_messages_published_total',
+                    'Messages published to topics')
+DELIVERED = Counter('eowyn_messages_delivered_total',
+                    'Messages popped by subscribers')
+DROPPED = Counter('eowyn_messages_dropped_total',
+                  'Messages dropped or rejected by retention policies')
+QUEUED = Gauge('eowyn_queued_messages',
+               'Messages queued for the subscribers of a sampled topic',
+               ['topic'])
+MAX_QUEUED = Gauge('eowyn_max_queued_messages',
+                   'Messages queued for the slowest subscriber of a '
+                   'sampled topic', ['topic'])
+
+METRICS = [REQUESTS, MANAGER_CALLS, PUBLISHED, DELIVERED, DROPPED, QUEUED,
+           MAX_QUEUED]
+
+# Seconds between samples of the queue depths, and maximum number of
+# topics sampled
+SAMPLE_INTERVAL = 10
+SAMPLE_TOPICS = 100
+
+_sampled = {'time': None}
+_sample_lock = threading.Lock()
+
+
+def sample_due():
+    """Whether queue depths are due to be sampled
+
+    Samples are taken at most once every SAMPLE_INTERVAL seconds, as
+    they may take a round trip per topic.
+    """
+    with _sample_lock:
+        now = time.time()
+        last = _sampled['time']
+        if last is not None and now - last < SAMPLE_INTERVAL:
+            return False
+        _sampled['time'] = now
+        return True
+
+
+def set_depths(depths):
+    """Record sampled queue depths
+
+    :param depths: messages queued by username, by topic, as returned by
+        get_queue_depths. None if the manager does not support it.
+    """
+    if depths is None:
+        return
+    QUEUED.clear()
+    MAX_QUEUED.clear()
+    for topic, queues in depths.items():
+        QUEUED.set(sum(queues.values()), topic)
+        MAX_QUEUED.set(max(queues.values()) if queues else 0, topic)
+
+
+def render(manager=None):
+    """Render all metrics in the Prometheus text format
+
+    :param manager: if specified, the queue depths of up to SAMPLE_TOPICS
+        of its topics are sampled, when due
+    """
+    if manager is not None and sample_due():
+        set_depths(manager.get_queue_depths(SAMPLE_TOPICS))
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
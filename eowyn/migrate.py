@@ -0,0 +1,41 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Migrate the data of Eowyn to the layout of the current version
+
+Run once on upgrade, with the configuration file of the API, after the
+processes of the previous version are stopped:
+
+    eowyn-migrate /etc/eowyn/api.conf
+"""
+
+import sys
+
+from eowyn import config
+from eowyn.model import managers
+
+
+def main(argv=None):
+    argv = sys.argv if argv is None else argv
+    manager_type, manager_configs, _ = config.load(argv)
+    manager = managers.get_manager(manager_type, **manager_configs)
+    moved = manager.migrate()
+    if moved is None:
+        print('Nothing to migrate with the %s manager' % manager_type)
+    else:
+        print('Moved %d queues' % moved)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
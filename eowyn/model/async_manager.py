@@ -0,0 +1,300 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import abc
+import asyncio
+import collections
+
+from eowyn import exceptions as eowyn_exc
+from eowyn.model import manager
+from eowyn.model import retention
+
+
+class AsyncManager(manager.Validator, metaclass=abc.ABCMeta):
+    """Asynchronous manager of subscription and messages
+
+    Defines the same API as Manager, as coroutines, so that many
+    subscribers may wait for messages in a single thread.
+    Requires Python 3.
+    """
+
+    @abc.abstractmethod
+    async def create_subscription(self, topic, username):
+        """See Manager.create_subscription"""
+        self.validate_topic(topic)
+        self.validate_pattern(topic)
+        self.validate_username(username)
+
+    @abc.abstractmethod
+    async def delete_subscription(self, topic, username):
+        """See Manager.delete_subscription"""
+        self.validate_topic(topic)
+        self.validate_username(username)
+
+    @abc.abstractmethod
+    async def publish_message(self, topic, message):
+        """See Manager.publish_message"""
+        self.validate_topic(topic)
+        self.validate_published_topic(topic)
+        self.validate_message(message)
+
+    @abc.abstractmethod
+    async def publish_messages(self, topic, messages):
+        """See Manager.publish_messages"""
+        self.validate_topic(topic)
+        self.validate_published_topic(topic)
+        self.validate_messages(messages)
+
+    @abc.abstractmethod
+    async def pop_message(self, topic, username, wait=0):
+        """See Manager.pop_message"""
+        self.validate_topic(topic)
+        self.validate_username(username)
+        self.validate_wait(wait)
+
+    @abc.abstractmethod
+    async def pop_messages(self, topic, username, max_count, wait=0):
+        """See Manager.pop_messages"""
+        self.validate_topic(topic)
+        self.validate_username(username)
+        self.validate_max_count(max_count)
+        self.validate_wait(wait)
+
+    async def create_subscriptions(self, username, topics):
+        """See Manager.create_subscriptions"""
+        self.validate_username(username)
+        self.validate_topics(topics)
+
+    async def get_topics(self, username):
+        """See Manager.get_topics"""
+        self.validate_username(username)
+
+    async def delete_subscriptions(self, username):
+        """See Manager.delete_subscriptions"""
+        self.validate_username(username)
+
+    async def pop_messages_with_position(self, topic, username, max_count,
+                                         wait=0):
+        """See Manager.pop_messages_with_position"""
+        self.validate_topic(topic)
+        self.validate_username(username)
+        self.validate_max_count(max_count)
+        self.validate_wait(wait)
+
+    async def pop_user_messages(self, username, max_count, wait=0):
+        """See Manager.pop_user_messages"""
+        self.validate_username(username)
+        self.validate_max_count(max_count)
+        self.validate_wait(wait)
+
+    async def get_position(self, topic, username):
+        """See Manager.get_position"""
+        self.validate_topic(topic)
+        self.validate_username(username)
+
+    async def rewind(self, topic, username, position):
+        """See Manager.rewind"""
+        self.validate_topic(topic)
+        self.validate_username(username)
+        self.validate_position(position)
+        return False
+
+    async def get_dropped(self, topic, username):
+        """See Manager.get_dropped"""
+        self.validate_topic(topic)
+        self.validate_username(username)
+
+    async def get_queue_depths(self, limit):
+        """See Manager.get_queue_depths"""
+
+
+class Waiters(object):
+    """Subscribers waiting for messages, by topic
+
+    Each topic has an event, which is set and replaced by a new one when
+    messages are published to the topic. Waiters get the event before
+    checking for messages, so they cannot miss a notification.
+    """
+
+    def __init__(self):
+        self.events = {}
+        self.count = collections.Counter()
+
+    def add(self, topic):
+        self.count[topic] += 1
+        return self.events.setdefault(topic, asyncio.Event())
+
+    def remove(self, topic):
+        self.count[topic] -= 1
+        if not self.count[topic]:
+            del self.count[topic]
+            del self.events[topic]
+
+    def notify(self, topic):
+        event = self.events.get(topic)
+        if event is not None:
+            self.events[topic] = asyncio.Event()
+            event.set()
+
+    async def wait(self, topic, pop, wait):
+        """Pop messages, waiting up to wait seconds for them
+
+        :param topic: topic to wait on
+        :param pop: coroutine function that pops the messages
+        :param wait: seconds to wait for messages
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + wait
+        self.add(topic)
+        try:
+            while True:
+                event = self.events[topic]
+                try:
+                    return await pop()
+                except eowyn_exc.NoMessageFoundException:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        raise
+                    try:
+                        await asyncio.wait_for(event.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self.remove(topic)
+
+
+class AsyncSimpleManager(AsyncManager):
+    """Asynchronous in-memory manager
+
+    Subscriptions and messages are held by a SimpleManager, whose
+    operations never block. Waiting for messages is done on asyncio
+    events instead of threading conditions.
+    """
+
+    supports_patterns = True
+
+    def __init__(self, max_length=0, max_age=0,
+                 overflow=retention.DROP_OLDEST, topic_retention=''):
+        self.manager = manager.SimpleManager(max_length, max_age, overflow,
+                                             topic_retention)
+        self.waiters = Waiters()
+        # Users waiting for messages from any of their topics
+        self.user_waiters = Waiters()
+
+    async def create_subscription(self, topic, username):
+        await super(AsyncSimpleManager, self).create_subscription(
+            topic, username)
+        return self.manager.create_subscription(topic, username)
+
+    async def delete_subscription(self, topic, username):
+        await super(AsyncSimpleManager, self).delete_subscription(
+            topic, username)
+        self.manager.delete_subscription(topic, username)
+        # Let subscribers waiting on this subscription know it's gone
+        self.waiters.notify(topic)
+        return topic
+
+    def _notify(self, topic):
+        # Subscribers to the patterns matching the topic are notified too
+        for target in [topic] + self.manager.patterns.match(topic):
+            self.waiters.notify(target)
+            state = self.manager.topics.get(target)
+            if self.user_waiters.events and state is not None:
+                for username in state.subscriptions:
+                    self.user_waiters.notify(username)
+
+    async def publish_message(self, topic, message):
+        await super(AsyncSimpleManager, self).publish_message(topic, message)
+        self.manager.publish_message(topic, message)
+        self._notify(topic)
+
+    async def publish_messages(self, topic, messages):
+        await super(AsyncSimpleManager, self).publish_messages(
+            topic, messages)
+        self.manager.publish_messages(topic, messages)
+        self._notify(topic)
+
+    async def _pop(self, topic, username, max_count, wait):
+        async def pop():
+            return self.manager.pop_messages(topic, username, max_count)
+        if not wait:
+            return await pop()
+        return await self.waiters.wait(topic, pop, wait)
+
+    async def pop_message(self, topic, username, wait=0):
+        await super(AsyncSimpleManager, self).pop_message(
+            topic, username, wait)
+        messages = await self._pop(topic, username, 1, wait)
+        return messages[0]
+
+    async def pop_messages(self, topic, username, max_count, wait=0):
+        await super(AsyncSimpleManager, self).pop_messages(
+            topic, username, max_count, wait)
+        return await self._pop(topic, username, max_count, wait)
+
+    async def create_subscriptions(self, username, topics):
+        await super(AsyncSimpleManager, self).create_subscriptions(
+            username, topics)
+        return self.manager.create_subscriptions(username, topics)
+
+    async def get_topics(self, username):
+        await super(AsyncSimpleManager, self).get_topics(username)
+        return self.manager.get_topics(username)
+
+    async def delete_subscriptions(self, username):
+        await super(AsyncSimpleManager, self).delete_subscriptions(username)
+        topics = self.manager.delete_subscriptions(username)
+        # Let subscribers waiting on these subscriptions know they're gone
+        for topic in topics:
+            self.waiters.notify(topic)
+        return topics
+
+    async def pop_messages_with_position(self, topic, username, max_count,
+                                         wait=0):
+        await super(AsyncSimpleManager, self).pop_messages_with_position(
+            topic, username, max_count, wait)
+
+        async def pop():
+            return self.manager.pop_messages_with_position(topic, username,
+                                                           max_count)
+        if not wait:
+            return await pop()
+        return await self.waiters.wait(topic, pop, wait)
+
+    async def pop_user_messages(self, username, max_count, wait=0):
+        await super(AsyncSimpleManager, self).pop_user_messages(
+            username, max_count, wait)
+
+        async def pop():
+            return self.manager.pop_user_messages(username, max_count)
+        if not wait:
+            return await pop()
+        return await self.user_waiters.wait(username, pop, wait)
+
+    async def get_position(self, topic, username):
+        await super(AsyncSimpleManager, self).get_position(topic, username)
+        return self.manager.get_position(topic, username)
+
+    async def rewind(self, topic, username, position):
+        await super(AsyncSimpleManager, self).rewind(
+            topic, username, position)
+        return self.manager.rewind(topic, username, position)
+
+    async def get_dropped(self, topic, username):
+        await super(AsyncSimpleManager, self).get_dropped(topic, username)
+        return self.manager.get_dropped(topic, username)
+
+    async def get_queue_depths(self, limit):
+        await super(AsyncSimpleManager, self).get_queue_depths(limit)
+        return self.manager.get_queue_depths(limit)
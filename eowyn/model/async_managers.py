@@ -0,0 +1,28 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from eowyn import exceptions as eowyn_exc
+from eowyn.model import async_manager
+from eowyn.model import async_redis_manager
+
+classes = {'simple': async_manager.AsyncSimpleManager,
+           'redis': async_redis_manager.AsyncRedisManager}
+
+
+def get_manager(name='redis', **kwargs):
+    # Same names as in managers, for the asynchronous implementations
+    if name in classes.keys():
+        return classes[name](**kwargs)
+    else:
+        raise eowyn_exc.InvalidManagerException(manager=name)
@@ -0,0 +1,284 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import collections
+
+from redis import asyncio as aioredis
+
+from eowyn import exceptions as eowyn_exc
+from eowyn.model import async_manager
+from eowyn.model import redis_manager
+from eowyn.model import retention
+
+
+class AsyncRedisManager(async_manager.AsyncManager):
+    """Asynchronous Redis backed manager
+
+    Uses the same data layout and scripts as RedisManager, so both may
+    share the same Redis DB.
+
+    Subscribers waiting for messages do not hold a connection each.
+    Publishing notifies a channel named after the topic; a single
+    pub/sub connection listens to the topics with waiting subscribers.
+    Users waiting for messages from any of their topics register as
+    RedisManager does, and listen to their ready/wake channel instead of
+    blocking on the list.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0,
+                 max_connections=50, max_length=0, max_age=0,
+                 overflow=retention.DROP_OLDEST, topic_retention='',
+                 dedup_threshold=0, patterns=False):
+        self.retention = retention.Retention(max_length, max_age, overflow,
+                                             topic_retention)
+        self.dedup_threshold = int(dedup_threshold)
+        self.supports_patterns = str(patterns).lower() in ('true', '1',
+                                                           'yes')
+        # Requests queue up for a connection rather than failing when
+        # many of them are in flight
+        _pool = aioredis.BlockingConnectionPool(
+            host=host, port=int(port), db=int(db),
+            max_connections=int(max_connections))
+        self.store = aioredis.StrictRedis(connection_pool=_pool)
+        self._publish_messages = self.store.register_script(
+            redis_manager._PUBLISH_MESSAGES)
+        self._pop_messages = self.store.register_script(
+            redis_manager._POP_MESSAGES)
+        self._pop_user_messages = self.store.register_script(
+            redis_manager._POP_USER_MESSAGES)
+        self._wait_user = self.store.register_script(
+            redis_manager._WAIT_USER)
+        self._create_subscription = self.store.register_script(
+            redis_manager._CREATE_SUBSCRIPTION)
+        self._delete_subscription = self.store.register_script(
+            redis_manager._DELETE_SUBSCRIPTION)
+        self.waiters = async_manager.Waiters()
+        self._pubsub = self.store.pubsub()
+        # Serializes the commands sent on the pub/sub connection
+        self._pubsub_lock = asyncio.Lock()
+        self._listener = None
+        # Topics listened to, with an event set once the subscription to
+        # the topic channel is confirmed
+        self._watching = collections.Counter()
+        self._watched = {}
+
+    def _queue(self, topic, username):
+        return topic + redis_manager.QUEUE_SEPARATOR + username
+
+    async def _listen(self):
+        while self._pubsub.subscribed:
+            message = await self._pubsub.get_message(timeout=None)
+            if message is None:
+                continue
+            topic = message['channel'].decode('utf-8')
+            if message['type'] == 'subscribe' and topic in self._watched:
+                self._watched[topic].set()
+            elif message['type'] == 'message':
+                self.waiters.notify(topic)
+
+    async def _watch(self, topic):
+        self._watching[topic] += 1
+        if topic not in self._watched:
+            self._watched[topic] = asyncio.Event()
+            async with self._pubsub_lock:
+                await self._pubsub.subscribe(topic)
+            if self._listener is None or self._listener.done():
+                self._listener = asyncio.ensure_future(self._listen())
+        # Publishing before the subscription is confirmed would not wake
+        # the subscriber up
+        await self._watched[topic].wait()
+
+    async def _unwatch(self, topic):
+        self._watching[topic] -= 1
+        if not self._watching[topic]:
+            del self._watching[topic]
+            del self._watched[topic]
+            async with self._pubsub_lock:
+                await self._pubsub.unsubscribe(topic)
+
+    async def create_subscription(self, topic, username):
+        await super(AsyncRedisManager, self).create_subscription(
+            topic, username)
+        # Changes are announced to the caches of RedisManagers
+        if not await self._create_subscription(
+                keys=[topic, redis_manager._user_key(username),
+                      redis_manager._ready_key(username)],
+                args=redis_manager._subscription_args(
+                    topic, username, self.supports_patterns)):
+            raise eowyn_exc.SubscriptionAlreadyExistsException(
+                topic=topic, username=username)
+        return topic
+
+    async def delete_subscription(self, topic, username):
+        await super(AsyncRedisManager, self).delete_subscription(
+            topic, username)
+        if not await self._delete_subscription(
+                keys=[topic, self._queue(topic, username),
+                      redis_manager._user_key(username),
+                      redis_manager._ready_key(username)],
+                args=redis_manager._subscription_args(
+                    topic, username, self.supports_patterns)):
+            raise eowyn_exc.SubscriptionNotFoundException(
+                topic=topic, username=username)
+        return topic
+
+    async def create_subscriptions(self, username, topics):
+        await super(AsyncRedisManager, self).create_subscriptions(
+            username, topics)
+        async with self.store.pipeline(transaction=False) as pipe:
+            for topic in topics:
+                await self._create_subscription(
+                    keys=[topic, redis_manager._user_key(username),
+                          redis_manager._ready_key(username)],
+                    args=redis_manager._subscription_args(
+                        topic, username, self.supports_patterns),
+                    client=pipe)
+            added = await pipe.execute()
+        return [topic for topic, created in zip(topics, added) if created]
+
+    async def get_topics(self, username):
+        await super(AsyncRedisManager, self).get_topics(username)
+        return sorted(topic.decode('utf-8') for topic in
+                      await self.store.smembers(
+                          redis_manager._user_key(username)))
+
+    async def delete_subscriptions(self, username):
+        await super(AsyncRedisManager, self).delete_subscriptions(username)
+        topics = await self.get_topics(username)
+        if not topics:
+            return []
+        async with self.store.pipeline(transaction=False) as pipe:
+            for topic in topics:
+                await self._delete_subscription(
+                    keys=[topic, self._queue(topic, username),
+                          redis_manager._user_key(username),
+                          redis_manager._ready_key(username)],
+                    args=redis_manager._subscription_args(
+                        topic, username, self.supports_patterns),
+                    client=pipe)
+            removed = await pipe.execute()
+        # Subscriptions may be deleted concurrently
+        return [topic for topic, deleted in zip(topics, removed) if deleted]
+
+    async def publish_message(self, topic, message):
+        await super(AsyncRedisManager, self).publish_message(topic, message)
+        redis_manager._check_published(topic, await self._publish_messages(
+            keys=[topic], args=redis_manager._publish_args(
+                self.retention.get(topic), self.dedup_threshold,
+                [message], self.supports_patterns)))
+
+    async def publish_messages(self, topic, messages):
+        await super(AsyncRedisManager, self).publish_messages(
+            topic, messages)
+        redis_manager._check_published(topic, await self._publish_messages(
+            keys=[topic], args=redis_manager._publish_args(
+                self.retention.get(topic), self.dedup_threshold,
+                messages, self.supports_patterns)))
+
+    async def _pop_now(self, topic, username, max_count):
+        messages = await self._pop_messages(
+            keys=[topic, self._queue(topic, username)],
+            args=[username, max_count])
+        if messages is None:
+            raise eowyn_exc.SubscriptionNotFoundException(
+                topic=topic, username=username)
+        if not messages:
+            raise eowyn_exc.NoMessageFoundException(
+                topic=topic, username=username)
+        return messages
+
+    async def _pop(self, topic, username, max_count, wait):
+        async def pop():
+            return await self._pop_now(topic, username, max_count)
+        try:
+            return await pop()
+        except eowyn_exc.NoMessageFoundException:
+            if not wait:
+                raise
+        await self._watch(topic)
+        try:
+            return await self.waiters.wait(topic, pop, wait)
+        finally:
+            await self._unwatch(topic)
+
+    async def pop_message(self, topic, username, wait=0):
+        await super(AsyncRedisManager, self).pop_message(
+            topic, username, wait)
+        messages = await self._pop(topic, username, 1, wait)
+        return messages[0]
+
+    async def pop_messages(self, topic, username, max_count, wait=0):
+        await super(AsyncRedisManager, self).pop_messages(
+            topic, username, max_count, wait)
+        return await self._pop(topic, username, max_count, wait)
+
+    async def pop_user_messages(self, username, max_count, wait=0):
+        await super(AsyncRedisManager, self).pop_user_messages(
+            username, max_count, wait)
+        ready = redis_manager._ready_key(username)
+
+        async def pop():
+            return redis_manager._user_messages(
+                username, await self._pop_user_messages(
+                    keys=[ready], args=[username, max_count]))
+        try:
+            return await pop()
+        except eowyn_exc.NoMessageFoundException:
+            if not wait:
+                raise
+        # Channels are named after keys, which never collide with topics
+        channel = ready + '/wake'
+        await self._watch(channel)
+        await self._wait_user(keys=[ready + '/waiting'], args=[1, wait + 1])
+        try:
+            return await self.waiters.wait(channel, pop, wait)
+        finally:
+            await self._wait_user(keys=[ready + '/waiting'], args=[-1, 0])
+            await self._unwatch(channel)
+
+    async def get_dropped(self, topic, username):
+        await super(AsyncRedisManager, self).get_dropped(topic, username)
+        async with self.store.pipeline() as pipe:
+            pipe.sismember(topic, username)
+            pipe.hget(topic + '/dropped', username)
+            subscribed, dropped = await pipe.execute()
+        if not subscribed:
+            raise eowyn_exc.SubscriptionNotFoundException(
+                topic=topic, username=username)
+        return int(dropped or 0)
+
+    async def get_queue_depths(self, limit):
+        await super(AsyncRedisManager, self).get_queue_depths(limit)
+        topics = []
+        async for key in self.store.scan_iter(_type='SET'):
+            if len(topics) == limit:
+                break
+            if redis_manager._is_topic_key(key):
+                topics.append(key.decode('utf-8'))
+        async with self.store.pipeline() as pipe:
+            for topic in topics:
+                pipe.smembers(topic)
+            members = await pipe.execute()
+        queues = [(topic, username.decode('utf-8'))
+                  for topic, usernames in zip(topics, members)
+                  for username in usernames]
+        async with self.store.pipeline() as pipe:
+            for topic, username in queues:
+                pipe.llen(self._queue(topic, username))
+            lengths = await pipe.execute()
+        depths = dict((topic, {}) for topic in topics)
+        for (topic, username), length in zip(queues, lengths):
+            depths[topic][username] = length
+        return depths
@@ -0,0 +1,78 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import threading
+import time
+
+
+class TTLCache(object):
+    """Thread safe cache with time to live and LRU eviction
+
+    Entries expire ttl seconds after they are set, and the least recently
+    used ones are evicted when the cache holds more than size entries.
+    Hits and misses are counted.
+
+    Values loaded while entries are invalidated may be stale. Callers take
+    a token before loading a value, and the value is only set if nothing
+    was invalidated in the meantime.
+    """
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._invalidations = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        """Get the value of key, None if not cached or expired"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # Move the entry to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def token(self):
+        with self._lock:
+            return self._invalidations
+
+    def set(self, key, value, token):
+        with self._lock:
+            if token != self._invalidations:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._invalidations += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
@@ -0,0 +1,629 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import errno
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+import six
+
+from eowyn import exceptions as eowyn_exc
+from eowyn.model import manager
+from eowyn.model import records
+
+_INDEX = 'index'
+_MAGIC = b'eowynidx'
+_VERSION = 2
+_INDEX_HEADER = struct.Struct('<8sIQI')
+_NAME = struct.Struct('<H')
+_COUNT = struct.Struct('<I')
+_CURSOR = struct.Struct('<QQQ')
+_SEGMENT_SUFFIX = '.log'
+
+# The journal holds the cursors moved since the index was written, in
+# batches, one per commit, checked by their CRC-32. Each record is a kind,
+# the name of the topic, the username for the cursors of subscribers, and
+# the cursor. The journal only applies to the index of its generation.
+_JOURNAL = 'journal'
+_JOURNAL_MAGIC = b'eowynjnl'
+_JOURNAL_HEADER = struct.Struct('<8sQ')
+_BATCH = struct.Struct('<II')
+_KIND = struct.Struct('<B')
+_END = 0
+_SUBSCRIBER = 1
+# Size the journal may reach before the index is written again, if larger
+# than the index
+_JOURNAL_SIZE = 1048576
+
+# A position in the log of a topic: the sequence number of the next
+# message, the sequence number of the first message of the segment it is
+# in, which names the segment, and the position in the segment.
+_Cursor = collections.namedtuple('_Cursor', 'sequence segment position')
+
+
+def _fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _pack_name(name):
+    if isinstance(name, six.text_type):
+        name = name.encode('utf-8')
+    return _NAME.pack(len(name)) + name
+
+
+def _unpack_name(data, position):
+    length = _NAME.unpack_from(data, position)[0]
+    start = position + _NAME.size
+    return data[start:start + length].decode('utf-8'), start + length
+
+
+class _Segment(object):
+    """A file of the log of a topic
+
+    Messages are appended with writes and read through a memory map of
+    the file, which is extended as the file grows.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        self.size = os.fstat(self.fd).st_size
+        self.map = None
+
+    def truncate(self, size):
+        os.ftruncate(self.fd, size)
+        self.size = size
+
+    def append(self, data):
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+            self.size += written
+
+    def read(self, position):
+        if self.map is None or len(self.map) < self.size:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+        return records.decode(self.map, position)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        os.close(self.fd)
+
+
+class _Topic(object):
+    """Subscriptions and log of messages of a topic
+
+    Access to a topic is serialized by its condition, as in SimpleManager.
+    """
+
+    def __init__(self, name, directory):
+        self.name = name
+        self.directory = directory
+        # Cursor of each subscriber
+        self.subscriptions = {}
+        # Segments by the sequence number of their first message
+        self.segments = collections.OrderedDict()
+        # Cursor after the last message written, and after the last one
+        # committed. Subscribers only read committed messages.
+        self.end = self.committed = _Cursor(0, 0, 0)
+        # Segments written since the last commit
+        self.unsynced = set()
+        self.condition = threading.Condition()
+
+    def segment_path(self, sequence):
+        return os.path.join(self.directory,
+                            '%020d%s' % (sequence, _SEGMENT_SUFFIX))
+
+    def add_segment(self, sequence):
+        segment = self.segments[sequence] = _Segment(
+            self.segment_path(sequence))
+        return segment
+
+
+class FileManager(manager.Manager):
+    """Durable, file backed implementation of a model manager
+
+    Each topic has an append-only log of messages, split in segment
+    files, and shared by all its subscribers. A subscription is a cursor
+    in the log. Cursors and the end of the log of each topic are
+    persisted in a compact index file, so that on start the state is
+    loaded from the index, without replaying the logs.
+
+    Changes are committed in groups: a committer thread syncs the
+    segments written and then appends the cursors moved to a journal,
+    once for all the changes made since the last commit. The whole index
+    is only written again when topics or subscriptions are added or
+    removed, when the journal grows larger than the index, and on start,
+    which folds the journal in it. Publishing returns once the message is
+    committed, and subscribers only receive committed messages, so a
+    message acknowledged is never lost. Pops are not waited for, so a
+    message may be received again after a crash.
+
+    Segments are deleted once all subscribers have read past them.
+    """
+
+    def __init__(self, path='/var/lib/eowyn', segment_size=16777216,
+                 commit_interval=0.005):
+        self.path = path
+        self.segment_size = int(segment_size)
+        # Time to wait for more changes before committing
+        self.commit_interval = float(commit_interval)
+        try:
+            os.makedirs(path)
+        except OSError as ose:
+            if ose.errno != errno.EEXIST:
+                raise
+        self.topics = {}
+        # Guards adding and dropping topics. It's always acquired before
+        # the condition of a topic.
+        self._lock = threading.Lock()
+        # Changes made and committed, and directories of topics deleted
+        # since the last commit. A commit which fails stops the committer,
+        # and its error is raised for all the changes not committed.
+        self._commit = threading.Condition()
+        self._changes = 0
+        self._committed = 0
+        self._deleted = []
+        self._closed = False
+        self._error = None
+        # State in the index and the journal, by topic name, generation of
+        # the index, and size of the index
+        self._indexed = {}
+        self._generation = 0
+        self._index_size = 0
+        self._journal = None
+        self._load()
+        self._committer = threading.Thread(target=self._commit_loop)
+        self._committer.daemon = True
+        self._committer.start()
+
+    def close(self):
+        """Commit pending changes and stop the committer"""
+        with self._commit:
+            if self._closed:
+                return
+            self._closed = True
+            self._commit.notify_all()
+        self._committer.join()
+        if self._journal is not None:
+            self._journal.close()
+        for topic in self.topics.values():
+            # Subscribers woken up by the last commit may be reading
+            with topic.condition:
+                for segment in topic.segments.values():
+                    segment.close()
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, _INDEX), 'rb') as index:
+                data = index.read()
+        except IOError as ioe:
+            if ioe.errno != errno.ENOENT:
+                raise
+            data = None
+        if data:
+            magic, version, generation, count = _INDEX_HEADER.unpack_from(
+                data, 0)
+            if magic != _MAGIC or version != _VERSION:
+                raise eowyn_exc.InvalidDataException(key='index',
+                                                     value=self.path)
+            self._generation = generation
+            self._index_size = len(data)
+            position = _INDEX_HEADER.size
+            for _ in range(count):
+                position = self._load_topic(data, position)
+        journal = self._replay_journal()
+        for topic in self.topics.values():
+            self._load_segments(topic)
+        snapshot = [(t, t.end, dict(t.subscriptions))
+                    for t in self.topics.values()]
+        if journal:
+            # Fold the journal in the index, the next commits start a new
+            # one
+            self._compact(snapshot)
+        else:
+            self._set_indexed(snapshot)
+        # Remove the directories of topics not in the index, i.e. deleted
+        # or created but never committed
+        directories = set(t.directory for t in self.topics.values())
+        for name in os.listdir(self.path):
+            directory = os.path.join(self.path, name)
+            if os.path.isdir(directory) and directory not in directories:
+                shutil.rmtree(directory)
+
+    def _load_topic(self, data, position):
+        name, position = _unpack_name(data, position)
+        directory, position = _unpack_name(data, position)
+        topic = _Topic(name, os.path.join(self.path, directory))
+        topic.end = topic.committed = _Cursor(
+            *_CURSOR.unpack_from(data, position))
+        position += _CURSOR.size
+        count = _COUNT.unpack_from(data, position)[0]
+        position += _COUNT.size
+        for _ in range(count):
+            username, position = _unpack_name(data, position)
+            topic.subscriptions[username] = _Cursor(
+                *_CURSOR.unpack_from(data, position))
+            position += _CURSOR.size
+        self.topics[name] = topic
+        return position
+
+    def _replay_journal(self):
+        # Apply the cursors moved since the index was written, up to the
+        # first batch not fully written. Returns whether there is a journal.
+        try:
+            with open(os.path.join(self.path, _JOURNAL), 'rb') as journal:
+                data = journal.read()
+        except IOError as ioe:
+            if ioe.errno != errno.ENOENT:
+                raise
+            return False
+        if len(data) < _JOURNAL_HEADER.size:
+            return True
+        magic, generation = _JOURNAL_HEADER.unpack_from(data, 0)
+        if magic != _JOURNAL_MAGIC or generation != self._generation:
+            # Left from an index written since
+            return True
+        position = _JOURNAL_HEADER.size
+        while position + _BATCH.size <= len(data):
+            length, crc = _BATCH.unpack_from(data, position)
+            position += _BATCH.size
+            batch = data[position:position + length]
+            if (len(batch) < length or
+                    zlib.crc32(batch) & 0xffffffff != crc):
+                break
+            position += length
+            offset = 0
+            while offset < length:
+                kind = _KIND.unpack_from(batch, offset)[0]
+                name, offset = _unpack_name(batch, offset + _KIND.size)
+                topic = self.topics[name]
+                if kind == _SUBSCRIBER:
+                    username, offset = _unpack_name(batch, offset)
+                cursor = _Cursor(*_CURSOR.unpack_from(batch, offset))
+                offset += _CURSOR.size
+                if kind == _SUBSCRIBER:
+                    topic.subscriptions[username] = cursor
+                else:
+                    topic.end = topic.committed = cursor
+        return True
+
+    def _load_segments(self, topic):
+        first = min(c.segment for c in topic.subscriptions.values())
+        segments = sorted(int(f[:-len(_SEGMENT_SUFFIX)])
+                          for f in os.listdir(topic.directory)
+                          if f.endswith(_SEGMENT_SUFFIX))
+        for sequence in segments:
+            if first <= sequence <= topic.end.segment:
+                topic.add_segment(sequence)
+            else:
+                # Segments already read, or created after the last commit
+                os.unlink(topic.segment_path(sequence))
+        if topic.end.segment not in topic.segments:
+            topic.add_segment(topic.end.segment)
+        # Drop what was written after the last commit
+        topic.segments[topic.end.segment].truncate(topic.end.position)
+
+    def _check_open(self):
+        # Changes would never be committed once the manager is closed, or
+        # a commit failed
+        with self._commit:
+            if self._error is not None:
+                raise self._error
+            if self._closed:
+                raise eowyn_exc.EowynException('The manager is closed')
+
+    def _changed(self):
+        # Record a change, and return the number to wait for to see it
+        # committed
+        with self._commit:
+            self._check_open()
+            self._changes += 1
+            self._commit.notify_all()
+            return self._changes
+
+    def _wait_committed(self, change):
+        with self._commit:
+            while self._committed < change:
+                if self._error is not None:
+                    raise self._error
+                self._commit.wait()
+
+    def _commit_loop(self):
+        while True:
+            with self._commit:
+                while self._committed == self._changes and not self._closed:
+                    self._commit.wait()
+                if self._committed == self._changes:
+                    return
+            # Let more changes join this commit
+            time.sleep(self.commit_interval)
+            with self._commit:
+                change = self._changes
+                deleted, self._deleted = self._deleted, []
+            try:
+                self._commit_changes(deleted)
+            except Exception as exc:
+                with self._commit:
+                    self._error = exc
+                    self._commit.notify_all()
+                return
+            with self._commit:
+                self._committed = change
+                self._commit.notify_all()
+
+    def _commit_changes(self, deleted):
+        # Take a snapshot of the state to commit
+        with self._lock:
+            topics = list(self.topics.values())
+        snapshot = []
+        unsynced = set()
+        for topic in topics:
+            with topic.condition:
+                # Skip topics dropped since they were listed
+                if not topic.subscriptions:
+                    continue
+                snapshot.append((topic, topic.end,
+                                 dict(topic.subscriptions)))
+                unsynced.update(topic.unsynced)
+                topic.unsynced = set()
+        for segment in unsynced:
+            os.fsync(segment.fd)
+        # New segments and topics must be in their directories as well
+        for directory in set(os.path.dirname(s.path) for s in unsynced):
+            _fsync_directory(directory)
+        self._write_index(snapshot)
+        for topic, end, subscriptions in snapshot:
+            with topic.condition:
+                topic.committed = end
+                # Delete the segments all subscribers have read past in
+                # the index just written
+                first = min([c.segment for c in subscriptions.values()] or
+                            [end.segment])
+                for sequence in list(topic.segments):
+                    if sequence >= min(first, topic.end.segment):
+                        break
+                    topic.segments.pop(sequence).close()
+                    os.unlink(topic.segment_path(sequence))
+                topic.condition.notify_all()
+        for directory, segments in deleted:
+            for segment in segments:
+                segment.close()
+            shutil.rmtree(directory)
+
+    def _write_index(self, snapshot):
+        moved = self._moved(snapshot)
+        if (moved is None or self._journal is not None and
+                self._journal.size > max(self._index_size, _JOURNAL_SIZE)):
+            self._compact(snapshot)
+        elif moved:
+            self._append_journal(moved)
+            self._set_indexed(snapshot)
+
+    def _moved(self, snapshot):
+        # Records of the cursors moved since the last commit, or None if
+        # topics or subscriptions were added or removed
+        if len(snapshot) != len(self._indexed):
+            return None
+        moved = []
+        for topic, end, subscriptions in snapshot:
+            indexed = self._indexed.get(topic.name)
+            if (indexed is None or indexed[0] != topic.directory or
+                    six.viewkeys(subscriptions) != six.viewkeys(indexed[2])):
+                return None
+            name = _pack_name(topic.name)
+            if end != indexed[1]:
+                moved.append(_KIND.pack(_END) + name + _CURSOR.pack(*end))
+            for username, cursor in subscriptions.items():
+                if cursor != indexed[2][username]:
+                    moved.append(_KIND.pack(_SUBSCRIBER) + name +
+                                 _pack_name(username) + _CURSOR.pack(*cursor))
+        return moved
+
+    def _set_indexed(self, snapshot):
+        self._indexed = dict(
+            (topic.name, (topic.directory, end, subscriptions))
+            for topic, end, subscriptions in snapshot)
+
+    def _append_journal(self, moved):
+        created = self._journal is None
+        if created:
+            self._journal = _Segment(os.path.join(self.path, _JOURNAL))
+            self._journal.truncate(0)
+            self._journal.append(_JOURNAL_HEADER.pack(_JOURNAL_MAGIC,
+                                                      self._generation))
+        data = b''.join(moved)
+        self._journal.append(
+            _BATCH.pack(len(data), zlib.crc32(data) & 0xffffffff) + data)
+        os.fsync(self._journal.fd)
+        if created:
+            _fsync_directory(self.path)
+
+    def _compact(self, snapshot):
+        # Write the whole index, in a new generation that the journal of
+        # the previous one does not apply to, and drop the journal
+        generation = self._generation + 1
+        data = [_INDEX_HEADER.pack(_MAGIC, _VERSION, generation,
+                                   len(snapshot))]
+        for topic, end, subscriptions in snapshot:
+            data.append(_pack_name(topic.name))
+            data.append(_pack_name(os.path.basename(topic.directory)))
+            data.append(_CURSOR.pack(*end))
+            data.append(_COUNT.pack(len(subscriptions)))
+            for username, cursor in subscriptions.items():
+                data.append(_pack_name(username))
+                data.append(_CURSOR.pack(*cursor))
+        data = b''.join(data)
+        path = os.path.join(self.path, _INDEX)
+        with open(path + '.tmp', 'wb') as index:
+            index.write(data)
+            index.flush()
+            os.fsync(index.fileno())
+        os.rename(path + '.tmp', path)
+        _fsync_directory(self.path)
+        self._generation = generation
+        self._index_size = len(data)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        try:
+            os.unlink(os.path.join(self.path, _JOURNAL))
+        except OSError as ose:
+            if ose.errno != errno.ENOENT:
+                raise
+        self._set_indexed(snapshot)
+
+    def _get_topic(self, topic, username):
+        state = self.topics.get(topic)
+        if state is None:
+            raise eowyn_exc.SubscriptionNotFoundException(
+                topic=topic, username=username)
+        return state
+
+    def create_subscription(self, topic, username):
+        super(FileManager, self).create_subscription(topic, username)
+        self._check_open()
+        with self._lock:
+            state = self.topics.get(topic)
+            if state is None:
+                directory = os.path.join(self.path, uuid.uuid4().hex)
+                os.mkdir(directory)
+                state = self.topics[topic] = _Topic(topic, directory)
+                state.unsynced.add(state.add_segment(0))
+            with state.condition:
+                if username in state.subscriptions:
+                    raise eowyn_exc.SubscriptionAlreadyExistsException(
+                        topic=topic, username=username)
+                # New subscribers start after the last message
+                state.subscriptions[username] = state.end
+        self._wait_committed(self._changed())
+        return topic
+
+    def delete_subscription(self, topic, username):
+        super(FileManager, self).delete_subscription(topic, username)
+        self._check_open()
+        with self._lock:
+            state = self._get_topic(topic, username)
+            with state.condition:
+                if username not in state.subscriptions:
+                    raise eowyn_exc.SubscriptionNotFoundException(
+                        topic=topic, username=username)
+                del state.subscriptions[username]
+                state.condition.notify_all()
+                # If the subscription was the last one, drop the topic
+                if not state.subscriptions:
+                    del self.topics[topic]
+                    with self._commit:
+                        self._deleted.append(
+                            (state.directory, list(state.segments.values())))
+        self._wait_committed(self._changed())
+        return topic
+
+    def _publish(self, topic, data, count):
+        self._check_open()
+        state = self.topics.get(topic)
+        if state is None:
+            raise eowyn_exc.TopicNotFoundException(topic=topic)
+        with state.condition:
+            # The topic may have been dropped since it was looked up
+            if not state.subscriptions:
+                raise eowyn_exc.TopicNotFoundException(topic=topic)
+            end = state.end
+            segment = state.segments[end.segment]
+            if segment.size and segment.size + len(data) > self.segment_size:
+                segment = state.add_segment(end.sequence)
+                end = _Cursor(end.sequence, end.sequence, 0)
+            segment.append(data)
+            state.unsynced.add(segment)
+            state.end = _Cursor(end.sequence + count, end.segment,
+                                end.position + len(data))
+        self._wait_committed(self._changed())
+
+    def publish_message(self, topic, message):
+        super(FileManager, self).publish_message(topic, message)
+        self._publish(topic, records.encode(message), 1)
+
+    def publish_messages(self, topic, messages):
+        super(FileManager, self).publish_messages(topic, messages)
+        self._publish(topic, b''.join(records.encode(m) for m in messages),
+                      len(messages))
+
+    def _pop_now(self, state, topic, username, max_count):
+        # Must be called with the condition of the topic held. Returns the
+        # messages and the cursor after them, which the caller moves to.
+        cursor = state.subscriptions.get(username)
+        if cursor is None:
+            raise eowyn_exc.SubscriptionNotFoundException(
+                topic=topic, username=username)
+        messages = []
+        while (len(messages) < max_count and
+               cursor.sequence < state.committed.sequence):
+            segment = state.segments[cursor.segment]
+            if cursor.position >= segment.size:
+                # The next segment starts with the next message
+                cursor = _Cursor(cursor.sequence, cursor.sequence, 0)
+                continue
+            message, position = segment.read(cursor.position)
+            messages.append(message)
+            cursor = _Cursor(cursor.sequence + 1, cursor.segment, position)
+        if not messages:
+            raise eowyn_exc.NoMessageFoundException(
+                topic=topic, username=username)
+        return messages, cursor
+
+    def _pop(self, topic, username, max_count, wait):
+        state = self._get_topic(topic, username)
+        deadline = time.time() + wait
+        with state.condition:
+            while True:
+                # Segments are closed along with the manager
+                self._check_open()
+                try:
+                    messages, cursor = self._pop_now(state, topic, username,
+                                                     max_count)
+                    break
+                except eowyn_exc.NoMessageFoundException:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise
+                    state.condition.wait(remaining)
+            # The new cursor is committed with the next group. The cursor
+            # only moves once the change is recorded, so that messages are
+            # not lost if the manager was closed, or a commit failed.
+            self._changed()
+            state.subscriptions[username] = cursor
+        return messages
+
+    def pop_message(self, topic, username, wait=0):
+        super(FileManager, self).pop_message(topic, username, wait)
+        return self._pop(topic, username, 1, wait)[0]
+
+    def pop_messages(self, topic, username, max_count, wait=0):
+        super(FileManager, self).pop_messages(topic, username, max_count,
+                                              wait)
+        return self._pop(topic, username, max_count, wait)
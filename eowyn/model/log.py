@@ -0,0 +1,109 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+
+
+class SegmentedLog(object):
+    """Append-only in-memory log of messages
+
+    Messages are addressed by their offset in the log, and stored in
+    fixed size segments. Readers are tracked by the offset of the next
+    message they will read. A segment is freed as soon as all readers
+    have moved past it, so the log only holds unread messages, plus at
+    most one partially read segment.
+    """
+
+    def __init__(self, segment_size=1024):
+        self.segment_size = segment_size
+        # Segments by index. The segment at index i holds the messages
+        # from offset i * segment_size onwards.
+        self._segments = {0: []}
+        self._first = 0
+        self._last = 0
+        # Number of readers by segment index
+        self._readers = collections.Counter()
+        self.end = 0
+
+    @property
+    def start(self):
+        # Offset of the oldest message still held in the log
+        return self._first * self.segment_size
+
+    def append(self, message):
+        tail = self._segments[self._last]
+        if len(tail) == self.segment_size:
+            self._last += 1
+            tail = self._segments[self._last] = []
+        tail.append(message)
+        self.end += 1
+
+    def extend(self, messages):
+        # Fill the tail segment, and then as many new segments as needed,
+        # with one slice each
+        position = 0
+        while position < len(messages):
+            tail = self._segments[self._last]
+            if len(tail) == self.segment_size:
+                self._last += 1
+                tail = self._segments[self._last] = []
+            chunk = messages[position:
+                             position + self.segment_size - len(tail)]
+            tail.extend(chunk)
+            position += len(chunk)
+        self.end += len(messages)
+
+    def read(self, offset, count=1):
+        """Read up to count messages, starting from offset
+
+        :param offset: offset of the first message to read
+        :param count: maximum number of messages to read
+        :returns: a list of messages, empty if offset is at the end
+        """
+        messages = []
+        end = min(offset + count, self.end)
+        while offset < end:
+            index, position = divmod(offset, self.segment_size)
+            chunk = self._segments[index][position:position + end - offset]
+            messages.extend(chunk)
+            offset += len(chunk)
+        return messages
+
+    def add_reader(self):
+        """Register a reader at the end of the log
+
+        :returns: the offset of the reader
+        """
+        self._readers[self.end // self.segment_size] += 1
+        return self.end
+
+    def move_reader(self, offset, new_offset):
+        old_index = offset // self.segment_size
+        new_index = new_offset // self.segment_size
+        if old_index != new_index:
+            self._readers[new_index] += 1
+            self._release(old_index)
+
+    def remove_reader(self, offset):
+        self._release(offset // self.segment_size)
+
+    def _release(self, index):
+        self._readers[index] -= 1
+        if self._readers[index] == 0:
+            del self._readers[index]
+        # Free the leading segments no reader is left on. The tail segment
+        # is kept, as it's the one messages are appended to.
+        while self._first < self._last and self._first not in self._readers:
+            del self._segments[self._first]
+            self._first += 1
@@ -14,32 +14,198 @@
 
 import abc
 import collections
-import exceptions
+import functools
+import heapq
 import six
+import threading
+import time
 
 from eowyn import exceptions as eowyn_exc
+from eowyn import metrics
+from eowyn.model import log
+from eowyn.model import retention
+from eowyn.model import topics
 
+# Prefix of the routes of the APIs which are not about a topic, e.g.
+# /_user/username. Topics starting with it cannot be subscribed to.
+RESERVED_PREFIX = '_'
 
-@six.add_metaclass(abc.ABCMeta)
-class Manager(object):
+
+class Validator(object):
+    """Data validation rules for the API of managers"""
+
+    # Whether users may subscribe to patterns of topics
+    supports_patterns = False
+
+    def validate_topic(self, topic):
+        if topic is None:
+            raise eowyn_exc.InvalidDataException(key='topic', value='None')
+
+    def validate_pattern(self, topic):
+        # Topics subscribed to may be patterns, if supported
+        if topic.startswith(RESERVED_PREFIX):
+            raise eowyn_exc.InvalidDataException(key='topic', value=topic)
+        if self.supports_patterns:
+            topics.validate_pattern(topic)
+        elif topics.is_pattern(topic):
+            raise eowyn_exc.InvalidDataException(key='topic', value=topic)
+
+    def validate_published_topic(self, topic):
+        # Messages are published to topics, never to patterns
+        if topics.is_pattern(topic):
+            raise eowyn_exc.InvalidDataException(key='topic', value=topic)
+
+    def validate_username(self, username):
+        if username is None:
+            raise eowyn_exc.InvalidDataException(key='username', value='None')
+
+    def validate_message(self, message):
+        if message is None:
+            raise eowyn_exc.InvalidDataException(key='message', value='None')
+
+    def validate_messages(self, messages):
+        if not messages:
+            raise eowyn_exc.InvalidDataException(key='messages',
+                                                 value=messages)
+        for message in messages:
+            self.validate_message(message)
+
+    def validate_topics(self, topics):
+        if not topics:
+            raise eowyn_exc.InvalidDataException(key='topics', value=topics)
+        for topic in topics:
+            self.validate_topic(topic)
+            self.validate_pattern(topic)
+
+    def validate_max_count(self, max_count):
+        if not isinstance(max_count, six.integer_types) or max_count < 1:
+            raise eowyn_exc.InvalidDataException(key='max_count',
+                                                 value=max_count)
+
+    def validate_position(self, position):
+        if not isinstance(position, six.integer_types) or position < 0:
+            raise eowyn_exc.InvalidDataException(key='position',
+                                                 value=position)
+
+    def validate_wait(self, wait):
+        if not isinstance(wait, six.integer_types) or wait < 0:
+            raise eowyn_exc.InvalidDataException(key='wait', value=wait)
+
+    def validate_visibility(self, visibility):
+        if not isinstance(visibility, six.integer_types) or visibility < 1:
+            raise eowyn_exc.InvalidDataException(key='visibility',
+                                                 value=visibility)
+
+    def validate_leases(self, leases):
+        if not leases:
+            raise eowyn_exc.InvalidDataException(key='leases', value=leases)
+        for lease in leases:
+            if not isinstance(lease, six.string_types):
+                raise eowyn_exc.InvalidDataException(key='lease',
+                                                     value=lease)
+
+
+# Operations of the API of managers which are measured
+INSTRUMENTED = ('create_subscription', 'delete_subscription',
+                'create_subscriptions', 'delete_subscriptions',
+                'publish_message', 'publish_messages', 'pop_message',
+                'pop_messages', 'pop_messages_with_position',
+                'pop_user_messages', 'lease_messages', 'ack_messages')
+
+# Whether a thread is in a measured call
+_calls = threading.local()
+
+
+def _count(operation, args, kwargs, result):
+    # Count the messages published or delivered by a call
+    if operation == 'publish_message':
+        metrics.PUBLISHED.inc()
+    elif operation == 'publish_messages':
+        messages = kwargs['messages'] if 'messages' in kwargs else args[1]
+        metrics.PUBLISHED.inc(amount=len(messages))
+    elif operation == 'pop_message':
+        metrics.DELIVERED.inc()
+    elif operation in ('pop_messages', 'pop_user_messages',
+                       'lease_messages'):
+        metrics.DELIVERED.inc(amount=len(result or ()))
+    elif operation == 'pop_messages_with_position' and result is not None:
+        metrics.DELIVERED.inc(amount=len(result[0]))
+
+
+def _instrument(operation, method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        # Only the outermost call is measured, not the ones to overridden
+        # methods, nor to the managers it delegates to
+        if getattr(_calls, 'active', False):
+            return method(self, *args, **kwargs)
+        _calls.active = True
+        outcome = 'ok'
+        start = time.time()
+        try:
+            result = method(self, *args, **kwargs)
+        except Exception as exc:
+            outcome = type(exc).__name__
+            raise
+        finally:
+            _calls.active = False
+            metrics.MANAGER_CALLS.observe(time.time() - start,
+                                          type(self).__name__, operation,
+                                          outcome)
+        _count(operation, args, kwargs, result)
+        return result
+    return wrapper
+
+
+class InstrumentedMeta(abc.ABCMeta):
+    """Metaclass of managers, measuring the calls to their API
+
+    Calls are timed by manager, operation and outcome, i.e. 'ok' or the
+    name of the exception raised, and published and delivered messages
+    are counted.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        for operation in INSTRUMENTED:
+            if operation in namespace:
+                namespace[operation] = _instrument(operation,
+                                                   namespace[operation])
+        return super(InstrumentedMeta, mcs).__new__(mcs, name, bases,
+                                                    namespace)
+
+
+@six.add_metaclass(InstrumentedMeta)
+class Manager(Validator):
     """Manager of subscription and messages
 
     Defines the API to manage subscriptions and messages.
     Defines data validation rules, which may be overwritten by specific
     manager implementations.
+
+    Calls to the API are measured, see InstrumentedMeta.
     """
 
+    # Whether managers in different processes share subscriptions and
+    # messages, so that the API may be served by several workers
+    shared = False
+
     @abc.abstractmethod
     def create_subscription(self, topic, username):
         """Subscribe a user to a topic
 
-        :param topic: topic to subscribe to
+        Managers which support patterns also subscribe users to patterns
+        of topics, see eowyn.model.topics. Messages published to any
+        topic matching the pattern are then queued for the subscriber,
+        who pops them using the pattern as the topic.
+
+        :param topic: topic or pattern to subscribe to
         :param username: username subscribing to the topic
         :returns: the topic for which a subscription was created
         :raises: eowyn_exc.SubscriptionAlreadyExistsException
         :raises: eowyn_exc.InvalidDataException
         """
         self.validate_topic(topic)
+        self.validate_pattern(topic)
         self.validate_username(username)
 
     @abc.abstractmethod
@@ -63,17 +229,37 @@ class Manager(object):
         :param message: message to publish to the topic
         :returns: the published message
         :raises: eowyn_exc.TopicNotFoundException
+        :raises: eowyn_exc.QueueFullException
         :raises: eowyn_exc.InvalidDataException
         """
         self.validate_topic(topic)
+        self.validate_published_topic(topic)
         self.validate_message(message)
 
     @abc.abstractmethod
-    def pop_message(self, topic, username):
+    def publish_messages(self, topic, messages):
+        """Publish a batch of messages to the subscribers of the topic
+
+        Messages are delivered in the order they are in the batch.
+
+        :param topic: topic to publish to
+        :param messages: list of messages to publish to the topic
+        :returns: the published messages
+        :raises: eowyn_exc.TopicNotFoundException
+        :raises: eowyn_exc.QueueFullException
+        :raises: eowyn_exc.InvalidDataException
+        """
+        self.validate_topic(topic)
+        self.validate_published_topic(topic)
+        self.validate_messages(messages)
+
+    @abc.abstractmethod
+    def pop_message(self, topic, username, wait=0):
         """Pops the next message from a topic for the specific subscriber
 
         :param topic: topic to inspect
         :param username: get the next message on the topic for username
+        :param wait: seconds to wait for a message if there is none yet
         :returns: the message
         :raises: eowyn_exc.SubscriptionNotFoundException
         :raises: eowyn_exc.NoMessageFoundException
@@ -81,18 +267,269 @@ class Manager(object):
         """
         self.validate_topic(topic)
         self.validate_username(username)
+        self.validate_wait(wait)
 
-    def validate_topic(self, topic):
-        if topic is None:
-            raise eowyn_exc.InvalidDataException(key='topic', value='None')
+    @abc.abstractmethod
+    def pop_messages(self, topic, username, max_count, wait=0):
+        """Pops up to max_count messages from a topic for the subscriber
 
-    def validate_username(self, username):
-        if username is None:
-            raise eowyn_exc.InvalidDataException(key='username', value='None')
+        :param topic: topic to inspect
+        :param username: get the next messages on the topic for username
+        :param max_count: maximum number of messages to pop
+        :param wait: seconds to wait for a message if there is none yet
+        :returns: the list of messages, oldest first
+        :raises: eowyn_exc.SubscriptionNotFoundException
+        :raises: eowyn_exc.NoMessageFoundException
+        :raises: eowyn_exc.InvalidDataException
+        """
+        self.validate_topic(topic)
+        self.validate_username(username)
+        self.validate_max_count(max_count)
+        self.validate_wait(wait)
 
-    def validate_message(self, message):
-        if message is None:
-            raise eowyn_exc.InvalidDataException(key='message', value='None')
+    def pop_messages_with_position(self, topic, username, max_count,
+                                   wait=0):
+        """Pops messages, along with the position of the subscriber
+
+        Same as pop_messages, for managers which track positions. The
+        position is taken along with the messages, so that it is the one
+        of the last message popped even if other calls pop concurrently.
+
+        :param topic: topic to get messages from
+        :param username: username subscribed to the topic
+        :param max_count: maximum number of messages to pop
+        :param wait: seconds to wait for a message if there is none yet
+        :returns: the list of messages, oldest first, and the position,
+            see get_position, or None if not supported by the manager
+        :raises: eowyn_exc.SubscriptionNotFoundException
+        :raises: eowyn_exc.NoMessageFoundException
+        :raises: eowyn_exc.InvalidDataException
+        """
+        self.validate_topic(topic)
+        self.validate_username(username)
+        self.validate_max_count(max_count)
+        self.validate_wait(wait)
+
+    def pop_user_messages(self, username, max_count, wait=0):
+        """Pops up to max_count messages from all the topics of a user
+
+        Managers which support it keep track of the topics with messages
+        for each user, so that topics without messages are not looked at.
+
+        :param username: username subscribed to the topics
+        :param max_count: maximum number of messages to pop
+        :param wait: seconds to wait for a message if there is none yet
+        :returns: the list of (topic, message), oldest first for each
+            topic, or None if not supported by the manager
+        :raises: eowyn_exc.NoMessageFoundException
+        :raises: eowyn_exc.InvalidDataException
+        """
+        self.validate_username(username)
+        self.validate_max_count(max_count)
+        self.validate_wait(wait)
+
+    def get_position(self, topic, username):
+        """Position of a subscriber in the topic, if the manager tracks it
+
+        The position identifies the last message popped by the subscriber.
+        Positions of consecutive messages are consecutive integers.
+
+        :param topic: topic to inspect
+        :param username: username subscribed to the topic
+        :returns: the position, or None if not supported by the manager
+        :raises: eowyn_exc.SubscriptionNotFoundException
+        :raises: eowyn_exc.InvalidDataException
+        """
+        self.validate_topic(topic)
+        self.validate_username(username)
+
+    def rewind(self, topic, username, position):
+        """Move a subscriber back to a previous position in the topic
+
+        Messages popped after the position are delivered again, as long
+        as the manager still holds them.
+
+        :param topic: topic to rewind
+        :param username: username subscribed to the topic
+        :param position: position returned by get_position
+        :returns: True if the subscriber was moved, False otherwise
+        :raises: eowyn_exc.SubscriptionNotFoundException
+        :raises: eowyn_exc.InvalidDataException
+        """
+        self.validate_topic(topic)
+        self.validate_username(username)
+        self.validate_position(position)
+        return False
+
+    def get_dropped(self, topic, username):
+        """Number of messages dropped from the queue of a subscriber
+
+        Messages are dropped by the retention policy of the topic, when
+        the subscriber lags behind.
+
+        :param topic: topic to inspect
+        :param username: username subscribed to the topic
+        :returns: the number of messages, or None if not supported by the
+            manager
+        :raises: eowyn_exc.SubscriptionNotFoundException
+        :raises: eowyn_exc.InvalidDataException
+        """
+        self.validate_topic(topic)
+        self.validate_username(username)
+
+    def lease_messages(self, topic, username, max_count, visibility,
+                       wait=0):
+        """Lease up to max_count messages to a consumer of the subscriber
+
+        Many consumers may share a subscription, by leasing its messages
+        rather than popping them. Each message is leased to one consumer,
+        until it's acknowledged or its lease expires, after visibility
+        seconds. Messages of expired leases are leased again, under new
+        leases, before newer messages.
+
+        :param topic: topic to inspect
+        :param username: username subscribed to the topic
+        :param max_count: maximum number of messages to lease
+        :param visibility: seconds after which the leases expire
+        :param wait: seconds to wait for a message if there is none yet
+        :returns: the list of (lease, message), or None if not supported
+            by the manager
+        :raises: eowyn_exc.SubscriptionNotFoundException
+        :raises: eowyn_exc.NoMessageFoundException
+        :raises: eowyn_exc.InvalidDataException
+        """
+        self.validate_topic(topic)
+        self.validate_username(username)
+        self.validate_max_count(max_count)
+        self.validate_visibility(visibility)
+        self.validate_wait(wait)
+
+    def ack_messages(self, topic, username, leases):
+        """Acknowledge leased messages, which are not delivered again
+
+        :param topic: topic of the leases
+        :param username: username subscribed to the topic
+        :param leases: leases returned by lease_messages
+        :returns: the number of messages acknowledged, which excludes the
+            messages leased again since, or None if not supported by the
+            manager
+        :raises: eowyn_exc.SubscriptionNotFoundException
+        :raises: eowyn_exc.InvalidDataException
+        """
+        self.validate_topic(topic)
+        self.validate_username(username)
+        self.validate_leases(leases)
+
+    def create_subscriptions(self, username, topics):
+        """Subscribe a user to many topics at once
+
+        Topics the user is already subscribed to are skipped.
+
+        :param username: username subscribing to the topics
+        :param topics: list of topics or patterns to subscribe to
+        :returns: the list of topics for which a subscription was created,
+            or None if not supported by the manager
+        :raises: eowyn_exc.InvalidDataException
+        """
+        self.validate_username(username)
+        self.validate_topics(topics)
+
+    def get_topics(self, username):
+        """Topics a user is subscribed to
+
+        Managers which support it keep an index of the topics of each
+        user, so that listing them does not scan all topics.
+
+        :param username: username to inspect
+        :returns: the sorted list of topics, or None if not supported by
+            the manager
+        :raises: eowyn_exc.InvalidDataException
+        """
+        self.validate_username(username)
+
+    def delete_subscriptions(self, username):
+        """Unsubscribe a user from all the topics subscribed to
+
+        :param username: username un-subscribing
+        :returns: the list of topics for which a subscription was deleted,
+            or None if not supported by the manager
+        :raises: eowyn_exc.InvalidDataException
+        """
+        self.validate_username(username)
+
+    def get_queue_depths(self, limit):
+        """Number of messages queued for subscribers, for some topics
+
+        :param limit: maximum number of topics to inspect
+        :returns: the number of messages by username, by topic, or None
+            if not supported by the manager
+        """
+
+    def migrate(self):
+        """Move the data stored by previous versions to the current layout
+
+        Meant to be run once on upgrade, with the processes of previous
+        versions stopped. Running it again does nothing.
+
+        :returns: the number of queues moved, or None if not supported by
+            the manager
+        """
+
+
+class _Topic(object):
+    """Subscriptions and log of messages of a topic
+
+    Access to a topic is serialized by its condition, so operations on
+    different topics never contend.
+    """
+
+    def __init__(self):
+        # Offset in the log of the next message, by username
+        self.subscriptions = {}
+        self.log = log.SegmentedLog()
+        self.condition = threading.Condition()
+        # Messages dropped by retention, by username
+        self.dropped = collections.Counter()
+        # Offset and time of each publish, when messages expire
+        self.times = collections.deque()
+        # Leased messages, by username
+        self.leases = {}
+
+
+class _Leases(object):
+    """Messages of a subscriber leased to its consumers
+
+    Leases are checked for expiry when messages are leased, so acknowledged
+    leases stay in the heap of deadlines until then.
+    """
+
+    def __init__(self):
+        self.count = 0
+        # Message of each lease
+        self.messages = {}
+        # Heap of (deadline, lease)
+        self.deadlines = []
+        # Messages of expired leases, to be leased again
+        self.expired = collections.deque()
+
+    def expire(self, now):
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, lease = heapq.heappop(self.deadlines)
+            if lease in self.messages:
+                self.expired.append(self.messages.pop(lease))
+
+    def next_deadline(self):
+        return self.deadlines[0][0] if self.deadlines else None
+
+    def add(self, message, deadline):
+        self.count += 1
+        lease = str(self.count)
+        self.messages[lease] = message
+        heapq.heappush(self.deadlines, (deadline, lease))
+        return lease
+
+    def ack(self, lease):
+        return self.messages.pop(lease, None) is not None
 
 
 class SimpleManager(Manager):
@@ -100,51 +537,434 @@ class SimpleManager(Manager):
 
     Subscriptions and messages are held in memory, as part of the manager
     itself. Subscriptions and messages are lost upon service restart.
+
+    Each topic has a single log of messages, shared by all its
+    subscribers. A subscription is the offset in the log of the next
+    message for the subscriber, so publishing a message costs the same
+    regardless of the number of subscribers.
+
+    The manager is thread safe. Publishing and popping messages only lock
+    the topic, while creating and deleting subscriptions also lock the
+    set of topics, as they may add or drop a topic. Subscribers waiting
+    for messages wait on the condition of the topic, which is notified
+    when messages are published.
+
+    Retention policies are enforced when publishing, by moving the
+    subscribers that lag behind forward in the log, which then frees the
+    segments no subscriber needs anymore. This costs one step per
+    subscriber of the topic, only when the topic has a policy.
+
+    Leased messages move out of the log, to the leases of the subscriber,
+    until they are acknowledged. Leasing and acknowledging cost O(log n)
+    in the number of leases of the subscriber.
+
+    Subscriptions to a pattern are held as a topic named after the
+    pattern, which is indexed by a trie. Messages are published to the
+    topic, and to each pattern the trie matches it with, under the
+    retention policy of the topic.
+
+    The topics of each user are indexed along with the subscriptions, so
+    bulk operations on the subscriptions of a user cost O(k) in the
+    number of its topics.
+
+    Publishing also marks the topic as ready for each of its subscribers,
+    one step per subscriber, so that users popping from all their topics
+    only look at the topics with messages. Users waiting for messages on
+    any of their topics wait on a condition shared by all topics.
     """
 
-    def __init__(self):
-        self.subscriptions = {}
+    supports_patterns = True
+
+    def __init__(self, max_length=0, max_age=0,
+                 overflow=retention.DROP_OLDEST, topic_retention=''):
+        self.retention = retention.Retention(max_length, max_age, overflow,
+                                             topic_retention)
+        self.topics = {}
+        # Patterns with subscribers, updated along with topics
+        self.patterns = topics.TopicTrie()
+        # Topics by username, updated along with subscriptions
+        self.users = {}
+        # Topics which may have messages, by username. Guarded by its own
+        # lock, always acquired after the condition of a topic.
+        self.ready = {}
+        self._ready = threading.Lock()
+        # Conditions of the users waiting for messages from any of their
+        # topics, on the lock of ready topics, with the number of waiters.
+        # Only the users of a topic are woken up when it gets ready.
+        self._waiting = {}
+        self._waiters = collections.Counter()
+        # Guards adding and dropping topics. It's always acquired before
+        # the condition of a topic.
+        self._lock = threading.Lock()
+
+    def _get_topic(self, topic, username):
+        state = self.topics.get(topic)
+        if state is None:
+            raise eowyn_exc.SubscriptionNotFoundException(
+                topic=topic, username=username)
+        return state
+
+    def _get_offset(self, state, topic, username):
+        # Must be called with the condition of the topic held
+        try:
+            return state.subscriptions[username]
+        except KeyError:
+            raise eowyn_exc.SubscriptionNotFoundException(
+                topic=topic, username=username)
 
     def create_subscription(self, topic, username):
         super(SimpleManager, self).create_subscription(topic, username)
-        if self.subscriptions.get(topic, None) is None:
-            self.subscriptions[topic] = {}
-        elif username in self.subscriptions[topic]:
-            raise eowyn_exc.SubscriptionAlreadyExistsException(
-                topic=topic, username=username)
-        _message_queue = collections.deque()
-        self.subscriptions[topic][username] = _message_queue
+        with self._lock:
+            state = self.topics.get(topic)
+            if state is None:
+                state = self.topics[topic] = _Topic()
+                if topics.is_pattern(topic):
+                    self.patterns.add(topic)
+            with state.condition:
+                if username in state.subscriptions:
+                    raise eowyn_exc.SubscriptionAlreadyExistsException(
+                        topic=topic, username=username)
+                state.subscriptions[username] = state.log.add_reader()
+            self.users.setdefault(username, set()).add(topic)
         return topic
 
     def delete_subscription(self, topic, username):
         super(SimpleManager, self).delete_subscription(topic, username)
-        if (self.subscriptions.get(topic, None) is None or username not in
-                self.subscriptions[topic]):
-            raise eowyn_exc.SubscriptionNotFoundException(
-                topic=topic, username=username)
-        del self.subscriptions[topic][username]
-        # If the subscription was the last one, drop the topic
-        if not self.subscriptions[topic]:
-            del self.subscriptions[topic]
+        with self._lock:
+            state = self._get_topic(topic, username)
+            with state.condition:
+                offset = self._get_offset(state, topic, username)
+                del state.subscriptions[username]
+                del state.dropped[username]
+                state.leases.pop(username, None)
+                state.log.remove_reader(offset)
+                self._unready(username, topic)
+                # Let subscribers waiting on this subscription know it's
+                # gone
+                state.condition.notify_all()
+                # If the subscription was the last one, drop the topic
+                if not state.subscriptions:
+                    del self.topics[topic]
+                    self.patterns.remove(topic)
+            user_topics = self.users[username]
+            user_topics.discard(topic)
+            if not user_topics:
+                del self.users[username]
         return topic
 
+    def _unready(self, username, topic):
+        # Must be called with the condition of the topic held
+        with self._ready:
+            ready = self.ready.get(username)
+            if ready is not None:
+                ready.discard(topic)
+                if not ready:
+                    del self.ready[username]
+
+    def _mark_ready(self, username, topic):
+        # Must be called with the ready lock held. Users only wait when
+        # none of their topics is ready.
+        ready = self.ready.setdefault(username, set())
+        if not ready and username in self._waiting:
+            self._waiting[username].notify_all()
+        ready.add(topic)
+
+    def _wait_ready(self, username, timeout):
+        # Must be called with the ready lock held
+        condition = self._waiting.get(username)
+        if condition is None:
+            condition = threading.Condition(self._ready)
+            self._waiting[username] = condition
+        self._waiters[username] += 1
+        try:
+            condition.wait(timeout)
+        finally:
+            self._waiters[username] -= 1
+            if not self._waiters[username]:
+                del self._waiters[username]
+                del self._waiting[username]
+
+    def create_subscriptions(self, username, topics):
+        super(SimpleManager, self).create_subscriptions(username, topics)
+        created = []
+        for topic in topics:
+            try:
+                created.append(self.create_subscription(topic, username))
+            except eowyn_exc.SubscriptionAlreadyExistsException:
+                pass
+        return created
+
+    def get_topics(self, username):
+        super(SimpleManager, self).get_topics(username)
+        with self._lock:
+            return sorted(self.users.get(username, ()))
+
+    def delete_subscriptions(self, username):
+        super(SimpleManager, self).delete_subscriptions(username)
+        deleted = []
+        for topic in self.get_topics(username):
+            # Subscriptions may be deleted concurrently
+            try:
+                deleted.append(self.delete_subscription(topic, username))
+            except eowyn_exc.SubscriptionNotFoundException:
+                pass
+        return deleted
+
+    def _drop(self, state, username, offset):
+        # Must be called with the condition of the topic held. Moves a
+        # subscriber forward to offset, dropping the messages skipped.
+        current = state.subscriptions[username]
+        if offset > current:
+            state.log.move_reader(current, offset)
+            state.subscriptions[username] = offset
+            state.dropped[username] += offset - current
+            metrics.DROPPED.inc(amount=offset - current)
+
+    def _expire(self, state, max_age):
+        # Must be called with the condition of the topic held
+        cutoff = time.time() - max_age
+        while state.times and state.times[0][1] < cutoff:
+            state.times.popleft()
+        # Entries for messages no subscriber needs anymore are not useful
+        while len(state.times) > 1 and state.times[1][0] <= state.log.start:
+            state.times.popleft()
+        oldest = state.times[0][0] if state.times else state.log.end
+        for username in list(state.subscriptions):
+            self._drop(state, username, oldest)
+
+    def _publish(self, topic, publish, count):
+        # Publish to the topic and to the patterns matching it, under the
+        # retention policy of the topic. Either all the queues get the
+        # messages, or none does. Conditions are acquired in the order of
+        # names, so that publishers never deadlock.
+        targets = [(name, self.topics.get(name)) for name in
+                   sorted(set([topic] + self.patterns.match(topic)))]
+        targets = [(name, state) for name, state in targets
+                   if state is not None]
+        for _, state in targets:
+            state.condition.acquire()
+        try:
+            self._publish_locked(targets, topic, publish, count)
+        finally:
+            for _, state in targets:
+                state.condition.release()
+
+    def _publish_locked(self, targets, topic, publish, count):
+        # Must be called with the conditions of the topics held. Topics
+        # may have been dropped since they were looked up.
+        targets = [(name, state) for name, state in targets
+                   if state.subscriptions]
+        if not targets:
+            raise eowyn_exc.TopicNotFoundException(topic=topic)
+        states = [state for _, state in targets]
+        policy = self.retention.get(topic)
+        if policy.max_age:
+            for state in states:
+                self._expire(state, policy.max_age)
+        reject = policy.overflow == retention.REJECT
+        if policy.max_length and reject:
+            # The messages are dropped for all the full queues
+            full = [(state, username) for state in states
+                    for username, offset in state.subscriptions.items()
+                    if state.log.end + count - offset > policy.max_length]
+            for state, username in full:
+                state.dropped[username] += count
+            metrics.DROPPED.inc(amount=count * len(full))
+            if full:
+                raise eowyn_exc.QueueFullException(topic=topic,
+                                                   username=full[0][1])
+        for state in states:
+            publish(state.log)
+            if policy.max_age:
+                state.times.append((state.log.end - count, time.time()))
+            if policy.max_length and not reject:
+                for username in list(state.subscriptions):
+                    self._drop(state, username,
+                               state.log.end - policy.max_length)
+            state.condition.notify_all()
+        with self._ready:
+            for name, state in targets:
+                for username in state.subscriptions:
+                    self._mark_ready(username, name)
+
     def publish_message(self, topic, message):
         super(SimpleManager, self).publish_message(topic, message)
-        if topic in self.subscriptions.keys():
-            for username in self.subscriptions[topic].keys():
-                self.subscriptions[topic][username].appendleft(message)
-        else:
-            raise eowyn_exc.TopicNotFoundException(topic=topic)
+        self._publish(topic, lambda topic_log: topic_log.append(message), 1)
 
-    def pop_message(self, topic, username):
-        super(SimpleManager, self).pop_message(topic, username)
-        if (topic in self.subscriptions.keys() and username in
-                self.subscriptions[topic].keys()):
-            try:
-                return self.subscriptions[topic][username].pop()
-            except exceptions.IndexError:
-                raise eowyn_exc.NoMessageFoundException(
-                    topic=topic, username=username)
-        else:
-            raise eowyn_exc.SubscriptionNotFoundException(
+    def publish_messages(self, topic, messages):
+        super(SimpleManager, self).publish_messages(topic, messages)
+        self._publish(topic, lambda topic_log: topic_log.extend(messages),
+                      len(messages))
+
+    def _pop_now(self, state, topic, username, max_count):
+        # Must be called with the condition of the topic held
+        offset = self._get_offset(state, topic, username)
+        messages = state.log.read(offset, max_count)
+        if not messages:
+            raise eowyn_exc.NoMessageFoundException(
+                topic=topic, username=username)
+        state.log.move_reader(offset, offset + len(messages))
+        state.subscriptions[username] = offset + len(messages)
+        return messages
+
+    def _pop(self, topic, username, max_count, wait):
+        # Returns the messages and the position of the subscriber
+        state = self._get_topic(topic, username)
+        deadline = time.time() + wait
+        with state.condition:
+            while True:
+                try:
+                    messages = self._pop_now(state, topic, username,
+                                             max_count)
+                    return messages, state.subscriptions[username]
+                except eowyn_exc.NoMessageFoundException:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise
+                    state.condition.wait(remaining)
+
+    def pop_message(self, topic, username, wait=0):
+        super(SimpleManager, self).pop_message(topic, username, wait)
+        return self._pop(topic, username, 1, wait)[0][0]
+
+    def _pop_user_now(self, username, max_count):
+        with self._ready:
+            ready = sorted(self.ready.get(username, ()))
+        popped = []
+        for topic in ready:
+            if len(popped) == max_count:
+                break
+            # Topics are dropped along with their readiness
+            state = self.topics.get(topic)
+            if state is None:
+                continue
+            with state.condition:
+                try:
+                    popped.extend(
+                        (topic, message) for message in self._pop_now(
+                            state, topic, username, max_count - len(popped)))
+                except (eowyn_exc.NoMessageFoundException,
+                        eowyn_exc.SubscriptionNotFoundException):
+                    pass
+                if state.subscriptions.get(username) in (None,
+                                                         state.log.end):
+                    self._unready(username, topic)
+        return popped
+
+    def pop_user_messages(self, username, max_count, wait=0):
+        super(SimpleManager, self).pop_user_messages(username, max_count,
+                                                     wait)
+        deadline = time.time() + wait
+        while True:
+            popped = self._pop_user_now(username, max_count)
+            if popped:
+                return popped
+            with self._ready:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise eowyn_exc.NoMessageFoundException(
+                        topic=topics.ANY, username=username)
+                if not self.ready.get(username):
+                    self._wait_ready(username, remaining)
+
+    def _lease_now(self, state, topic, username, max_count, visibility):
+        # Must be called with the condition of the topic held
+        offset = self._get_offset(state, topic, username)
+        leases = state.leases.setdefault(username, _Leases())
+        now = time.time()
+        leases.expire(now)
+        messages = []
+        while leases.expired and len(messages) < max_count:
+            messages.append(leases.expired.popleft())
+        if len(messages) < max_count:
+            read = state.log.read(offset, max_count - len(messages))
+            state.log.move_reader(offset, offset + len(read))
+            state.subscriptions[username] = offset + len(read)
+            messages.extend(read)
+        if not messages:
+            raise eowyn_exc.NoMessageFoundException(
                 topic=topic, username=username)
+        return [(leases.add(message, now + visibility), message)
+                for message in messages]
+
+    def lease_messages(self, topic, username, max_count, visibility,
+                       wait=0):
+        super(SimpleManager, self).lease_messages(topic, username,
+                                                  max_count, visibility,
+                                                  wait)
+        state = self._get_topic(topic, username)
+        deadline = time.time() + wait
+        with state.condition:
+            while True:
+                try:
+                    return self._lease_now(state, topic, username,
+                                           max_count, visibility)
+                except eowyn_exc.NoMessageFoundException:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise
+                    # Expiring leases do not notify the condition
+                    expiry = state.leases[username].next_deadline()
+                    if expiry is not None:
+                        remaining = min(remaining, expiry - time.time())
+                    state.condition.wait(max(remaining, 0))
+
+    def ack_messages(self, topic, username, leases):
+        super(SimpleManager, self).ack_messages(topic, username, leases)
+        state = self._get_topic(topic, username)
+        with state.condition:
+            self._get_offset(state, topic, username)
+            pending = state.leases.get(username)
+            if pending is None:
+                return 0
+            return len([lease for lease in leases if pending.ack(lease)])
+
+    def pop_messages(self, topic, username, max_count, wait=0):
+        super(SimpleManager, self).pop_messages(topic, username, max_count,
+                                                wait)
+        return self._pop(topic, username, max_count, wait)[0]
+
+    def pop_messages_with_position(self, topic, username, max_count,
+                                   wait=0):
+        super(SimpleManager, self).pop_messages_with_position(
+            topic, username, max_count, wait)
+        return self._pop(topic, username, max_count, wait)
+
+    def get_position(self, topic, username):
+        super(SimpleManager, self).get_position(topic, username)
+        state = self._get_topic(topic, username)
+        with state.condition:
+            # The offset of the next message is the position of the last
+            # one popped, plus one
+            return self._get_offset(state, topic, username)
+
+    def rewind(self, topic, username, position):
+        super(SimpleManager, self).rewind(topic, username, position)
+        state = self._get_topic(topic, username)
+        with state.condition:
+            offset = self._get_offset(state, topic, username)
+            if not state.log.start <= position <= offset:
+                return False
+            state.log.move_reader(offset, position)
+            state.subscriptions[username] = position
+            if position < state.log.end:
+                with self._ready:
+                    self._mark_ready(username, topic)
+        return True
+
+    def get_dropped(self, topic, username):
+        super(SimpleManager, self).get_dropped(topic, username)
+        state = self._get_topic(topic, username)
+        with state.condition:
+            self._get_offset(state, topic, username)
+            return state.dropped[username]
+
+    def get_queue_depths(self, limit):
+        super(SimpleManager, self).get_queue_depths(limit)
+        depths = {}
+        for topic, state in list(self.topics.items())[:limit]:
+            with state.condition:
+                depths[topic] = dict(
+                    (username, state.log.end - offset)
+                    for username, offset in state.subscriptions.items())
+        return depths
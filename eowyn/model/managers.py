@@ -13,11 +13,19 @@
 # under the License.
 
 from eowyn import exceptions as eowyn_exc
+from eowyn.model import file_manager
 from eowyn.model import manager
 from eowyn.model import redis_manager
+from eowyn.model import redis_stream_manager
+from eowyn.model import sharded_redis_manager
+from eowyn.model import shm_manager
 
 classes = {'simple': manager.SimpleManager,
-           'redis': redis_manager.RedisManager}
+           'redis': redis_manager.RedisManager,
+           'redis_stream': redis_stream_manager.RedisStreamManager,
+           'shm': shm_manager.ShmManager,
+           'file': file_manager.FileManager,
+           'sharded_redis': sharded_redis_manager.ShardedRedisManager}
 
 
 def get_manager(name='redis', **kwargs):
@@ -26,4 +34,12 @@ def get_manager(name='redis', **kwargs):
     if name in classes.keys():
         return classes[name](**kwargs)
     else:
-        raise eowyn_exc.InvalidManager(manager=name)
+        raise eowyn_exc.InvalidManagerException(manager=name)
+
+
+def is_shared(name='redis'):
+    # Whether managers of this type share their data across processes
+    if name in classes.keys():
+        return classes[name].shared
+    else:
+        raise eowyn_exc.InvalidManagerException(manager=name)
@@ -0,0 +1,54 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Binary encoding of messages, for managers that store them as bytes
+
+Each message is a record made of a header, with the length and kind of
+the payload, followed by the payload. Text messages are stored as UTF-8
+and decoded back to text, so that messages are returned with the type
+they were published with.
+"""
+
+import struct
+
+import six
+
+HEADER = struct.Struct('<IB')
+BYTES = 0
+TEXT = 1
+
+
+def encode(message):
+    if isinstance(message, six.text_type):
+        message = message.encode('utf-8')
+        return HEADER.pack(len(message), TEXT) + message
+    return HEADER.pack(len(message), BYTES) + message
+
+
+def decode(buffer, position):
+    """Decode the record at position in buffer
+
+    :returns: a tuple with the message and the position after the record
+    """
+    length, kind = HEADER.unpack_from(buffer, position)
+    start = position + HEADER.size
+    message = buffer[start:start + length]
+    if kind == TEXT:
+        message = message.decode('utf-8')
+    return message, start + length
+
+
+def size(buffer, position):
+    # Size of the record at position in buffer
+    return HEADER.size + HEADER.unpack_from(buffer, position)[0]
@@ -12,72 +12,1131 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import math
+import threading
+import time
+
 import redis
 
 from eowyn import exceptions as eowyn_exc
+from eowyn import metrics
+from eowyn.model import cache
 from eowyn.model import manager
+from eowyn.model import retention
+from eowyn.model import topics
+
+# Channel on which changes to the subscriptions of a topic are announced,
+# with the name of the topic. Topic names never contain a '/'.
+SUBSCRIPTIONS_CHANNEL = 'eowyn/subscriptions'
+
+# Queues are topic/q/username keys. Neither topics nor usernames contain
+# a '/', so queues never collide with topics, whose segments are separated
+# by dots. Lua scripts build the same names.
+QUEUE_SEPARATOR = '/q/'
+
+# Hash holding the trie of the patterns with subscribers
+PATTERNS = 'eowyn/patterns'
+
+# The topics of each user are the set at the eowyn/users/username key.
+# Like the other keys of Eowyn, it contains a '/', which topics never do,
+# so scans for topics skip it.
+USERS = 'eowyn/users/'
+
+# The topics which may have messages for each user are the set at the
+# eowyn/ready/username key, updated by the publish scripts when a queue
+# gets its first message. Users waiting for messages on any of their topics
+# are counted at the ready/waiting key, and block on the ready/wake list,
+# holding at most one token, pushed when the first of their topics gets
+# ready. The token is also published to the ready/wake channel, for the
+# asynchronous managers.
+READY = 'eowyn/ready/'
+
+# Each node of the trie of patterns is a prefix of patterns, made of whole
+# segments, with the number of patterns sharing it. The subscribers of a
+# pattern are the set at the key of the pattern, as for a topic.
+_TRIE = """
+local trie = '%s'
+
+local function split(name)
+    local segments = {}
+    local start = 1
+    while true do
+        local stop = string.find(name, '.', start, true)
+        if not stop then
+            segments[#segments + 1] = string.sub(name, start)
+            return segments
+        end
+        segments[#segments + 1] = string.sub(name, start, stop - 1)
+        start = stop + 1
+    end
+end
+
+-- Add a pattern to the trie, or remove it with an increment of -1
+local function index(pattern, increment)
+    local prefix = nil
+    for _, segment in ipairs(split(pattern)) do
+        prefix = prefix and prefix .. '.' .. segment or segment
+        if redis.call('HINCRBY', trie, prefix, increment) <= 0 then
+            redis.call('HDEL', trie, prefix)
+        end
+    end
+end
+
+-- Patterns with subscribers matching a topic. The trie is walked down
+-- one segment at a time, following the segment itself and the '*'
+-- wildcard, and collecting the patterns ending with '>' along the way.
+local function match(topic)
+    local matches = {}
+    local nodes = {false}
+    for _, segment in ipairs(split(topic)) do
+        local following = {}
+        for _, node in ipairs(nodes) do
+            local base = node and node .. '.' or ''
+            if redis.call('HEXISTS', trie, base .. '>') == 1 then
+                matches[#matches + 1] = base .. '>'
+            end
+            for _, child in ipairs({base .. segment, base .. '*'}) do
+                if redis.call('HEXISTS', trie, child) == 1 then
+                    following[#following + 1] = child
+                end
+            end
+        end
+        nodes = following
+        if #nodes == 0 then
+            break
+        end
+    end
+    for _, node in ipairs(nodes) do
+        if node ~= topic and redis.call('EXISTS', node) == 1 then
+            matches[#matches + 1] = node
+        end
+    end
+    return matches
+end
+""" % PATTERNS
+
+# Subscribe a user to a topic, and announce the change.
+# KEYS[1] is the topic, KEYS[2] and KEYS[3], if any, the topics of the
+# user and the ready ones, which a new subscription leaves as they are,
+# ARGV[1] the username, ARGV[2] the channel, ARGV[3] the topic name and
+# ARGV[4] '1' if the topic is a pattern, which is indexed along with its
+# first subscriber. Returns 1 if the subscription was created.
+_CREATE_SUBSCRIPTION = _TRIE + """
+local added = redis.call('SADD', KEYS[1], ARGV[1])
+if added == 1 then
+    if KEYS[2] then
+        redis.call('SADD', KEYS[2], ARGV[3])
+    end
+    if ARGV[4] == '1' and redis.call('SCARD', KEYS[1]) == 1 then
+        index(ARGV[3], 1)
+    end
+    redis.call('PUBLISH', ARGV[2], ARGV[3])
+end
+return added
+"""
+
+# Payloads of large messages published to many subscribers are stored
+# once per topic, in the topic/payloads hash by SHA1 digest, along with
+# the number of queue entries referencing them, in the topic/references
+# hash. Queues hold references, i.e. the marker followed by the digest.
+# Entries starting with the marker are only references if their payload
+# is stored, as plain messages which are not UTF-8 text may start with it.
+_PAYLOADS = """
+local topic = KEYS[1]
+local payloads = topic .. '/payloads'
+local references = topic .. '/references'
+local marker = '\\255#'
+
+-- Store a payload for count queue entries, and return its reference
+local function store(message, count)
+    local digest = redis.sha1hex(message)
+    redis.call('HSETNX', payloads, digest, message)
+    redis.call('HINCRBY', references, digest, count)
+    return marker .. digest
+end
+
+-- Release the references among entries removed from a queue, resolving
+-- them to their payloads if asked to. Payloads are removed along with
+-- their last reference.
+local function release(entries, resolve)
+    for i, entry in ipairs(entries) do
+        local payload = string.sub(entry, 1, 2) == marker and
+            redis.call('HGET', payloads, string.sub(entry, 3))
+        if payload then
+            local digest = string.sub(entry, 3)
+            if resolve then
+                entries[i] = payload
+            end
+            if redis.call('HINCRBY', references, digest, -1) <= 0 then
+                redis.call('HDEL', payloads, digest)
+                redis.call('HDEL', references, digest)
+            end
+        end
+    end
+    return entries
+end
+
+-- Release the references in a queue, from start to stop, before they
+-- are removed from it
+local function release_range(queue, start, stop)
+    if redis.call('EXISTS', references) == 1 then
+        release(redis.call('LRANGE', queue, start, stop), false)
+    end
+end
+
+-- Resolve an entry to its payload, keeping its reference
+local function resolve(entry)
+    if string.sub(entry, 1, 2) == marker then
+        return redis.call('HGET', payloads, string.sub(entry, 3)) or entry
+    end
+    return entry
+end
+"""
+
+# Unsubscribe a user from a topic, drop its queue and leases and announce
+# the change. KEYS[1] is the topic, KEYS[2] the queue, KEYS[3] and
+# KEYS[4], if any, the topics of the user and the ready ones, and ARGV as
+# for creation. The wake list of the user goes with its last topic, and a
+# pattern leaves the trie along with its last subscriber.
+# No queue exists without a subscription, so deleting it is harmless
+# when the subscription is not found. Returns 1 if the subscription was
+# deleted.
+_DELETE_SUBSCRIPTION = _PAYLOADS + _TRIE + """
+local removed = redis.call('SREM', KEYS[1], ARGV[1])
+release_range(KEYS[2], 0, -1)
+release_range(KEYS[2] .. '/leasing', 0, -1)
+if redis.call('EXISTS', references) == 1 then
+    release(redis.call('HVALS', KEYS[2] .. '/leased'), false)
+end
+redis.call('DEL', KEYS[2], KEYS[2] .. '/times', KEYS[2] .. '/leases',
+           KEYS[2] .. '/leased', KEYS[2] .. '/lease', KEYS[2] .. '/leasing')
+redis.call('HDEL', KEYS[1] .. '/dropped', ARGV[1])
+if removed == 1 then
+    if KEYS[3] then
+        redis.call('SREM', KEYS[3], ARGV[3])
+        redis.call('SREM', KEYS[4], ARGV[3])
+        if redis.call('EXISTS', KEYS[3]) == 0 then
+            redis.call('DEL', KEYS[4] .. '/wake')
+        end
+    end
+    if ARGV[4] == '1' and redis.call('EXISTS', KEYS[1]) == 0 then
+        index(ARGV[3], -1)
+    end
+    redis.call('PUBLISH', ARGV[2], ARGV[3])
+end
+return removed
+"""
+
+# Retention of the queues of the subscribers of a topic. ARGV[1] is the
+# maximum length of queues, ARGV[2] the maximum age of messages in seconds,
+# zero for no limit, ARGV[3] the overflow policy and ARGV[4] the current
+# time. Dropped messages are counted by username at the topic/dropped key,
+# and in total by the script.
+# The times of messages are kept at the queue/times key, aligned with the
+# newest end of the queue, as subscribers pop from the other end.
+_RETENTION = """
+local max_length = tonumber(ARGV[1])
+local max_age = tonumber(ARGV[2])
+local reject = ARGV[3] == 'reject'
+local now = ARGV[4]
+local dropped = topic .. '/dropped'
+local dropped_count = 0
+
+local function drop(username, count)
+    redis.call('HINCRBY', dropped, username, count)
+    dropped_count = dropped_count + count
+end
+
+-- Outcome of a publish: the number of subscribers, the number of messages
+-- dropped and the subscribers whose queues are full, if any
+local function outcome(subscribers, full)
+    local result = {subscribers, dropped_count}
+    for _, username in ipairs(full) do
+        result[#result + 1] = username
+    end
+    return result
+end
+
+local function expire(username, queue)
+    local times = queue .. '/times'
+    local length = redis.call('LLEN', queue)
+    if length == 0 then
+        redis.call('DEL', times)
+        return
+    end
+    -- Drop the times of the messages popped so far
+    redis.call('LTRIM', times, 0, length - 1)
+    local timed = redis.call('LLEN', times)
+    local cutoff = tonumber(now) - max_age
+    local expired = 0
+    while expired < timed and
+            tonumber(redis.call('LINDEX', times, -1 - expired)) < cutoff do
+        expired = expired + 1
+    end
+    if expired == 0 then
+        return
+    end
+    -- Messages without a time are older than the expired ones
+    local keep = timed - expired
+    release_range(queue, keep, -1)
+    if keep == 0 then
+        redis.call('DEL', queue, times)
+    else
+        redis.call('LTRIM', queue, 0, keep - 1)
+        redis.call('LTRIM', times, 0, keep - 1)
+    end
+    drop(username, length - keep)
+end
+
+-- Expire messages, and check that count messages fit in the queues.
+-- Returns the subscribers whose queues are full, if publishing to them
+-- is rejected.
+local function before_push(subscribers, count)
+    local full = {}
+    if max_length == 0 and max_age == 0 then
+        return full
+    end
+    for _, username in ipairs(subscribers) do
+        local queue = topic .. '/q/' .. username
+        if max_age > 0 then
+            expire(username, queue)
+        end
+        if reject and max_length > 0 and
+                redis.call('LLEN', queue) + count > max_length then
+            full[#full + 1] = username
+        end
+    end
+    for _, username in ipairs(full) do
+        drop(username, count)
+    end
+    return full
+end
+
+-- Record the times of count messages pushed to a queue, and drop its
+-- oldest messages if it overflows
+local function after_push(username, queue, count)
+    if max_age > 0 then
+        local times = {}
+        for i = 1, math.min(count, 1000) do
+            times[i] = now
+        end
+        for first = 1, count, 1000 do
+            redis.call('LPUSH', queue .. '/times',
+                       unpack(times, 1, math.min(count - first + 1, 1000)))
+        end
+    end
+    if max_length > 0 and not reject then
+        local excess = redis.call('LLEN', queue) - max_length
+        if excess > 0 then
+            release_range(queue, max_length, -1)
+            redis.call('LTRIM', queue, 0, max_length - 1)
+            redis.call('LTRIM', queue .. '/times', 0, max_length - 1)
+            drop(username, excess)
+        end
+    end
+end
+"""
+
+# Fan a batch of messages out to the queue of each subscriber of the topic,
+# and of the patterns matching it. KEYS[1] is the topic, ARGV[1] to ARGV[4]
+# the retention, ARGV[5] the minimum size of payloads stored once, zero to
+# store messages in each queue, ARGV[6] '1' to match patterns, ARGV[7]
+# '1' to mark the topic as ready for its subscribers and the rest
+# of ARGV the messages. Returns the outcome of the publish, the topic does
+# not exist if neither it nor the patterns matching it have subscribers,
+# and the messages are rejected if any queue is full.
+# Queues of patterns follow the retention of the topic. Messages are
+# pushed in chunks, to stay within the limits of the Lua stack.
+# Subscribers waiting via the asynchronous manager are notified on a
+# channel named after the topic, or the pattern.
+_PUBLISH_MESSAGES = _PAYLOADS + _RETENTION + _TRIE + """
+-- Switch the keys of the topic to those of a pattern
+local function use(key)
+    topic = key
+    payloads = key .. '/payloads'
+    references = key .. '/references'
+    dropped = key .. '/dropped'
+end
+
+local targets = {KEYS[1]}
+if ARGV[6] == '1' then
+    for _, pattern in ipairs(match(KEYS[1])) do
+        targets[#targets + 1] = pattern
+    end
+end
+local count = #ARGV - 7
+local subscribers = {}
+local total = 0
+local full = {}
+for i, target in ipairs(targets) do
+    use(target)
+    subscribers[i] = redis.call('SMEMBERS', target)
+    total = total + #subscribers[i]
+    for _, username in ipairs(before_push(subscribers[i], count)) do
+        full[#full + 1] = username
+    end
+end
+if #full > 0 then
+    return outcome(total, full)
+end
+local threshold = tonumber(ARGV[5])
+for i, target in ipairs(targets) do
+    use(target)
+    local entries = {}
+    for j = 8, #ARGV do
+        local entry = ARGV[j]
+        if threshold > 0 and #entry >= threshold and #subscribers[i] > 1 then
+            entry = store(entry, #subscribers[i])
+        end
+        entries[#entries + 1] = entry
+    end
+    for _, username in ipairs(subscribers[i]) do
+        local queue = target .. '/q/' .. username
+        local idle = ARGV[7] == '1' and redis.call('LLEN', queue) == 0
+        for first = 1, count, 1000 do
+            redis.call('LPUSH', queue,
+                       unpack(entries, first, math.min(first + 999, count)))
+        end
+        after_push(username, queue, count)
+        -- Queues with messages are already ready, and users only wait
+        -- when none of their topics is
+        if idle then
+            local ready = '%s' .. username
+            if redis.call('SADD', ready, target) == 1 and
+                    redis.call('SCARD', ready) == 1 and
+                    redis.call('EXISTS', ready .. '/waiting') == 1 then
+                redis.call('LPUSH', ready .. '/wake', '')
+                redis.call('LTRIM', ready .. '/wake', 0, 0)
+                redis.call('PUBLISH', ready .. '/wake', '')
+            end
+        end
+    end
+    if #subscribers[i] > 0 then
+        redis.call('PUBLISH', target, '')
+    end
+end
+return outcome(total, {})
+""" % READY
+
+# Pop up to a number of messages from the topics ready for a user. Topics
+# found without messages are no longer ready. KEYS[1] is the set of ready
+# topics, ARGV[1] the username and ARGV[2] the maximum number of
+# messages. Returns a flat list of topics and messages.
+_POP_USER_MESSAGES = _PAYLOADS + """
+local remaining = tonumber(ARGV[2])
+local ready = redis.call('SMEMBERS', KEYS[1])
+table.sort(ready)
+local result = {}
+for _, name in ipairs(ready) do
+    if remaining == 0 then
+        break
+    end
+    local queue = name .. '/q/' .. ARGV[1]
+    if redis.call('SISMEMBER', name, ARGV[1]) == 1 then
+        topic = name
+        payloads = name .. '/payloads'
+        references = name .. '/references'
+        local queued = redis.call('LRANGE', queue, -remaining, -1)
+        redis.call('LTRIM', queue, 0, -remaining - 1)
+        local messages = {}
+        for i = #queued, 1, -1 do
+            messages[#messages + 1] = queued[i]
+        end
+        for _, message in ipairs(release(messages, true)) do
+            result[#result + 1] = name
+            result[#result + 1] = message
+        end
+        remaining = remaining - #queued
+    end
+    if redis.call('LLEN', queue) == 0 then
+        redis.call('SREM', KEYS[1], name)
+    end
+end
+return result
+"""
+
+# Count the waiters of a user, registered before their first pop so that
+# no publish is missed. KEYS[1] is the ready/waiting key, ARGV[1] 1 to
+# register a waiter or -1 to unregister it, ARGV[2] the seconds it waits
+# for, which the key outlives in case the waiter is gone.
+_WAIT_USER = """
+local waiting = redis.call('INCRBY', KEYS[1], ARGV[1])
+if waiting <= 0 then
+    redis.call('DEL', KEYS[1])
+elseif redis.call('TTL', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+"""
+
+# KEYS[1] is the topic, KEYS[2] the queue, ARGV[1] the username and
+# ARGV[2] the maximum number of messages. Returns nil if there is no
+# subscription, or the list of messages, oldest first.
+_POP_MESSAGES = _PAYLOADS + """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+    return false
+end
+local count = tonumber(ARGV[2])
+local queued = redis.call('LRANGE', KEYS[2], -count, -1)
+redis.call('LTRIM', KEYS[2], 0, -count - 1)
+local messages = {}
+for i = #queued, 1, -1 do
+    messages[#messages + 1] = queued[i]
+end
+return release(messages, true)
+"""
+
+# Lease messages of a queue to a consumer. Leased entries are held in the
+# queue/leased hash by lease, and the deadlines of leases in the
+# queue/leases sorted set. Leases are numbered by the queue/lease counter.
+# Clients waiting for messages move them from the queue to the
+# queue/leasing list, which the script leases first, so that they are not
+# lost if the client goes away before leasing them.
+# KEYS[1] is the topic, KEYS[2] the queue, ARGV[1] the username, ARGV[2]
+# the maximum number of messages, ARGV[3] the current time and ARGV[4] the
+# visibility timeout. Returns nil if there is no subscription, or a flat
+# list of leases and messages.
+_LEASE_MESSAGES = _PAYLOADS + """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+    return false
+end
+local leases = KEYS[2] .. '/leases'
+local leased = KEYS[2] .. '/leased'
+local count = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local entries = {}
+-- Take the oldest entries of a list, up to count in all
+local function take(list)
+    local remaining = count - #entries
+    if remaining > 0 then
+        local taken = redis.call('LRANGE', list, -remaining, -1)
+        redis.call('LTRIM', list, 0, -remaining - 1)
+        for i = #taken, 1, -1 do
+            entries[#entries + 1] = taken[i]
+        end
+    end
+end
+take(KEYS[2] .. '/leasing')
+-- Then messages of expired leases
+if count > #entries then
+    local expired = redis.call('ZRANGEBYSCORE', leases, '-inf', now,
+                               'LIMIT', 0, count - #entries)
+    for _, lease in ipairs(expired) do
+        entries[#entries + 1] = redis.call('HGET', leased, lease)
+        redis.call('HDEL', leased, lease)
+        redis.call('ZREM', leases, lease)
+    end
+end
+take(KEYS[2])
+local result = {}
+local deadline = now + tonumber(ARGV[4])
+for _, entry in ipairs(entries) do
+    local lease = tostring(redis.call('INCR', KEYS[2] .. '/lease'))
+    redis.call('HSET', leased, lease, entry)
+    redis.call('ZADD', leases, deadline, lease)
+    result[#result + 1] = lease
+    result[#result + 1] = resolve(entry)
+end
+return result
+"""
+
+# Acknowledge leased messages. KEYS[1] is the topic, KEYS[2] the queue,
+# ARGV[1] the username and the rest of ARGV the leases. Returns nil if
+# there is no subscription, or the number of messages acknowledged.
+_ACK_MESSAGES = _PAYLOADS + """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+    return false
+end
+local acked = 0
+for i = 2, #ARGV do
+    local entry = redis.call('HGET', KEYS[2] .. '/leased', ARGV[i])
+    if entry then
+        redis.call('HDEL', KEYS[2] .. '/leased', ARGV[i])
+        redis.call('ZREM', KEYS[2] .. '/leases', ARGV[i])
+        release({entry}, false)
+        acked = acked + 1
+    end
+end
+return acked
+"""
+
+# Resolve the references in entries popped from a queue by the client.
+# KEYS[1] is the topic and ARGV the entries. Returns the messages.
+_RESOLVE = _PAYLOADS + """
+return release(ARGV, true)
+"""
+
+# Move the queues of the subscribers of a topic from the topic.username
+# keys of previous versions to the current ones. Legacy queues hold the
+# oldest messages, which go to the tail of the current queues. KEYS[1] is
+# the topic. Returns the subscribers, and those whose queue was moved.
+_MIGRATE_QUEUES = """
+local subscribers = redis.call('SMEMBERS', KEYS[1])
+local moved = {}
+for _, username in ipairs(subscribers) do
+    local legacy = KEYS[1] .. '.' .. username
+    if redis.call('TYPE', legacy)['ok'] == 'list' then
+        local queue = KEYS[1] .. '/q/' .. username
+        local entries = redis.call('LRANGE', legacy, 0, -1)
+        for first = 1, #entries, 1000 do
+            redis.call('RPUSH', queue,
+                       unpack(entries, first, math.min(first + 999, #entries)))
+        end
+        redis.call('DEL', legacy)
+        moved[#moved + 1] = username
+    end
+end
+return {subscribers, moved}
+"""
+
+# Entries of queues referencing payloads start with the marker
+_REFERENCE = b'\xff#'
+
+
+def _cluster_client(host, port):
+    # The cluster client comes with redis-py 4.1 or newer, and with
+    # redis-py-cluster for older versions, which are only imported in
+    # cluster mode
+    try:
+        from redis import cluster
+    except ImportError:
+        import rediscluster
+        return rediscluster.RedisCluster(
+            startup_nodes=[{'host': host, 'port': port}])
+    return cluster.RedisCluster(host=host, port=int(port))
+
+
+def _publish_args(policy, dedup_threshold, messages, patterns=False,
+                  ready=True):
+    # Arguments of the publish scripts
+    return [policy.max_length, policy.max_age, policy.overflow,
+            time.time(), dedup_threshold, '1' if patterns else '0',
+            '1' if ready else '0'] + list(messages)
+
+
+def _subscription_args(topic, username, patterns=False):
+    # Arguments of the scripts creating and deleting subscriptions
+    return [username, SUBSCRIPTIONS_CHANNEL, topic,
+            '1' if patterns and topics.is_pattern(topic) else '0']
+
+
+def _user_key(username):
+    # Name of the key for the topics of a user in Redis
+    return USERS + username
+
+
+def _ready_key(username):
+    # Name of the key for the topics with messages for a user in Redis
+    return READY + username
+
+
+def _is_topic_key(key):
+    # Whether a set key found by a scan holds the subscribers of a topic
+    if isinstance(key, bytes):
+        key = key.decode('utf-8')
+    return '/' not in key
+
+
+def _user_messages(username, popped):
+    # Pairs of topics and messages from the flat list of the script popping
+    # from all the topics of a user
+    if not popped:
+        raise eowyn_exc.NoMessageFoundException(topic=topics.ANY,
+                                                username=username)
+    return [(topic.decode('utf-8'), message) for topic, message
+            in zip(popped[::2], popped[1::2])]
+
+
+def _check_published(topic, published):
+    # The publish scripts return the number of subscribers and of dropped
+    # messages, then the subscribers with full queues when the messages
+    # are rejected
+    subscribers, dropped = published[:2]
+    if dropped:
+        metrics.DROPPED.inc(amount=dropped)
+    if len(published) > 2:
+        username = published[2]
+        if isinstance(username, bytes):
+            username = username.decode('utf-8')
+        raise eowyn_exc.QueueFullException(topic=topic, username=username)
+    if not subscribers:
+        raise eowyn_exc.TopicNotFoundException(topic=topic)
 
 
 class RedisManager(manager.Manager):
     """Redis backed implementation of a model manager
 
     Subscriptions are sets of usernames associated to topic keys.
-    Messages are lists associated topic.username keys.
+    Messages are lists associated topic/q/username keys.
     Redis key/pairs are thread/process safe, so this manager can be
-    used when running Eowyn under uwsgi. With a Redis cluster Eowyn
-    may scale across multiple nodes.
+    used when running Eowyn under uwsgi.
+
+    In cluster mode topic keys are hash tags ({topic}), and queues are
+    {topic}/q/username keys, so that all the keys of a topic map to the
+    same slot. Topics are spread across the nodes of the cluster, while
+    the scripts and pipelines of each topic run on a single node. Cluster
+    mode requires a slot aware client, i.e. redis-py 4.1 or newer, or
+    redis-py-cluster.
 
     Empty keys in Redis are automatically wiped, so this manager does
     not need to cleanup empty topic subscriptions nor empty message queues.
+
+    With a cache_ttl, the subscribers of topics are cached in process, up
+    to cache_size topics. Publishing to a topic without subscribers, and
+    popping without a subscription, then fail without a round trip to
+    Redis. Changes to subscriptions are announced on a pub/sub channel,
+    which invalidates the caches of all managers. The cache is eventually
+    consistent: until the announcement of a new subscription is received,
+    messages published via other managers may be discarded.
+
+    Retention policies are enforced by the publish scripts, in the same
+    round trip. Queues are trimmed to their maximum length, and the times
+    of messages are kept in queue/times lists, if messages expire.
+    Dropped messages are counted in a topic/dropped hash, by username.
+
+    With a dedup_threshold, messages of at least that many bytes, published
+    to more than one subscriber, are stored once in a topic/payloads hash
+    by digest, and queues only hold references to them. Payloads are
+    reference counted, and removed by the script that pops, drops or
+    deletes their last reference.
+
+    Leased messages move from the queue to a queue/leased hash, by lease,
+    with the deadlines of leases in a queue/leases sorted set. Leasing and
+    acknowledging take a single round trip. Consumers waiting for
+    messages move them to a queue/leasing list, leased first.
+
+    With patterns, users may subscribe to patterns of topics. Patterns
+    with subscribers are indexed by a trie, held in the eowyn/patterns
+    hash, which the publish scripts walk down to find the patterns
+    matching the topic, in the same round trip. All the managers sharing
+    the DB must enable patterns, and publishing no longer fails early
+    from the cache. Patterns are not supported in cluster mode, as the
+    trie spans all topics.
+
+    The topics of each user are indexed in an eowyn/users/username set,
+    updated by the scripts creating and deleting subscriptions. In cluster
+    mode, where the set is on another node than the topic, it's updated
+    right after the script instead. Bulk operations on the subscriptions
+    of a user are pipelined, in a round trip or two.
+
+    The publish scripts mark the topic as ready for each subscriber whose
+    queue was empty, in eowyn/ready/username sets, so that users pop from
+    all their topics in one round trip which only looks at topics with
+    messages. Users waiting for messages register at the
+    eowyn/ready/username/waiting counter, and block on the
+    eowyn/ready/username/wake list, which publishes only write to when the
+    first topic of a registered user gets ready.
+    Popping from all topics is not supported in cluster mode, where the
+    sets of users are on other nodes than topics.
+
+    Previous versions kept queues at topic.username keys, without an
+    index of the topics of users; migrate moves them to the current
+    layout.
     """
 
-    def __init__(self, host='localhost', port=6379, db=0):
-        # By default we use db 0. Test uses db 1.
-        _pool = redis.ConnectionPool(host=host, port=port, db=db)
-        self.store = redis.StrictRedis(connection_pool=_pool)
+    shared = True
+
+    def __init__(self, host='localhost', port=6379, db=0, cluster=False,
+                 cache_ttl=0, cache_size=10000, max_length=0, max_age=0,
+                 overflow=retention.DROP_OLDEST, topic_retention='',
+                 dedup_threshold=0, patterns=False):
+        self.retention = retention.Retention(max_length, max_age, overflow,
+                                             topic_retention)
+        self.dedup_threshold = int(dedup_threshold)
+        self.cluster = str(cluster).lower() in ('true', '1', 'yes')
+        self.supports_patterns = str(patterns).lower() in ('true', '1',
+                                                           'yes')
+        if self.cluster and self.supports_patterns:
+            raise eowyn_exc.InvalidDataException(key='patterns',
+                                                 value=patterns)
+        if self.cluster:
+            # Redis Cluster only has db 0
+            self.store = _cluster_client(host, port)
+        else:
+            # By default we use db 0. Test uses db 1.
+            _pool = redis.ConnectionPool(host=host, port=port, db=db)
+            self.store = redis.StrictRedis(connection_pool=_pool)
+        # Scripts are loaded on first use and invoked via EVALSHA
+        self._publish_messages = self.store.register_script(
+            _PUBLISH_MESSAGES)
+        self._pop_messages = self.store.register_script(_POP_MESSAGES)
+        self._pop_user_messages = self.store.register_script(
+            _POP_USER_MESSAGES)
+        self._wait_user = self.store.register_script(_WAIT_USER)
+        self._resolve = self.store.register_script(_RESOLVE)
+        self._lease_messages = self.store.register_script(_LEASE_MESSAGES)
+        self._ack_messages = self.store.register_script(_ACK_MESSAGES)
+        self._create_subscription = self.store.register_script(
+            _CREATE_SUBSCRIPTION)
+        self._delete_subscription = self.store.register_script(
+            _DELETE_SUBSCRIPTION)
+        self._migrate_queues = self.store.register_script(_MIGRATE_QUEUES)
+        self.cache = None
+        if float(cache_ttl) > 0:
+            self.cache = cache.TTLCache(float(cache_ttl), int(cache_size))
+            # Set once the manager listens to announcements
+            self._cache_ready = False
+            self._closed = threading.Event()
+            self._listener = threading.Thread(target=self._listen)
+            self._listener.daemon = True
+            self._listener.start()
+
+    def _listen(self):
+        # Invalidate cached topics as changes are announced
+        while not self._closed.is_set():
+            pubsub = self.store.pubsub()
+            try:
+                pubsub.subscribe(SUBSCRIPTIONS_CHANNEL)
+                while not self._closed.is_set():
+                    message = pubsub.get_message(timeout=0.1)
+                    if message is None:
+                        continue
+                    if message['type'] == 'subscribe':
+                        # Changes may have been missed until now
+                        self.cache.clear()
+                        self._cache_ready = True
+                    elif message['type'] == 'message':
+                        topic = message['data']
+                        if isinstance(topic, bytes):
+                            topic = topic.decode('utf-8')
+                        self.cache.invalidate(topic)
+            except redis.exceptions.ConnectionError:
+                self._cache_ready = False
+                self._closed.wait(1)
+            finally:
+                pubsub.close()
+        self._cache_ready = False
+
+    def close(self):
+        """Stop listening to changes of subscriptions, if caching"""
+        if self.cache is not None:
+            self._closed.set()
+            self._listener.join()
+
+    def _subscribers(self, topic):
+        # Cached subscribers of a topic, None if the cache cannot be used
+        if self.cache is None or not self._cache_ready:
+            return None
+        subscribers = self.cache.get(topic)
+        if subscribers is None:
+            token = self.cache.token()
+            subscribers = frozenset(
+                s.decode('utf-8') if isinstance(s, bytes) else s
+                for s in self.store.smembers(self._key(topic)))
+            self.cache.set(topic, subscribers, token)
+        return subscribers
+
+    def _key(self, topic):
+        # Name of the key for the subscriptions of a topic in Redis
+        if self.cluster:
+            return '{%s}' % topic
+        return topic
 
     def _queue(self, topic, username):
-        # Name of the key for the message queue in Redis
-        return ".".join([topic, username])
+        # Name of the key for the message queue in Redis. Lua scripts
+        # build the same name server side.
+        return self._key(topic) + QUEUE_SEPARATOR + username
+
+    def _index_keys(self, username):
+        # Keys of the topics of a user, and of the ready ones, updated by
+        # the scripts. In cluster mode they are on another node, see
+        # _index.
+        return [] if self.cluster else [_user_key(username),
+                                        _ready_key(username)]
+
+    def _index(self, username, added, removed):
+        # Update the index of the topics of a user in cluster mode
+        if not self.cluster:
+            return
+        pipe = self.store.pipeline()
+        if added:
+            pipe.sadd(_user_key(username), *added)
+        if removed:
+            pipe.srem(_user_key(username), *removed)
+        pipe.execute()
+
+    def _create(self, topic, username, client=None):
+        # SADD only reports members that were not in the set yet
+        return self._create_subscription(
+            keys=[self._key(topic)] + self._index_keys(username),
+            args=_subscription_args(topic, username, self.supports_patterns),
+            client=client)
+
+    def _delete(self, topic, username, client=None):
+        # Remove the subscriber and drop its message queue, if any,
+        # atomically
+        return self._delete_subscription(
+            keys=[self._key(topic), self._queue(topic, username)] +
+            self._index_keys(username),
+            args=_subscription_args(topic, username, self.supports_patterns),
+            client=client)
 
     def create_subscription(self, topic, username):
         super(RedisManager, self).create_subscription(topic, username)
-        subscribers = self.store.smembers(topic)
-        if subscribers and username in subscribers:
+        added = self._create(topic, username)
+        if self.cache is not None:
+            self.cache.invalidate(topic)
+        if not added:
             raise eowyn_exc.SubscriptionAlreadyExistsException(
                 topic=topic, username=username)
-        self.store.sadd(topic, username)
+        self._index(username, [topic], [])
         return topic
 
     def delete_subscription(self, topic, username):
         super(RedisManager, self).delete_subscription(topic, username)
-        subscribers = self.store.smembers(topic)
-        if username not in subscribers:
+        removed = self._delete(topic, username)
+        if self.cache is not None:
+            self.cache.invalidate(topic)
+        if not removed:
             raise eowyn_exc.SubscriptionNotFoundException(
                 topic=topic, username=username)
-        self.store.srem(topic, username)
-        # Drop the corresponding message queue if it exists
-        if self.store.exists(self._queue(topic, username)):
-            self.store.delete(self._queue(topic, username))
+        self._index(username, [], [topic])
         return topic
 
+    def create_subscriptions(self, username, topics):
+        super(RedisManager, self).create_subscriptions(username, topics)
+        pipe = self.store.pipeline(transaction=False)
+        for topic in topics:
+            self._create(topic, username, client=pipe)
+        created = [topic for topic, added in zip(topics, pipe.execute())
+                   if added]
+        if self.cache is not None:
+            for topic in topics:
+                self.cache.invalidate(topic)
+        self._index(username, created, [])
+        return created
+
+    def get_topics(self, username):
+        super(RedisManager, self).get_topics(username)
+        return sorted(
+            topic.decode('utf-8') if isinstance(topic, bytes) else topic
+            for topic in self.store.smembers(_user_key(username)))
+
+    def delete_subscriptions(self, username):
+        super(RedisManager, self).delete_subscriptions(username)
+        topics = self.get_topics(username)
+        if not topics:
+            return []
+        pipe = self.store.pipeline(transaction=False)
+        for topic in topics:
+            self._delete(topic, username, client=pipe)
+        # Subscriptions may be deleted concurrently
+        deleted = [topic for topic, removed in zip(topics, pipe.execute())
+                   if removed]
+        if self.cache is not None:
+            for topic in topics:
+                self.cache.invalidate(topic)
+        self._index(username, [], topics)
+        return deleted
+
+    def _no_subscribers(self, topic):
+        # Whether the cache tells that nothing is published to the topic.
+        # Patterns matching the topic are not cached.
+        return (not self.supports_patterns and
+                self._subscribers(topic) == frozenset())
+
     def publish_message(self, topic, message):
         super(RedisManager, self).publish_message(topic, message)
-        if topic in self.store:
-            for username in self.store.smembers(topic):
-                self.store.lpush(self._queue(topic, username), message)
-        else:
+        if self._no_subscribers(topic):
             raise eowyn_exc.TopicNotFoundException(topic=topic)
+        # The fan-out runs server side, in a single round trip regardless
+        # of the number of subscribers
+        _check_published(topic, self._publish_messages(
+            keys=[self._key(topic)],
+            args=_publish_args(self.retention.get(topic),
+                               self.dedup_threshold, [message],
+                               self.supports_patterns, not self.cluster)))
+
+    def publish_messages(self, topic, messages):
+        super(RedisManager, self).publish_messages(topic, messages)
+        if self._no_subscribers(topic):
+            raise eowyn_exc.TopicNotFoundException(topic=topic)
+        _check_published(topic, self._publish_messages(
+            keys=[self._key(topic)],
+            args=_publish_args(self.retention.get(topic),
+                               self.dedup_threshold, messages,
+                               self.supports_patterns, not self.cluster)))
+
+    def _pop_now(self, topic, username, max_count):
+        subscribers = self._subscribers(topic)
+        if subscribers is not None and username not in subscribers:
+            raise eowyn_exc.SubscriptionNotFoundException(
+                topic=topic, username=username)
+        # Membership check and pop run atomically, in one round trip
+        messages = self._pop_messages(
+            keys=[self._key(topic), self._queue(topic, username)],
+            args=[username, max_count])
+        if messages is None:
+            raise eowyn_exc.SubscriptionNotFoundException(
+                topic=topic, username=username)
+        if not messages:
+            raise eowyn_exc.NoMessageFoundException(
+                topic=topic, username=username)
+        return messages
+
+    def _pop(self, topic, username, max_count, wait):
+        try:
+            return self._pop_now(topic, username, max_count)
+        except eowyn_exc.NoMessageFoundException:
+            if not wait:
+                raise
+        # Block on the queue until a message is pushed to it, or the wait
+        # is over. If the subscription is deleted meanwhile, the final pop
+        # reports it.
+        popped = self.store.brpop(self._queue(topic, username), timeout=wait)
+        if popped is None:
+            return self._pop_now(topic, username, max_count)
+        messages = [popped[1]]
+        if messages[0].startswith(_REFERENCE):
+            messages = self._resolve(keys=[self._key(topic)], args=messages)
+        if max_count > 1:
+            try:
+                messages.extend(
+                    self._pop_now(topic, username, max_count - 1))
+            except (eowyn_exc.NoMessageFoundException,
+                    eowyn_exc.SubscriptionNotFoundException):
+                pass
+        return messages
 
-    def pop_message(self, topic, username):
-        super(RedisManager, self).pop_message(topic, username)
-        if topic in self.store and username in self.store.smembers(topic):
-            message = self.store.rpop(self._queue(topic, username))
-            if not message:
+    def pop_message(self, topic, username, wait=0):
+        super(RedisManager, self).pop_message(topic, username, wait)
+        return self._pop(topic, username, 1, wait)[0]
+
+    def pop_messages(self, topic, username, max_count, wait=0):
+        super(RedisManager, self).pop_messages(topic, username, max_count,
+                                               wait)
+        return self._pop(topic, username, max_count, wait)
+
+    def pop_user_messages(self, username, max_count, wait=0):
+        super(RedisManager, self).pop_user_messages(username, max_count,
+                                                    wait)
+        if self.cluster:
+            return None
+        popped = self._pop_user_messages(keys=[_ready_key(username)],
+                                         args=[username, max_count])
+        if popped or not wait:
+            return _user_messages(username, popped)
+        # Publishes only wake up registered waiters
+        waiting = _ready_key(username) + '/waiting'
+        self._wait_user(keys=[waiting], args=[1, wait + 1])
+        try:
+            deadline = time.time() + wait
+            while True:
+                popped = self._pop_user_messages(
+                    keys=[_ready_key(username)], args=[username, max_count])
+                remaining = deadline - time.time()
+                if popped or remaining <= 0:
+                    return _user_messages(username, popped)
+                # Block until the first topic of the user gets ready.
+                # Tokens left by publishes already popped only cause
+                # another round.
+                self.store.brpop(_ready_key(username) + '/wake',
+                                 timeout=max(1, int(math.ceil(remaining))))
+        finally:
+            self._wait_user(keys=[waiting], args=[-1, 0])
+
+    def lease_messages(self, topic, username, max_count, visibility,
+                       wait=0):
+        super(RedisManager, self).lease_messages(topic, username,
+                                                 max_count, visibility, wait)
+        queue = self._queue(topic, username)
+        deadline = time.time() + wait
+        while True:
+            leased = self._lease_messages(
+                keys=[self._key(topic), queue],
+                args=[username, max_count, time.time(), visibility])
+            if leased is None:
+                raise eowyn_exc.SubscriptionNotFoundException(
+                    topic=topic, username=username)
+            if leased:
+                return [(lease.decode('utf-8'), message) for lease, message
+                        in zip(leased[::2], leased[1::2])]
+            remaining = deadline - time.time()
+            if remaining <= 0:
                 raise eowyn_exc.NoMessageFoundException(
                     topic=topic, username=username)
-            else:
-                return message
-        else:
+            # Block until a message is pushed to the queue, or the next
+            # lease expires. The entry is moved to the queue/leasing list,
+            # rather than popped, so that it's leased by the script even
+            # if this client goes away meanwhile.
+            expiry = self.store.zrange(queue + '/leases', 0, 0,
+                                       withscores=True)
+            if expiry:
+                remaining = min(remaining, expiry[0][1] - time.time())
+            self.store.brpoplpush(
+                queue, queue + '/leasing',
+                timeout=max(1, int(math.ceil(remaining))))
+
+    def ack_messages(self, topic, username, leases):
+        super(RedisManager, self).ack_messages(topic, username, leases)
+        acked = self._ack_messages(
+            keys=[self._key(topic), self._queue(topic, username)],
+            args=[username] + list(leases))
+        if acked is None:
             raise eowyn_exc.SubscriptionNotFoundException(
                 topic=topic, username=username)
+        return acked
+
+    def get_dropped(self, topic, username):
+        super(RedisManager, self).get_dropped(topic, username)
+        pipe = self.store.pipeline()
+        pipe.sismember(self._key(topic), username)
+        pipe.hget(self._key(topic) + '/dropped', username)
+        subscribed, dropped = pipe.execute()
+        if not subscribed:
+            raise eowyn_exc.SubscriptionNotFoundException(
+                topic=topic, username=username)
+        return int(dropped or 0)
+
+    def get_queue_depths(self, limit):
+        super(RedisManager, self).get_queue_depths(limit)
+        # Topics are the set keys, queues are lists
+        topics = []
+        for key in self.store.scan_iter(_type='SET'):
+            if len(topics) == limit:
+                break
+            if not _is_topic_key(key):
+                continue
+            topic = key.decode('utf-8') if isinstance(key, bytes) else key
+            topics.append(topic[1:-1] if self.cluster else topic)
+        pipe = self.store.pipeline()
+        for topic in topics:
+            pipe.smembers(self._key(topic))
+        queues = []
+        for topic, usernames in zip(topics, pipe.execute()):
+            for username in usernames:
+                if isinstance(username, bytes):
+                    username = username.decode('utf-8')
+                queues.append((topic, username))
+        pipe = self.store.pipeline()
+        for topic, username in queues:
+            pipe.llen(self._queue(topic, username))
+        depths = dict((topic, {}) for topic in topics)
+        for (topic, username), length in zip(queues, pipe.execute()):
+            depths[topic][username] = length
+        return depths
+
+    def migrate(self):
+        super(RedisManager, self).migrate()
+        # Queues were topic.username keys, and the topics of users were
+        # not indexed
+        moved = 0
+        for key in self.store.scan_iter(_type='SET'):
+            if not _is_topic_key(key):
+                continue
+            subscribers, queues = self._migrate_queues(keys=[key])
+            topic = key.decode('utf-8') if isinstance(key, bytes) else key
+            if self.cluster:
+                topic = topic[1:-1]
+            pipe = self.store.pipeline()
+            for username in subscribers:
+                if isinstance(username, bytes):
+                    username = username.decode('utf-8')
+                pipe.sadd(_user_key(username), topic)
+            if not self.cluster:
+                for username in queues:
+                    if isinstance(username, bytes):
+                        username = username.decode('utf-8')
+                    pipe.sadd(_ready_key(username), topic)
+            pipe.execute()
+            moved += len(queues)
+        return moved
@@ -0,0 +1,242 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import redis
+
+from eowyn import exceptions as eowyn_exc
+from eowyn.model import manager
+
+# Prefixes of the cursors, stream and sequence keys of topics. Topic names
+# may hold any character, so the kind of key comes first.
+CURSORS = 'eowyn/cursors/'
+STREAMS = 'eowyn/streams/'
+SEQUENCES = 'eowyn/sequences/'
+
+# Entries of a stream are consumed once all subscribers have read past
+# them. KEYS[1] are the cursors, KEYS[2] the stream and KEYS[3] the
+# sequence of a topic.
+_TRIM = """
+local function trim()
+    local slowest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    if #slowest == 0 then
+        redis.call('DEL', KEYS[2], KEYS[3])
+    else
+        redis.call('XTRIM', KEYS[2], 'MINID',
+                   string.format('%d-0', tonumber(slowest[2]) + 1))
+    end
+end
+"""
+
+# New subscribers start reading after the last published message.
+# ARGV[1] is the username. Returns 0 if the subscription already exists.
+_CREATE_SUBSCRIPTION = """
+local position = redis.call('GET', KEYS[3]) or 0
+return redis.call('ZADD', KEYS[1], 'NX', position, ARGV[1])
+"""
+
+# ARGV[1] is the username. Returns 0 if the subscription does not exist.
+_DELETE_SUBSCRIPTION = _TRIM + """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+trim()
+return 1
+"""
+
+# ARGV[1] is the message. Returns 0 if the topic does not exist.
+_PUBLISH_MESSAGE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local sequence = redis.call('INCR', KEYS[3])
+redis.call('XADD', KEYS[2], string.format('%d-0', sequence),
+           'message', ARGV[1])
+return 1
+"""
+
+# ARGV are the messages. Returns 0 if the topic does not exist.
+_PUBLISH_MESSAGES = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local sequence = redis.call('INCRBY', KEYS[3], #ARGV) - #ARGV
+for i, message in ipairs(ARGV) do
+    redis.call('XADD', KEYS[2], string.format('%d-0', sequence + i),
+               'message', message)
+end
+return 1
+"""
+
+# ARGV[1] is the username and ARGV[2] the maximum number of messages.
+# Returns nil if there is no subscription, an empty list if there is no
+# message, or the new position of the subscriber followed by the messages.
+_POP_MESSAGES = _TRIM + """
+local position = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not position then
+    return false
+end
+local entries = redis.call('XRANGE', KEYS[2],
+                           string.format('%d-0', tonumber(position) + 1),
+                           '+', 'COUNT', ARGV[2])
+if #entries == 0 then
+    return {}
+end
+local sequence = tonumber(string.match(entries[#entries][1], '^%d+'))
+redis.call('ZADD', KEYS[1], sequence, ARGV[1])
+trim()
+local popped = {sequence}
+for i, entry in ipairs(entries) do
+    popped[i + 1] = entry[2][2]
+end
+return popped
+"""
+
+# ARGV[1] is the username and ARGV[2] the position. Subscribers may only
+# move back to entries that are still in the stream, i.e. not past the
+# slowest subscriber. Returns nil if there is no subscription, 0 if the
+# subscriber could not be moved and 1 otherwise.
+_REWIND = """
+local position = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not position then
+    return false
+end
+local slowest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+local target = tonumber(ARGV[2])
+if target < tonumber(slowest[2]) or target > tonumber(position) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], target, ARGV[1])
+return 1
+"""
+
+
+class RedisStreamManager(manager.Manager):
+    """Redis Streams backed implementation of a model manager
+
+    Each message is stored once, in a stream associated to the
+    eowyn/streams/topic key. Entry IDs are taken from a per-topic sequence
+    at the eowyn/sequences/topic key. Subscriptions are a sorted set
+    associated to the eowyn/cursors/topic key, where the score of each
+    username is the sequence of the last message it received.
+    Entries are trimmed as soon as the slowest subscriber has read them,
+    so messages only persist until all subscribers at the time of
+    publishing have received them.
+
+    All operations are Lua scripts, which makes them atomic and lets them
+    run in a single round trip. Trimming by minimum ID requires Redis 6.2.
+    """
+
+    shared = True
+
+    def __init__(self, host='localhost', port=6379, db=0):
+        _pool = redis.ConnectionPool(host=host, port=port, db=db)
+        self.store = redis.StrictRedis(connection_pool=_pool)
+        self._create_subscription = self.store.register_script(
+            _CREATE_SUBSCRIPTION)
+        self._delete_subscription = self.store.register_script(
+            _DELETE_SUBSCRIPTION)
+        self._publish_message = self.store.register_script(_PUBLISH_MESSAGE)
+        self._publish_messages = self.store.register_script(
+            _PUBLISH_MESSAGES)
+        self._pop_messages = self.store.register_script(_POP_MESSAGES)
+        self._rewind = self.store.register_script(_REWIND)
+
+    def _keys(self, topic):
+        # Cursors, stream and sequence keys of a topic
+        return [CURSORS + topic, STREAMS + topic, SEQUENCES + topic]
+
+    def create_subscription(self, topic, username):
+        super(RedisStreamManager, self).create_subscription(topic, username)
+        if not self._create_subscription(keys=self._keys(topic),
+                                         args=[username]):
+            raise eowyn_exc.SubscriptionAlreadyExistsException(
+                topic=topic, username=username)
+        return topic
+
+    def delete_subscription(self, topic, username):
+        super(RedisStreamManager, self).delete_subscription(topic, username)
+        if not self._delete_subscription(keys=self._keys(topic),
+                                         args=[username]):
+            raise eowyn_exc.SubscriptionNotFoundException(
+                topic=topic, username=username)
+        return topic
+
+    def publish_message(self, topic, message):
+        super(RedisStreamManager, self).publish_message(topic, message)
+        if not self._publish_message(keys=self._keys(topic), args=[message]):
+            raise eowyn_exc.TopicNotFoundException(topic=topic)
+
+    def publish_messages(self, topic, messages):
+        super(RedisStreamManager, self).publish_messages(topic, messages)
+        if not self._publish_messages(keys=self._keys(topic), args=messages):
+            raise eowyn_exc.TopicNotFoundException(topic=topic)
+
+    def _pop_now(self, topic, username, max_count):
+        # Returns the messages and the position of the subscriber
+        popped = self._pop_messages(keys=self._keys(topic),
+                                    args=[username, max_count])
+        if popped is None:
+            raise eowyn_exc.SubscriptionNotFoundException(
+                topic=topic, username=username)
+        if not popped:
+            raise eowyn_exc.NoMessageFoundException(
+                topic=topic, username=username)
+        return popped[1:], popped[0]
+
+    def _pop(self, topic, username, max_count, wait):
+        try:
+            return self._pop_now(topic, username, max_count)
+        except eowyn_exc.NoMessageFoundException:
+            if not wait:
+                raise
+        # Block until an entry past the position of the subscriber is
+        # added to the stream, or the wait is over
+        cursors, stream, _ = self._keys(topic)
+        position = self.store.zscore(cursors, username)
+        if position is not None:
+            self.store.xread({stream: '%d-0' % position}, count=1,
+                             block=wait * 1000)
+        return self._pop_now(topic, username, max_count)
+
+    def pop_message(self, topic, username, wait=0):
+        super(RedisStreamManager, self).pop_message(topic, username, wait)
+        return self._pop(topic, username, 1, wait)[0][0]
+
+    def pop_messages(self, topic, username, max_count, wait=0):
+        super(RedisStreamManager, self).pop_messages(topic, username,
+                                                     max_count, wait)
+        return self._pop(topic, username, max_count, wait)[0]
+
+    def pop_messages_with_position(self, topic, username, max_count,
+                                   wait=0):
+        super(RedisStreamManager, self).pop_messages_with_position(
+            topic, username, max_count, wait)
+        return self._pop(topic, username, max_count, wait)
+
+    def get_position(self, topic, username):
+        super(RedisStreamManager, self).get_position(topic, username)
+        position = self.store.zscore(self._keys(topic)[0], username)
+        if position is None:
+            raise eowyn_exc.SubscriptionNotFoundException(
+                topic=topic, username=username)
+        return int(position)
+
+    def rewind(self, topic, username, position):
+        super(RedisStreamManager, self).rewind(topic, username, position)
+        rewound = self._rewind(keys=self._keys(topic),
+                               args=[username, position])
+        if rewound is None:
+            raise eowyn_exc.SubscriptionNotFoundException(
+                topic=topic, username=username)
+        return bool(rewound)
@@ -0,0 +1,80 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+
+from eowyn import exceptions as eowyn_exc
+
+# What to do when publishing to a full queue
+DROP_OLDEST = 'drop_oldest'
+REJECT = 'reject'
+
+Policy = collections.namedtuple('Policy', ['max_length', 'max_age',
+                                           'overflow'])
+
+
+def _policy(max_length, max_age, overflow):
+    try:
+        policy = Policy(int(max_length), float(max_age),
+                        str(overflow).lower())
+    except ValueError:
+        raise eowyn_exc.InvalidDataException(
+            key='retention', value=(max_length, max_age, overflow))
+    if (policy.max_length < 0 or policy.max_age < 0 or
+            policy.overflow not in (DROP_OLDEST, REJECT)):
+        raise eowyn_exc.InvalidDataException(key='retention', value=policy)
+    return policy
+
+
+class Retention(object):
+    """Retention policies of the queues of subscribers
+
+    A policy caps the number of messages queued for each subscriber to
+    max_length, and the age of queued messages to max_age seconds. Zero
+    means no limit. When a queue is full, publishing either drops its
+    oldest messages (drop_oldest), or fails (reject).
+
+    The global policy applies to all topics, except those with a policy
+    of their own. Topic policies are given one per line, as a topic name
+    followed by the settings that differ from the global policy, e.g.:
+
+        orders max_length=1000 overflow=reject
+        logs max_age=3600
+    """
+
+    def __init__(self, max_length=0, max_age=0, overflow=DROP_OLDEST,
+                 topic_retention=''):
+        self.default = _policy(max_length, max_age, overflow)
+        self.topics = {}
+        for line in topic_retention.splitlines():
+            fields = line.split()
+            if not fields:
+                continue
+            settings = self.default._asdict()
+            for field in fields[1:]:
+                key, _, value = field.partition('=')
+                if key not in settings:
+                    raise eowyn_exc.InvalidDataException(key=key,
+                                                         value=value)
+                settings[key] = value
+            self.topics[fields[0]] = _policy(**settings)
+
+    def get(self, topic):
+        return self.topics.get(topic, self.default)
+
+    def __bool__(self):
+        # Whether any limit is set at all
+        return any(p.max_length or p.max_age
+                   for p in [self.default] + list(self.topics.values()))
+    __nonzero__ = __bool__
@@ -0,0 +1,306 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import bisect
+import collections
+import contextlib
+import hashlib
+import struct
+import threading
+
+import six
+
+from eowyn.model import manager
+from eowyn.model import redis_manager
+from eowyn.model import retention
+
+
+class HashRing(object):
+    """Consistent hash ring
+
+    Each node is placed on the ring at a number of points, its virtual
+    nodes, and each key belongs to the node of the first point after the
+    hash of the key. Adding a node only moves the keys of the points it
+    takes over, about 1 / number of nodes of them, all to the new node.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._points = []
+        self._nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, six.text_type):
+            key = key.encode('utf-8')
+        return struct.unpack_from('>Q', hashlib.md5(key).digest())[0]
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = self._hash('%s-%d' % (node, replica))
+            bisect.insort(self._points, point)
+            self._nodes[point] = node
+
+    def remove(self, node):
+        for replica in range(self.replicas):
+            point = self._hash('%s-%d' % (node, replica))
+            self._points.remove(point)
+            del self._nodes[point]
+
+    def get(self, key):
+        index = bisect.bisect(self._points, self._hash(key))
+        return self._nodes[self._points[index % len(self._points)]]
+
+
+def _parse_shards(shards):
+    # Shards are a comma separated list of host:port/db
+    if isinstance(shards, six.string_types):
+        shards = [s.strip() for s in shards.split(',') if s.strip()]
+    return list(shards)
+
+
+class ShardedRedisManager(manager.Manager):
+    """Redis implementation of a model manager, sharded across servers
+
+    Topics are placed on standalone Redis servers, the shards, with
+    consistent hashing. All the keys of a topic are on the same shard,
+    which is managed by a RedisManager, with its own connection pool,
+    and uses the same data layout.
+
+    Shards may be added at runtime. Only the topics the new shard takes
+    over, about 1 / number of shards of them, are moved to it. Requests
+    on those topics wait for the move, other topics are served meanwhile.
+
+    Each shard indexes the topics of users it holds, so bulk operations
+    on the subscriptions of a user take a round trip or two per shard.
+    """
+
+    shared = True
+
+    def __init__(self, shards='localhost:6379/0', replicas=100,
+                 max_length=0, max_age=0, overflow=retention.DROP_OLDEST,
+                 topic_retention='', dedup_threshold=0):
+        # Options of the manager of each shard
+        self._options = dict(max_length=max_length, max_age=max_age,
+                             overflow=overflow,
+                             topic_retention=topic_retention,
+                             dedup_threshold=dedup_threshold)
+        self.shards = {}
+        self.ring = HashRing(replicas=int(replicas))
+        for shard in _parse_shards(shards):
+            self.shards[shard] = self._connect(shard)
+            self.ring.add(shard)
+        # Requests in progress by topic, None for those on all topics, and
+        # the shard being added along with the ring it makes, if any
+        self._lock = threading.Condition()
+        self._active = collections.Counter()
+        self._adding = None
+
+    def _connect(self, shard):
+        address, _, db = shard.partition('/')
+        host, _, port = address.partition(':')
+        return redis_manager.RedisManager(host=host, port=int(port or 6379),
+                                          db=int(db or 0), **self._options)
+
+    def _shard(self, topic):
+        return self.shards[self.ring.get(topic)]
+
+    def _moving(self, topic):
+        # Whether a topic moves to the shard being added
+        shard, ring = self._adding
+        return topic is None or ring.get(topic) == shard
+
+    @contextlib.contextmanager
+    def _hold(self, *topics):
+        # Requests on topics moving to a shard being added wait for the
+        # move, which waits for those in progress. No topics is for
+        # requests on all topics.
+        topics = topics or (None,)
+        with self._lock:
+            while self._adding and any(self._moving(t) for t in topics):
+                self._lock.wait()
+            self._active.update(topics)
+        try:
+            yield
+        finally:
+            with self._lock:
+                for topic in topics:
+                    self._active[topic] -= 1
+                    if not self._active[topic]:
+                        del self._active[topic]
+                self._lock.notify_all()
+
+    def add_shard(self, shard):
+        """Add a shard, and move to it the topics it takes over
+
+        Requests on the topics moved by this manager wait for the move,
+        those of other processes must be held while the shard is added.
+
+        :param shard: address of the shard, as host:port/db
+        """
+        new = self._connect(shard)
+        ring = HashRing(list(self.shards) + [shard], self.ring.replicas)
+        with self._lock:
+            while self._adding:
+                self._lock.wait()
+            self._adding = (shard, ring)
+            while any(self._moving(topic) for topic in self._active):
+                self._lock.wait()
+        try:
+            for old in self.shards.values():
+                for topic in list(self._topics(old)):
+                    if ring.get(topic) == shard:
+                        self._move(topic, old, new)
+            # Registered before it's on the ring, so that it's found by
+            # the requests routed to it
+            self.shards[shard] = new
+            self.ring = ring
+        finally:
+            with self._lock:
+                self._adding = None
+                self._lock.notify_all()
+
+    @staticmethod
+    def _topics(shard):
+        # Topics are the set keys of a shard, along with the sets of the
+        # topics of users
+        for key in shard.store.scan_iter(_type='SET'):
+            if redis_manager._is_topic_key(key):
+                yield key.decode('utf-8') if isinstance(key, bytes) else key
+
+    @staticmethod
+    def _move(topic, old, new):
+        keys = [old._key(topic)] + [
+            old._key(topic) + suffix
+            for suffix in ('/dropped', '/payloads', '/references')]
+        usernames = []
+        for username in old.store.smembers(old._key(topic)):
+            if isinstance(username, bytes):
+                username = username.decode('utf-8')
+            usernames.append(username)
+            queue = old._queue(topic, username)
+            keys.extend([queue] + [queue + suffix for suffix in
+                                   ('/times', '/leases', '/leased',
+                                    '/lease', '/leasing')])
+        pipe = old.store.pipeline()
+        for key in keys:
+            pipe.dump(key)
+        dumps = pipe.execute()
+        pipe = new.store.pipeline()
+        for key, dump in zip(keys, dumps):
+            if dump is not None:
+                pipe.restore(key, 0, dump, replace=True)
+        for username in usernames:
+            pipe.sadd(redis_manager._user_key(username), topic)
+        pipe.execute()
+        pipe = old.store.pipeline()
+        pipe.delete(*keys)
+        for username in usernames:
+            pipe.srem(redis_manager._user_key(username), topic)
+        pipe.execute()
+
+    def create_subscription(self, topic, username):
+        super(ShardedRedisManager, self).create_subscription(topic,
+                                                             username)
+        with self._hold(topic):
+            return self._shard(topic).create_subscription(topic, username)
+
+    def delete_subscription(self, topic, username):
+        super(ShardedRedisManager, self).delete_subscription(topic,
+                                                             username)
+        with self._hold(topic):
+            return self._shard(topic).delete_subscription(topic, username)
+
+    def create_subscriptions(self, username, topics):
+        super(ShardedRedisManager, self).create_subscriptions(username,
+                                                              topics)
+        with self._hold(*topics):
+            by_shard = {}
+            for topic in topics:
+                by_shard.setdefault(self.ring.get(topic), []).append(topic)
+            created = []
+            for shard, shard_topics in by_shard.items():
+                created.extend(self.shards[shard].create_subscriptions(
+                    username, shard_topics))
+        return created
+
+    def get_topics(self, username):
+        super(ShardedRedisManager, self).get_topics(username)
+        with self._hold():
+            return sorted(topic for shard in self.shards.values()
+                          for topic in shard.get_topics(username))
+
+    def delete_subscriptions(self, username):
+        super(ShardedRedisManager, self).delete_subscriptions(username)
+        with self._hold():
+            return sorted(topic for shard in self.shards.values()
+                          for topic in shard.delete_subscriptions(username))
+
+    def publish_message(self, topic, message):
+        super(ShardedRedisManager, self).publish_message(topic, message)
+        with self._hold(topic):
+            self._shard(topic).publish_message(topic, message)
+
+    def publish_messages(self, topic, messages):
+        super(ShardedRedisManager, self).publish_messages(topic, messages)
+        with self._hold(topic):
+            self._shard(topic).publish_messages(topic, messages)
+
+    def pop_message(self, topic, username, wait=0):
+        super(ShardedRedisManager, self).pop_message(topic, username, wait)
+        with self._hold(topic):
+            return self._shard(topic).pop_message(topic, username, wait)
+
+    def pop_messages(self, topic, username, max_count, wait=0):
+        super(ShardedRedisManager, self).pop_messages(topic, username,
+                                                      max_count, wait)
+        with self._hold(topic):
+            return self._shard(topic).pop_messages(topic, username,
+                                                   max_count, wait)
+
+    def lease_messages(self, topic, username, max_count, visibility,
+                       wait=0):
+        super(ShardedRedisManager, self).lease_messages(
+            topic, username, max_count, visibility, wait)
+        with self._hold(topic):
+            return self._shard(topic).lease_messages(
+                topic, username, max_count, visibility, wait)
+
+    def ack_messages(self, topic, username, leases):
+        super(ShardedRedisManager, self).ack_messages(topic, username,
+                                                      leases)
+        with self._hold(topic):
+            return self._shard(topic).ack_messages(topic, username, leases)
+
+    def get_dropped(self, topic, username):
+        super(ShardedRedisManager, self).get_dropped(topic, username)
+        with self._hold(topic):
+            return self._shard(topic).get_dropped(topic, username)
+
+    def get_queue_depths(self, limit):
+        super(ShardedRedisManager, self).get_queue_depths(limit)
+        depths = {}
+        with self._hold():
+            for shard in self.shards.values():
+                if len(depths) < limit:
+                    depths.update(
+                        shard.get_queue_depths(limit - len(depths)))
+        return depths
+
+    def migrate(self):
+        super(ShardedRedisManager, self).migrate()
+        with self._hold():
+            return sum(shard.migrate() for shard in self.shards.values())
@@ -0,0 +1,466 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import binascii
+import contextlib
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+import six
+
+from eowyn import exceptions as eowyn_exc
+from eowyn.model import manager
+from eowyn.model import records
+
+_MAGIC = b'eowynshm'
+_VERSION = 1
+_HEADER_SIZE = 64
+
+# Header flags. DIRTY is set while a process changes the region, so if it
+# is found set by the next one, the previous one died in the middle of a
+# change. MOVED is set once the region has been replaced by a new file,
+# and DELETED once the topic has no subscription left.
+_DIRTY = 1
+_MOVED = 2
+_DELETED = 4
+
+# Subscription slots: state, digest of the username and offset in the log
+_SLOT = struct.Struct('<B7x16sQ')
+_EMPTY = 0
+_USED = 1
+_REMOVED = 2
+
+_TABLE_CAPACITY = 16
+# Number of locks threads of a process share topics on
+_STRIPES = 64
+
+
+def _digest(name):
+    if isinstance(name, six.text_type):
+        name = name.encode('utf-8')
+    return hashlib.md5(name).digest()
+
+
+def _field(offset, fmt):
+    # A field of the header of a region
+    fmt = '<' + fmt
+
+    def get(self):
+        return struct.unpack_from(fmt, self.map, offset)[0]
+
+    def set(self, value):
+        struct.pack_into(fmt, self.map, offset, value)
+    return property(get, set)
+
+
+class _Region(object):
+    """The file of a topic, mapped in memory
+
+    The file starts with a header, followed by a hash table of
+    subscriptions and by the data area, where messages are appended.
+    Offsets in the log are absolute; base is the offset of the first
+    message in the data area and end the offset after the last one.
+    """
+
+    flags = _field(12, 'I')
+    capacity = _field(16, 'Q')
+    base = _field(24, 'Q')
+    end = _field(32, 'Q')
+    table_capacity = _field(40, 'I')
+    count = _field(44, 'I')
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.map = None
+
+    def lock(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        # The file may have been initialized by another process
+        length = os.fstat(self.fd).st_size
+        if self.map is not None and len(self.map) != length:
+            self.map.close()
+            self.map = None
+        if self.map is None and length:
+            self.map = mmap.mmap(self.fd, length)
+
+    def unlock(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        # Closing the file releases the lock as well
+        if self.map is not None:
+            self.map.close()
+        os.close(self.fd)
+
+    def valid(self):
+        return (self.map is not None and len(self.map) >= _HEADER_SIZE and
+                self.map[:len(_MAGIC)] == _MAGIC)
+
+    def initialize(self, capacity, table_capacity):
+        if self.map is not None:
+            self.map.close()
+        data_start = _HEADER_SIZE + table_capacity * _SLOT.size
+        # Truncating first zeroes the whole file
+        os.ftruncate(self.fd, 0)
+        os.ftruncate(self.fd, data_start + capacity)
+        self.map = mmap.mmap(self.fd, data_start + capacity)
+        struct.pack_into('<I', self.map, len(_MAGIC), _VERSION)
+        self.capacity = capacity
+        self.table_capacity = table_capacity
+        # The region is valid once the magic is written
+        self.map[:len(_MAGIC)] = _MAGIC
+
+    @property
+    def data_start(self):
+        return _HEADER_SIZE + self.table_capacity * _SLOT.size
+
+    def slots(self):
+        """Yield position, digest and offset of the subscriptions"""
+        for index in range(self.table_capacity):
+            position = _HEADER_SIZE + index * _SLOT.size
+            state, digest, offset = _SLOT.unpack_from(self.map, position)
+            if state == _USED:
+                yield position, digest, offset
+
+    def find(self, digest):
+        """Find the slot of a subscription
+
+        :returns: a tuple with the position of the slot of the
+            subscription, None if not found, and the position of the first
+            slot available for it
+        """
+        capacity = self.table_capacity
+        index = struct.unpack_from('<I', digest)[0] % capacity
+        available = None
+        for _ in range(capacity):
+            position = _HEADER_SIZE + index * _SLOT.size
+            state, slot_digest, _ = _SLOT.unpack_from(self.map, position)
+            if state == _EMPTY:
+                return None, available or position
+            if state == _USED and slot_digest == digest:
+                return position, None
+            if state == _REMOVED and available is None:
+                available = position
+            index = (index + 1) % capacity
+        return None, available
+
+    def insert(self, position, digest, offset):
+        # The state is written last, so a half-written slot stays unused
+        struct.pack_into('<16sQ', self.map, position + 8, digest, offset)
+        self.map[position:position + 1] = six.int2byte(_USED)
+        self.count += 1
+
+    def remove(self, position):
+        self.map[position:position + 1] = six.int2byte(_REMOVED)
+        self.count -= 1
+
+    def get_offset(self, position):
+        return _SLOT.unpack_from(self.map, position)[2]
+
+    def set_offset(self, position, offset):
+        struct.pack_into('<Q', self.map, position + _SLOT.size - 8, offset)
+
+    def append(self, data):
+        # Messages are written before moving the end, which commits them
+        start = self.data_start + self.end - self.base
+        self.map[start:start + len(data)] = data
+        self.end += len(data)
+
+    def read(self, offset, count):
+        """Read up to count messages from offset
+
+        :returns: a tuple with the messages and the offset after them
+        """
+        messages = []
+        position = self.data_start + offset - self.base
+        stop = self.data_start + self.end - self.base
+        while position < stop and len(messages) < count:
+            message, position = records.decode(self.map, position)
+            messages.append(message)
+        return messages, position - self.data_start + self.base
+
+    def recover(self):
+        """Restore a consistent state after a process died changing it
+
+        Messages that were not completely written are dropped, and
+        subscriptions are moved to the start of a message.
+        """
+        base = self.base
+        end = min(max(self.end, base), base + self.capacity)
+        slots = sorted(self.slots(), key=lambda slot: slot[2])
+        offset = base
+        index = 0
+        while True:
+            while index < len(slots) and slots[index][2] <= offset:
+                self.set_offset(slots[index][0], offset)
+                index += 1
+            if offset + records.HEADER.size > end:
+                break
+            size = records.size(self.map, self.data_start + offset - base)
+            if offset + size > end:
+                break
+            offset += size
+        self.end = offset
+        for position, _, _ in slots[index:]:
+            self.set_offset(position, offset)
+        self.count = len(slots)
+
+
+class ShmManager(manager.Manager):
+    """Shared memory implementation of a model manager
+
+    Subscriptions and messages are held in memory mapped files, one per
+    topic, in a directory which should live on a tmpfs, like /dev/shm.
+    All the processes that use the same directory share the same
+    subscriptions and messages, without a network round trip, so workers
+    of a uwsgi server on a host may share them. Subscriptions and
+    messages are lost upon host restart.
+
+    Each topic file holds a hash table of subscriptions, which records
+    the offset of the next message for each subscriber, and a log of
+    messages, which are stored once regardless of the number of
+    subscribers. When the log is full, messages read by all subscribers
+    are dropped and the file is rebuilt, with a larger log if needed.
+
+    Files are locked with fcntl locks, which are released by the kernel
+    if the process holding them dies. A process that finds a file left
+    in the middle of a change recovers it, dropping the message being
+    written, if any. Threads of a process share locks striped by topic.
+    Subscribers waiting for messages poll the topic file.
+    """
+
+    shared = True
+
+    def __init__(self, path='/dev/shm/eowyn', size=65536,
+                 poll_interval=0.01):
+        self.path = path
+        # Initial size of the log of a topic, in bytes
+        self.size = int(size)
+        self.poll_interval = float(poll_interval)
+        try:
+            os.makedirs(path)
+        except OSError as ose:
+            if ose.errno != errno.EEXIST:
+                raise
+        # Guards adding and dropping topics, across threads and processes.
+        # It's always acquired before the lock of a topic.
+        self._lock = threading.Lock()
+        self._lock_fd = os.open(os.path.join(path, '.lock'),
+                                os.O_RDWR | os.O_CREAT, 0o600)
+        self._stripes = [threading.Lock() for _ in range(_STRIPES)]
+        # Open regions by digest of the topic
+        self._regions = {}
+
+    def _file(self, digest):
+        return os.path.join(self.path,
+                            binascii.hexlify(digest).decode('ascii'))
+
+    @contextlib.contextmanager
+    def _global_lock(self):
+        with self._lock:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._lock_fd, fcntl.LOCK_UN)
+
+    def _close(self, digest):
+        self._regions.pop(digest).close()
+
+    def _acquire(self, digest, create):
+        # Lock the region of a topic, or return None if there is none
+        while True:
+            region = self._regions.get(digest)
+            fresh = region is None
+            if fresh:
+                flags = os.O_RDWR | (os.O_CREAT if create else 0)
+                try:
+                    fd = os.open(self._file(digest), flags, 0o600)
+                except OSError as ose:
+                    if ose.errno == errno.ENOENT:
+                        return None
+                    raise
+                region = self._regions[digest] = _Region(fd)
+            region.lock()
+            if region.valid() and not region.flags & (_MOVED | _DELETED):
+                if not region.flags & _DIRTY:
+                    return region
+                # The last process holding the region died. If it died
+                # after replacing the file, the region is moved.
+                try:
+                    current = os.stat(self._file(digest)).st_ino
+                except OSError:
+                    current = None
+                if current == os.fstat(region.fd).st_ino:
+                    region.recover()
+                    return region
+            elif fresh and not (region.valid() and region.flags & _MOVED):
+                # A new file, or one left behind by a process which died
+                # while deleting the topic
+                if create:
+                    region.initialize(self.size, _TABLE_CAPACITY)
+                    return region
+                self._close(digest)
+                return None
+            # The region is stale, open the current one
+            self._close(digest)
+
+    @contextlib.contextmanager
+    def _topic(self, topic, create=False):
+        """Lock the region of a topic, None if the topic does not exist"""
+        digest = _digest(topic)
+        stripe = struct.unpack_from('<I', digest)[0] % _STRIPES
+        with self._stripes[stripe]:
+            region = self._acquire(digest, create)
+            if region is not None:
+                region.flags |= _DIRTY
+            try:
+                yield digest, region
+            finally:
+                # The region may have been replaced or closed
+                region = self._regions.get(digest)
+                if region is not None:
+                    region.flags &= ~_DIRTY
+                    region.unlock()
+
+    def _rebuild(self, digest, region, capacity, table_capacity):
+        """Replace a region with a new one, without the messages read
+
+        The new region is written to a new file, which then replaces the
+        current one, so that the current one stays valid until then.
+        """
+        path = self._file(digest)
+        fd = os.open(path + '.tmp', os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        new = _Region(fd)
+        new.lock()
+        new.initialize(capacity, table_capacity)
+        slots = list(region.slots())
+        end = region.end
+        base = min([offset for _, _, offset in slots] or [end])
+        start = region.data_start + base - region.base
+        new.map[new.data_start:new.data_start + end - base] = (
+            region.map[start:start + end - base])
+        new.base = base
+        new.end = end
+        for _, username, offset in slots:
+            new.insert(new.find(username)[1], username, offset)
+        new.flags = _DIRTY
+        os.rename(path + '.tmp', path)
+        region.flags |= _MOVED
+        self._close(digest)
+        self._regions[digest] = new
+        return new
+
+    def _reserve(self, digest, region, size):
+        # Make room for size bytes in the log
+        if region.end - region.base + size <= region.capacity:
+            return region
+        base = min([offset for _, _, offset in region.slots()] or
+                   [region.end])
+        needed = region.end - base + size
+        capacity = region.capacity
+        # Leave room for as many messages as the ones unread
+        while needed * 2 > capacity:
+            capacity *= 2
+        return self._rebuild(digest, region, capacity,
+                             region.table_capacity)
+
+    def create_subscription(self, topic, username):
+        super(ShmManager, self).create_subscription(topic, username)
+        user_digest = _digest(username)
+        with self._global_lock():
+            with self._topic(topic, create=True) as (digest, region):
+                position, available = region.find(user_digest)
+                if position is not None:
+                    raise eowyn_exc.SubscriptionAlreadyExistsException(
+                        topic=topic, username=username)
+                # Keep the hash table at most half full
+                if (region.count + 1) * 2 > region.table_capacity:
+                    region = self._rebuild(digest, region, region.capacity,
+                                           region.table_capacity * 2)
+                    available = region.find(user_digest)[1]
+                region.insert(available, user_digest, region.end)
+        return topic
+
+    def delete_subscription(self, topic, username):
+        super(ShmManager, self).delete_subscription(topic, username)
+        with self._global_lock():
+            with self._topic(topic) as (digest, region):
+                position = region and region.find(_digest(username))[0]
+                if position is None:
+                    raise eowyn_exc.SubscriptionNotFoundException(
+                        topic=topic, username=username)
+                region.remove(position)
+                # If the subscription was the last one, drop the topic
+                if not region.count:
+                    region.flags |= _DELETED
+                    os.unlink(self._file(digest))
+                    self._close(digest)
+        return topic
+
+    def _publish(self, topic, data):
+        with self._topic(topic) as (digest, region):
+            if region is None:
+                raise eowyn_exc.TopicNotFoundException(topic=topic)
+            region = self._reserve(digest, region, len(data))
+            region.append(data)
+
+    def publish_message(self, topic, message):
+        super(ShmManager, self).publish_message(topic, message)
+        self._publish(topic, records.encode(message))
+
+    def publish_messages(self, topic, messages):
+        super(ShmManager, self).publish_messages(topic, messages)
+        self._publish(topic, b''.join(records.encode(m) for m in messages))
+
+    def _pop_now(self, topic, username, max_count):
+        with self._topic(topic) as (_, region):
+            position = region and region.find(_digest(username))[0]
+            if position is None:
+                raise eowyn_exc.SubscriptionNotFoundException(
+                    topic=topic, username=username)
+            messages, offset = region.read(region.get_offset(position),
+                                           max_count)
+            if not messages:
+                raise eowyn_exc.NoMessageFoundException(
+                    topic=topic, username=username)
+            region.set_offset(position, offset)
+            return messages
+
+    def _pop(self, topic, username, max_count, wait):
+        deadline = time.time() + wait
+        while True:
+            try:
+                return self._pop_now(topic, username, max_count)
+            except eowyn_exc.NoMessageFoundException:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise
+                time.sleep(min(remaining, self.poll_interval))
+
+    def pop_message(self, topic, username, wait=0):
+        super(ShmManager, self).pop_message(topic, username, wait)
+        return self._pop(topic, username, 1, wait)[0]
+
+    def pop_messages(self, topic, username, max_count, wait=0):
+        super(ShmManager, self).pop_messages(topic, username, max_count,
+                                             wait)
+        return self._pop(topic, username, max_count, wait)
@@ -0,0 +1,125 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from eowyn import exceptions as eowyn_exc
+
+# Topics are made of segments separated by dots, e.g. orders.eu.paris.
+# Patterns are topics with wildcard segments: ANY matches exactly one
+# segment, and REST, as the last segment, matches one or more, e.g.
+# orders.*.paris and orders.eu.>
+SEPARATOR = '.'
+ANY = '*'
+REST = '>'
+WILDCARDS = (ANY, REST)
+
+
+def is_pattern(topic):
+    """Whether a topic is a pattern, i.e. has wildcard segments"""
+    return any(segment in WILDCARDS
+               for segment in topic.split(SEPARATOR))
+
+
+def validate_pattern(pattern):
+    """Check that wildcards are whole segments, and REST the last one"""
+    segments = pattern.split(SEPARATOR)
+    for index, segment in enumerate(segments):
+        if segment in WILDCARDS:
+            if segment == REST and index < len(segments) - 1:
+                raise eowyn_exc.InvalidDataException(key='topic',
+                                                     value=pattern)
+        elif ANY in segment or REST in segment:
+            raise eowyn_exc.InvalidDataException(key='topic', value=pattern)
+
+
+class _Node(object):
+
+    __slots__ = ('children', 'pattern')
+
+    def __init__(self):
+        self.children = {}
+        # The pattern ending at this node, if any
+        self.pattern = None
+
+
+class TopicTrie(object):
+    """Index of patterns, matched against topics segment by segment
+
+    Each node of the trie is a segment of patterns, so matching a topic
+    walks down one level per segment, following the segment itself and
+    the ANY wildcard, and collects the patterns ending with REST along the
+    way. It costs O(depth) of the topic, times the number of branches
+    followed, which only grows where patterns have ANY wildcards in the
+    same positions, regardless of the number of patterns.
+
+    Matching does not lock the trie, it only looks nodes up, which is
+    safe while another thread adds or removes patterns. Adding and
+    removing patterns must be serialized by the caller.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, pattern):
+        node = self._root
+        for segment in pattern.split(SEPARATOR):
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = _Node()
+            node = child
+        if node.pattern is None:
+            node.pattern = pattern
+            self._count += 1
+
+    def remove(self, pattern):
+        path = [self._root]
+        segments = pattern.split(SEPARATOR)
+        for segment in segments:
+            node = path[-1].children.get(segment)
+            if node is None:
+                return
+            path.append(node)
+        if path[-1].pattern is None:
+            return
+        path[-1].pattern = None
+        self._count -= 1
+        # Prune the nodes no pattern goes through anymore
+        for depth in range(len(segments), 0, -1):
+            if path[depth].children or path[depth].pattern is not None:
+                break
+            del path[depth - 1].children[segments[depth - 1]]
+
+    def match(self, topic):
+        """Patterns matching a topic"""
+        matches = []
+        nodes = [self._root]
+        for segment in topic.split(SEPARATOR):
+            following = []
+            for node in nodes:
+                rest = node.children.get(REST)
+                if rest is not None and rest.pattern is not None:
+                    matches.append(rest.pattern)
+                for key in (segment, ANY):
+                    child = node.children.get(key)
+                    if child is not None:
+                        following.append(child)
+            nodes = following
+            if not nodes:
+                break
+        matches.extend(node.pattern for node in nodes
+                       if node.pattern is not None)
+        return matches
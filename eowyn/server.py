@@ -0,0 +1,374 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Pre-fork server of the Eowyn API
+
+A master process listens on the socket of the server, and forks workers,
+which accept connections on it and serve them on a pool of threads. The
+app, and so the manager, is created by each worker after it's forked, so
+workers share no connections.
+
+The master restarts workers which die, and handles signals:
+
+- SIGTERM and SIGINT stop the workers gracefully, then the master.
+- SIGHUP forks new workers, which load the configuration again, then
+  stops the old ones gracefully.
+
+Workers stopped gracefully no longer accept connections, and finish the
+requests in progress, for up to graceful_timeout seconds. Apps end the
+requests which wait for long once the event in the STOPPING key of their
+environ is set.
+"""
+
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from six.moves import queue
+from werkzeug import serving
+from werkzeug import wsgi
+
+from eowyn import exceptions as eowyn_exc
+
+# Options of the [server] section of the configuration, with their defaults.
+# Several workers require a manager shared across processes, e.g. redis.
+DEFAULTS = {'host': '127.0.0.1',
+            'port': 5000,
+            'workers': 1,
+            'threads': 8,
+            'backlog': 128,
+            'keep_alive': 2,
+            'graceful_timeout': 30}
+
+# Exit code of workers which fail to create the app. The master stops
+# rather than restarting them over and over.
+BOOT_ERROR = 3
+
+# Seconds between checks of the workers by the master
+_TICK = 0.1
+
+# Key of the WSGI environ holding the event set once the server stops
+STOPPING = 'eowyn.stopping'
+
+
+def load_options(section):
+    """Options of the server, from a section of the configuration
+
+    :param section: dict of options, e.g. from config.load_section
+    :returns: a dict of options, with defaults for missing ones
+    :raises: eowyn_exc.InvalidDataException
+    """
+    options = dict(DEFAULTS)
+    for key, value in section.items():
+        if key not in DEFAULTS:
+            continue
+        try:
+            options[key] = type(DEFAULTS[key])(value)
+        except ValueError:
+            raise eowyn_exc.InvalidDataException(key=key, value=value)
+    for key in ('workers', 'threads', 'backlog'):
+        if options[key] < 1:
+            raise eowyn_exc.InvalidDataException(key=key,
+                                                 value=options[key])
+    return options
+
+
+def listen(host, port, backlog):
+    """Listening socket shared by the workers"""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    # Workers wait for connections together, those which lose the race
+    # for one get back to waiting rather than blocking on accept
+    sock.setblocking(False)
+    return sock
+
+
+class _RequestHandler(serving.WSGIRequestHandler):
+    """Keeps connections alive between requests
+
+    Connections are kept alive for up to timeout seconds of inactivity,
+    unless werkzeug closes them, as the 2.1 and later versions do. Kept
+    alive connections hold a thread each, so they are closed when others
+    wait for one.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Responses are written in several parts, which must not wait for the
+    # acknowledgement of the previous ones
+    disable_nagle_algorithm = True
+
+    def handle_one_request(self):
+        # Body of the request, and whether the app is called
+        self._body = None
+        self._responding = False
+        super(_RequestHandler, self).handle_one_request()
+        if self.server.stopping.is_set():
+            self.close_connection = True
+        if self._body is not None and not self.close_connection:
+            # Bodies left unread by the app would be taken for the next
+            # request
+            try:
+                self._body.exhaust()
+            except Exception:
+                self.close_connection = True
+
+    def make_environ(self):
+        environ = super(_RequestHandler, self).make_environ()
+        self._responding = True
+        # Chunked bodies are not drained, their connection is closed
+        length = environ.get('CONTENT_LENGTH') or '0'
+        if length.isdigit() and not environ.get('wsgi.input_terminated'):
+            self._body = wsgi.LimitedStream(environ['wsgi.input'],
+                                            int(length))
+            environ['wsgi.input'] = self._body
+        environ[STOPPING] = self.server.stopping
+        return environ
+
+    def end_headers(self):
+        # Interim responses are sent before the app is called
+        if self._responding and not self.close_connection and (
+                self._body is None or self.server.busy() or
+                self.server.stopping.is_set()):
+            self.send_header('Connection', 'close')
+        super(_RequestHandler, self).end_headers()
+
+    def log_request(self, *args, **kwargs):
+        # Logging each request would slow the server down
+        pass
+
+
+class PooledWSGIServer(serving.BaseWSGIServer):
+    """WSGI server on a listening socket, with a fixed pool of threads
+
+    Accepted connections wait for a thread of the pool. Once all threads
+    are busy and a connection is waiting, the server stops accepting
+    connections, which are left to the other workers.
+    """
+
+    multithread = True
+
+    def __init__(self, app, listener, threads, keep_alive):
+        self.listener = listener
+        handler = type('RequestHandler', (_RequestHandler,),
+                       {'timeout': keep_alive})
+        host, port = listener.getsockname()[:2]
+        super(PooledWSGIServer, self).__init__(host, port, app,
+                                               handler=handler)
+        self._connections = queue.Queue(1)
+        self.stopping = threading.Event()
+        self._threads = [threading.Thread(target=self._work)
+                         for _ in range(threads)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def server_bind(self):
+        # Serve on the listening socket, rather than binding a new one
+        self.socket.close()
+        self.socket = self.listener
+        self.server_address = self.socket.getsockname()
+        self.server_name, self.server_port = self.server_address[:2]
+
+    def server_activate(self):
+        pass
+
+    def busy(self):
+        """Whether a connection waits for a thread"""
+        return not self._connections.empty()
+
+    def process_request(self, request, client_address):
+        self._connections.put((request, client_address))
+
+    def _wake(self):
+        # Once stopping, None is passed from thread to thread, so that all
+        # of them end once no connection is left
+        try:
+            self._connections.put_nowait(None)
+        except queue.Full:
+            # A connection waits, the thread taking it passes None on
+            pass
+
+    def _work(self):
+        while True:
+            connection = self._connections.get()
+            if connection is None:
+                self._wake()
+                return
+            request, client_address = connection
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+            if self.stopping.is_set():
+                self._wake()
+
+    def stop(self, timeout):
+        """Wait up to timeout seconds for the connections in progress
+
+        Must be called once the server no longer accepts connections. Never
+        waits for busy threads longer than timeout.
+        """
+        deadline = time.time() + timeout
+        self.stopping.set()
+        self._wake()
+        for thread in self._threads:
+            thread.join(max(deadline - time.time(), 0))
+
+
+class Master(object):
+    """Master of the workers of a pre-fork server
+
+    :param listener: listening socket, see listen
+    :param make_app: function creating the WSGI app, called by workers
+    :param options: options of the server, see load_options
+    """
+
+    def __init__(self, listener, make_app, options):
+        self.listener = listener
+        self.make_app = make_app
+        self.options = options
+        # Current workers, and old ones stopping, by pid
+        self.workers = set()
+        self.retiring = set()
+        self._signals = []
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            # Workers never return to the caller of the master
+            code = 1
+            try:
+                code = self._serve()
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+        self.workers.add(pid)
+
+    def _serve(self):
+        # Runs in a worker. Interrupts from the terminal reach the master,
+        # which stops the workers.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        try:
+            server = PooledWSGIServer(
+                self.make_app(), self.listener, self.options['threads'],
+                self.options['keep_alive'])
+        except Exception:
+            traceback.print_exc()
+            return BOOT_ERROR
+        server.multiprocess = self.options['workers'] > 1
+
+        def stop(signum, frame):
+            # shutdown waits for serve_forever to return, so it's called
+            # from another thread than the one serving
+            threading.Thread(target=server.shutdown).start()
+        signal.signal(signal.SIGTERM, stop)
+        server.serve_forever()
+        server.stop(self.options['graceful_timeout'])
+        return 0
+
+    def _signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def _stop(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        self.retiring.update(pids)
+        self.workers.difference_update(pids)
+
+    def _reap(self):
+        # Collect the workers which exited, and tell if any of the current
+        # ones failed to boot
+        failed = False
+        while self.workers or self.retiring:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if not pid:
+                break
+            self.retiring.discard(pid)
+            if pid in self.workers:
+                self.workers.discard(pid)
+                code = (os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                        else None)
+                if code == BOOT_ERROR:
+                    failed = True
+        return failed
+
+    def run(self):
+        """Run the workers until the master is stopped
+
+        :returns: the exit code of the master
+        """
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self._signal)
+        code = None
+        while code is None:
+            while self._signals and code is None:
+                if self._signals.pop(0) == signal.SIGHUP:
+                    # New workers first, so that connections are always
+                    # accepted
+                    old = set(self.workers)
+                    for _ in range(self.options['workers']):
+                        self._spawn()
+                    self._stop(old)
+                else:
+                    code = 0
+            if self._reap():
+                sys.stderr.write('Workers failed to boot\n')
+                code = BOOT_ERROR
+            if code is None:
+                while len(self.workers) < self.options['workers']:
+                    self._spawn()
+                time.sleep(_TICK)
+        self._stop(set(self.workers))
+        deadline = time.time() + self.options['graceful_timeout'] + 1
+        while self.retiring and time.time() < deadline:
+            self._reap()
+            time.sleep(_TICK)
+        for pid in self.retiring:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        return code
+
+
+def serve(make_app, options):
+    """Serve the app with pre-forked workers, until stopped
+
+    :param make_app: function creating the WSGI app, called by workers
+    :param options: options of the server, see load_options
+    :returns: the exit code of the master
+    """
+    listener = listen(options['host'], options['port'], options['backlog'])
+    try:
+        return Master(listener, make_app, options).run()
+    finally:
+        listener.close()
@@ -12,7 +12,16 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import gzip
+import io
+import json
+import time
+
+import fixtures
+
 from eowyn import api
+from eowyn import exceptions as eowyn_exc
+from eowyn import metrics
 from eowyn.model import managers
 from eowyn.tests import base
 
@@ -65,6 +74,138 @@ class TestRestAPI(base.TestCase):
         response = self.app.get('/topic/username')
         self.assertEqual(404, response.status_code)
 
+    def test_subscription_get_max(self):
+        messages = ['message%d' % i for i in range(5)]
+        self.app.post('/topic/username')
+        for message in messages:
+            self.app.post('/topic', data=message,
+                          headers={"content-type": "text/plain"})
+        response = self.app.get('/topic/username?max=3')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(messages[:3], json.loads(response.data))
+        response = self.app.get('/topic/username?max=3')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(messages[3:], json.loads(response.data))
+        response = self.app.get('/topic/username?max=3')
+        self.assertEqual(204, response.status_code)
+
+    def test_subscription_get_max_no_subscription(self):
+        response = self.app.get('/topic/username?max=3')
+        self.assertEqual(404, response.status_code)
+
+    def test_subscription_get_max_invalid(self):
+        self.app.post('/topic/username')
+        for max_count in ['0', '-1', 'many']:
+            response = self.app.get('/topic/username?max=%s' % max_count)
+            self.assertEqual(400, response.status_code)
+
+    def test_subscription_get_wait(self):
+        self.app.post('/topic/username')
+        response = self.app.get('/topic/username?wait=1')
+        self.assertEqual(204, response.status_code)
+        self.app.post('/topic', data='message',
+                      headers={"content-type": "text/plain"})
+        response = self.app.get('/topic/username?wait=1&max=2')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['message'], json.loads(response.data))
+
+    def test_subscription_get_wait_max(self):
+        # Waits are capped for workers to stop in time
+        self.useFixture(fixtures.MonkeyPatch('eowyn.api.MAX_WAIT', 0))
+        self.app.post('/topic/username')
+        start = time.time()
+        response = self.app.get('/topic/username?wait=60')
+        self.assertEqual(204, response.status_code)
+        self.assertLess(time.time() - start, 5)
+
+    def test_subscription_get_wait_invalid(self):
+        self.app.post('/topic/username')
+        for wait in ['-1', 'forever']:
+            response = self.app.get('/topic/username?wait=%s' % wait)
+            self.assertEqual(400, response.status_code)
+
+    def get_events(self, path, count, headers=None):
+        # Streams never end, read the first count chunks only
+        self.useFixture(fixtures.MonkeyPatch('eowyn.api.STREAM_KEEPALIVE', 0))
+        response = self.app.get(path, headers=headers, buffered=False)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('text/event-stream', response.mimetype)
+        chunks = iter(response.response)
+        events = [next(chunks) for _ in range(count)]
+        response.close()
+        return events
+
+    def test_subscription_stream(self):
+        self.app.post('/topic/username')
+        for message in ['message', 'message2']:
+            self.app.post('/topic', data=message,
+                          headers={"content-type": "text/plain"})
+        events = self.get_events('/topic/username/stream', 3)
+        self.assertEqual(['id: 1\ndata: message\n\n',
+                          'id: 2\ndata: message2\n\n',
+                          ':\n\n'], events)
+
+    def test_subscription_stream_concurrent_pop(self):
+        # Event IDs are the positions of the messages streamed, even if
+        # another client of the subscription pops meanwhile
+        self.useFixture(fixtures.MonkeyPatch('eowyn.api.STREAM_BATCH', 1))
+        mgr = api.manager
+
+        def concurrent(pop):
+            def wrapper(*args, **kwargs):
+                popped = pop(*args, **kwargs)
+                try:
+                    mgr.pop_message('topic', 'username')
+                except eowyn_exc.NoMessageFoundException:
+                    pass
+                return popped
+            return wrapper
+        for name in ('pop_messages', 'pop_messages_with_position'):
+            self.useFixture(fixtures.MonkeyPatch(
+                'eowyn.api.manager.' + name, concurrent(getattr(mgr, name))))
+        self.app.post('/topic/username')
+        self.app.post('/topic', data='message\nmessage2\nmessage3',
+                      headers={"content-type": api.BATCH_CONTENT_TYPE})
+        events = self.get_events('/topic/username/stream', 2)
+        self.assertEqual(['id: 1\ndata: message\n\n',
+                          'id: 3\ndata: message3\n\n'], events)
+
+    def test_subscription_stream_multiline(self):
+        self.app.post('/topic/username')
+        self.app.post('/topic', data='first\nsecond',
+                      headers={"content-type": "text/plain"})
+        events = self.get_events('/topic/username/stream', 1)
+        self.assertEqual(['id: 1\ndata: first\ndata: second\n\n'], events)
+
+    def test_subscription_stream_resume(self):
+        self.app.post('/topic/username')
+        for message in ['message', 'message2']:
+            self.app.post('/topic', data=message,
+                          headers={"content-type": "text/plain"})
+        self.get_events('/topic/username/stream', 2)
+        events = self.get_events('/topic/username/stream', 1,
+                                 headers={'Last-Event-ID': '1'})
+        self.assertEqual(['id: 2\ndata: message2\n\n'], events)
+
+    def test_subscription_stream_resume_invalid(self):
+        self.app.post('/topic/username')
+        response = self.app.get('/topic/username/stream',
+                                headers={'Last-Event-ID': 'last'})
+        self.assertEqual(400, response.status_code)
+
+    def test_subscription_stream_no_subscription(self):
+        response = self.app.get('/topic/username/stream')
+        self.assertEqual(404, response.status_code)
+
+    def test_subscription_stream_deleted(self):
+        self.app.post('/topic/username')
+        self.useFixture(fixtures.MonkeyPatch('eowyn.api.STREAM_KEEPALIVE', 0))
+        response = self.app.get('/topic/username/stream', buffered=False)
+        chunks = iter(response.response)
+        self.assertEqual(':\n\n', next(chunks))
+        self.app.delete('/topic/username')
+        self.assertEqual([], list(chunks))
+
     def test_subscription_post(self):
         response = self.app.post('/topic/username')
         self.assertEqual(200, response.status_code)
@@ -76,6 +217,72 @@ class TestRestAPI(base.TestCase):
         self.assertEqual(201, response.status_code)
         self.assertEqual(0, len(cleanup_message(response.data)))
 
+    def test_subscription_post_reserved(self):
+        response = self.app.post('/_topic/username')
+        self.assertEqual(400, response.status_code)
+
+    def test_user_topics(self):
+        self.app.post('/topic/username')
+        response = self.app.post('/_user/username/topics',
+                                 data='topic\ntopic2\ntopic3\n')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'subscribed': ['topic2', 'topic3']},
+                         json.loads(response.data))
+        response = self.app.get('/_user/username/topics')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['topic', 'topic2', 'topic3'],
+                         json.loads(response.data))
+        response = self.app.delete('/_user/username/topics')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'unsubscribed': ['topic', 'topic2', 'topic3']},
+                         json.loads(response.data))
+        response = self.app.get('/topic2/username')
+        self.assertEqual(404, response.status_code)
+
+    def test_user_topics_errors(self):
+        response = self.app.post('/_user/username/topics', data='')
+        self.assertEqual(400, response.status_code)
+        response = self.app.post('/_user/username/topics',
+                                 data='topic\n_topic')
+        self.assertEqual(400, response.status_code)
+        response = self.app.post('/_user/username/topics',
+                                 data=b'topic\n\xfe')
+        self.assertEqual(400, response.status_code)
+        response = self.app.get('/_user/username/topics')
+        self.assertEqual([], json.loads(response.data))
+
+    def test_user_topics_not_supported(self):
+        path = self.useFixture(fixtures.TempDir()).path
+        api.manager = managers.get_manager(name='file', path=path)
+        for method in (self.app.get, self.app.post, self.app.delete):
+            response = method('/_user/username/topics', data='topic')
+            self.assertEqual(501, response.status_code)
+
+    def test_user_messages(self):
+        self.app.post('/_user/username/topics', data='topic\ntopic2')
+        self.app.post('/topic', data='message',
+                      headers={"content-type": "text/plain"})
+        self.app.post('/topic2', data='message2',
+                      headers={"content-type": "text/plain"})
+        response = self.app.get('/_user/username?max=1')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([{'topic': 'topic', 'message': 'message'}],
+                         json.loads(response.data))
+        response = self.app.get('/_user/username?wait=1')
+        self.assertEqual([{'topic': 'topic2', 'message': 'message2'}],
+                         json.loads(response.data))
+        response = self.app.get('/_user/username')
+        self.assertEqual(204, response.status_code)
+
+    def test_user_messages_errors(self):
+        for query in ('max=0', 'max=x', 'wait=-1'):
+            response = self.app.get('/_user/username?' + query)
+            self.assertEqual(400, response.status_code)
+        path = self.useFixture(fixtures.TempDir()).path
+        api.manager = managers.get_manager(name='file', path=path)
+        response = self.app.get('/_user/username')
+        self.assertEqual(501, response.status_code)
+
     def test_subscription_delete(self):
         self.app.post('/topic/username')
         response = self.app.delete('/topic/username')
@@ -120,3 +327,162 @@ class TestRestAPI(base.TestCase):
                                  headers={"content-type": "text/plain"})
         self.assertEqual(200, response.status_code)
         self.assertEqual(0, len(cleanup_message(response.data)))
+
+    def test_message_post_queue_full(self):
+        api.manager = managers.get_manager(name='simple', max_length=1,
+                                           overflow='reject')
+        self.app.post('/topic/username')
+        self.app.post('/topic', data='message',
+                      headers={"content-type": "text/plain"})
+        response = self.app.post('/topic', data='message2',
+                                 headers={"content-type": "text/plain"})
+        self.assertEqual(503, response.status_code)
+        self.assertIn('username', response.data)
+
+    def test_message_post_pattern(self):
+        self.app.post('/orders.*.paris/username')
+        response = self.app.post('/orders.eu.paris', data='message',
+                                 headers={"content-type": "text/plain"})
+        self.assertEqual(200, response.status_code)
+        response = self.app.get('/orders.*.paris/username')
+        self.assertEqual('message', cleanup_message(response.data))
+        # Messages are not published to patterns
+        response = self.app.post('/orders.*.paris', data='message',
+                                 headers={"content-type": "text/plain"})
+        self.assertEqual(400, response.status_code)
+
+    def test_subscription_leases(self):
+        self.app.post('/topic/username')
+        self.app.post('/topic', data='message0\nmessage1',
+                      headers={"content-type": api.BATCH_CONTENT_TYPE})
+        response = self.app.post('/topic/username/leases?max=5')
+        self.assertEqual(200, response.status_code)
+        leased = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(['message0', 'message1'],
+                         [item['message'] for item in leased])
+        response = self.app.post('/topic/username/leases')
+        self.assertEqual(204, response.status_code)
+        response = self.app.post(
+            '/topic/username/acks',
+            data='\n'.join(item['lease'] for item in leased))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'acked': 2},
+                         json.loads(response.data.decode('utf-8')))
+
+    def test_subscription_leases_errors(self):
+        response = self.app.post('/topic/username/leases')
+        self.assertEqual(404, response.status_code)
+        self.app.post('/topic/username')
+        response = self.app.post('/topic/username/leases?visibility=0')
+        self.assertEqual(400, response.status_code)
+        for max_count in (0, -1):
+            response = self.app.post(
+                '/topic/username/leases?max=%d' % max_count)
+            self.assertEqual(400, response.status_code)
+        response = self.app.post('/topic/username/acks', data='')
+        self.assertEqual(400, response.status_code)
+        response = self.app.post('/topic/username/acks', data=b'\xfe')
+        self.assertEqual(400, response.status_code)
+
+    def test_subscription_leases_not_supported(self):
+        path = self.useFixture(fixtures.TempDir()).path
+        api.manager = managers.get_manager(name='file', path=path)
+        self.app.post('/topic/username')
+        response = self.app.post('/topic/username/leases')
+        self.assertEqual(501, response.status_code)
+
+    def test_metrics(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'eowyn.metrics._sampled', {'time': None}))
+        self.app.post('/topic/username')
+        self.app.post('/topic', data='message',
+                      headers={"content-type": "text/plain"})
+        response = self.app.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(metrics.CONTENT_TYPE, response.content_type)
+        text = response.data.decode('utf-8')
+        self.assertIn('eowyn_http_request_duration_seconds_count{'
+                      'route="/<string:topic>",method="POST",status="200"}',
+                      text)
+        self.assertIn('eowyn_queued_messages{topic="topic"} 1\n', text)
+
+    def test_metrics_topic(self):
+        # Messages may still be published to a topic named metrics
+        self.app.post('/metrics/username')
+        response = self.app.post('/metrics', data='message',
+                                 headers={"content-type": "text/plain"})
+        self.assertEqual(200, response.status_code)
+        response = self.app.get('/metrics/username')
+        self.assertEqual('message', cleanup_message(response.data))
+
+    def test_message_compressed(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'eowyn.api.COMPRESS_THRESHOLD', 100))
+        message = json.dumps({'cats': ['cute'] * 100})
+        self.app.post('/topic/username')
+        for i in range(2):
+            self.app.post('/topic', data=message,
+                          headers={"content-type": "text/plain"})
+        # Stored compressed
+        stored = api.manager.topics['topic'].log.read(0)[0]
+        self.assertLess(len(stored), len(message) / 4)
+        response = self.app.get('/topic/username',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual(
+            message,
+            json.loads(gzip.GzipFile(fileobj=io.BytesIO(response.data))
+                       .read()))
+        response = self.app.get('/topic/username')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(message, json.loads(response.data))
+
+    def test_message_not_text(self):
+        # Bodies which could be taken for compressed entries, or that can't
+        # be sent as JSON strings, are rejected rather than lost
+        self.useFixture(fixtures.MonkeyPatch(
+            'eowyn.api.COMPRESS_THRESHOLD', 4))
+        self.app.post('/topic/username')
+        for content_type in ('text/plain', api.BATCH_CONTENT_TYPE):
+            for body in (b'\xffg not gzip', b'message\n\xfe'):
+                response = self.app.post(
+                    '/topic', data=body,
+                    headers={"content-type": content_type})
+                self.assertEqual(400, response.status_code)
+        response = self.app.get('/topic/username')
+        self.assertEqual(204, response.status_code)
+
+    def test_message_compressed_batch(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'eowyn.api.COMPRESS_THRESHOLD', 100))
+        messages = ['small', json.dumps({'cats': ['cute'] * 100})]
+        self.app.post('/topic/username')
+        self.app.post('/topic', data='\n'.join(messages),
+                      headers={"content-type": api.BATCH_CONTENT_TYPE})
+        response = self.app.get('/topic/username?max=10',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(messages, json.loads(response.data))
+
+    def test_message_post_batch(self):
+        self.app.post('/topic/username')
+        messages = ['message%d' % i for i in range(5)]
+        response = self.app.post(
+            '/topic', data='\n'.join(messages) + '\n',
+            headers={"content-type": api.BATCH_CONTENT_TYPE})
+        self.assertEqual(200, response.status_code)
+        response = self.app.get('/topic/username?max=10')
+        self.assertEqual(messages, json.loads(response.data))
+
+    def test_message_post_batch_empty(self):
+        self.app.post('/topic/username')
+        response = self.app.post(
+            '/topic', data='\n', headers={"content-type":
+                                          api.BATCH_CONTENT_TYPE})
+        self.assertEqual(400, response.status_code)
+
+    def test_message_post_batch_no_subscription(self):
+        response = self.app.post(
+            '/topic', data='message\nmessage2',
+            headers={"content-type": api.BATCH_CONTENT_TYPE})
+        self.assertEqual(200, response.status_code)
@@ -0,0 +1,258 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+
+import fixtures
+import mock
+import six
+
+from eowyn import server
+from eowyn.tests import base
+
+if six.PY3:
+    import asyncio
+
+    from aiohttp import test_utils
+
+    from eowyn import async_api
+    from eowyn.model import async_managers
+
+
+class TestAsyncRestAPI(base.TestCase):
+
+    def setUp(self):
+        super(TestAsyncRestAPI, self).setUp()
+        if six.PY2:
+            self.skipTest('The asynchronous API requires Python 3')
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        # Use the simple manager for API testing, so we may run
+        # API tests even without a Redis DB available
+        async_api.manager = async_managers.get_manager(name='simple')
+        self.client = test_utils.TestClient(
+            test_utils.TestServer(async_api.create_app(), loop=self.loop),
+            loop=self.loop)
+        self.run_async(self.client.start_server())
+        self.addCleanup(self.run_async, self.client.close())
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def request(self, method, path, **kwargs):
+        response = self.run_async(self.client.request(method, path, **kwargs))
+        return response.status, self.run_async(response.read())
+
+    def test_metrics(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'eowyn.metrics._sampled', {'time': None}))
+        self.request('POST', '/topic/username')
+        self.request('POST', '/topic', data='message',
+                     headers={"content-type": "text/plain"})
+        status, body = self.request('GET', '/metrics')
+        self.assertEqual(200, status)
+        text = body.decode('utf-8')
+        self.assertIn('eowyn_http_request_duration_seconds_count{'
+                      'route="/{topic}",method="POST",status="200"}', text)
+        self.assertIn('eowyn_queued_messages{topic="topic"} 1\n', text)
+
+    def test_subscription_get(self):
+        self.request('POST', '/topic/username')
+        self.request('POST', '/topic', data='message',
+                     headers={"content-type": "text/plain"})
+        status, body = self.request('GET', '/topic/username')
+        self.assertEqual(200, status)
+        self.assertEqual(b'"message"', body)
+
+    def test_subscription_get_no_message(self):
+        self.request('POST', '/topic/username')
+        status, body = self.request('GET', '/topic/username')
+        self.assertEqual(204, status)
+        self.assertEqual(b'', body)
+
+    def test_subscription_get_no_subscription(self):
+        status, _ = self.request('GET', '/topic/username')
+        self.assertEqual(404, status)
+
+    def test_subscription_get_max(self):
+        self.request('POST', '/topic/username')
+        self.request('POST', '/topic', data='first\nsecond\nthird',
+                     headers={"content-type": async_api.BATCH_CONTENT_TYPE})
+        status, body = self.request('GET', '/topic/username?max=2')
+        self.assertEqual(200, status)
+        self.assertEqual(b'["first", "second"]', body)
+
+    def test_subscription_get_max_invalid(self):
+        self.request('POST', '/topic/username')
+        status, _ = self.request('GET', '/topic/username?max=foo')
+        self.assertEqual(400, status)
+
+    def test_subscription_get_wait(self):
+        self.request('POST', '/topic/username')
+        self.loop.call_later(0.1, asyncio.ensure_future,
+                             async_api.manager.publish_message(
+                                 'topic', b'message'))
+        status, body = self.request('GET', '/topic/username?wait=10')
+        self.assertEqual(200, status)
+        self.assertEqual(b'"message"', body)
+
+    def test_subscription_post_duplicate(self):
+        status, _ = self.request('POST', '/topic/username')
+        self.assertEqual(200, status)
+        status, _ = self.request('POST', '/topic/username')
+        self.assertEqual(201, status)
+
+    def test_message_not_text(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'eowyn.async_api.COMPRESS_THRESHOLD', 4))
+        self.request('POST', '/topic/username')
+        for content_type in ('text/plain', async_api.BATCH_CONTENT_TYPE):
+            for body in (b'\xffg not gzip', b'message\n\xfe'):
+                status, _ = self.request(
+                    'POST', '/topic', data=body,
+                    headers={"content-type": content_type})
+                self.assertEqual(400, status)
+        status, _ = self.request('GET', '/topic/username')
+        self.assertEqual(204, status)
+
+    def test_subscription_post_reserved(self):
+        status, _ = self.request('POST', '/_topic/username')
+        self.assertEqual(400, status)
+
+    def test_user_topics(self):
+        self.request('POST', '/topic/username')
+        status, body = self.request('POST', '/_user/username/topics',
+                                    data='topic\ntopic2\ntopic3\n')
+        self.assertEqual(200, status)
+        self.assertEqual({'subscribed': ['topic2', 'topic3']},
+                         json.loads(body.decode('utf-8')))
+        status, body = self.request('GET', '/_user/username/topics')
+        self.assertEqual(200, status)
+        self.assertEqual(['topic', 'topic2', 'topic3'],
+                         json.loads(body.decode('utf-8')))
+        status, body = self.request('DELETE', '/_user/username/topics')
+        self.assertEqual(200, status)
+        self.assertEqual({'unsubscribed': ['topic', 'topic2', 'topic3']},
+                         json.loads(body.decode('utf-8')))
+        status, _ = self.request('GET', '/topic2/username')
+        self.assertEqual(404, status)
+
+    def test_user_topics_errors(self):
+        for body in (b'', b'topic\n_topic', b'topic\n\xfe'):
+            status, _ = self.request('POST', '/_user/username/topics',
+                                     data=body)
+            self.assertEqual(400, status)
+        status, body = self.request('GET', '/_user/username/topics')
+        self.assertEqual([], json.loads(body.decode('utf-8')))
+
+    def test_user_messages(self):
+        self.request('POST', '/_user/username/topics', data='topic\ntopic2')
+        self.request('POST', '/topic', data='message',
+                     headers={"content-type": "text/plain"})
+        self.loop.call_later(0.1, asyncio.ensure_future,
+                             async_api.manager.publish_message(
+                                 'topic2', b'message2'))
+        status, body = self.request('GET', '/_user/username?max=1')
+        self.assertEqual(200, status)
+        self.assertEqual([{'topic': 'topic', 'message': 'message'}],
+                         json.loads(body.decode('utf-8')))
+        status, body = self.request('GET', '/_user/username?wait=10')
+        self.assertEqual([{'topic': 'topic2', 'message': 'message2'}],
+                         json.loads(body.decode('utf-8')))
+        status, _ = self.request('GET', '/_user/username')
+        self.assertEqual(204, status)
+        for query in ('max=0', 'max=x', 'wait=-1'):
+            status, _ = self.request('GET', '/_user/username?' + query)
+            self.assertEqual(400, status)
+
+    def test_subscription_delete_no_subscription(self):
+        status, _ = self.request('DELETE', '/topic/username')
+        self.assertEqual(404, status)
+
+    def test_subscription_stream(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'eowyn.async_api.STREAM_KEEPALIVE', 1))
+        self.request('POST', '/topic/username')
+        self.request('POST', '/topic', data='first\nsecond',
+                     headers={"content-type": async_api.BATCH_CONTENT_TYPE})
+        response = self.run_async(self.client.get('/topic/username/stream'))
+        self.assertEqual('text/event-stream', response.content_type)
+        events = [self.run_async(response.content.readuntil(b'\n\n'))
+                  for _ in range(2)]
+        # The stream ends once the subscription is deleted
+        self.request('DELETE', '/topic/username')
+        self.run_async(response.read())
+        self.assertEqual([b'id: 1\ndata: first\n\n',
+                          b'id: 2\ndata: second\n\n'], events)
+
+    def test_message_compressed(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'eowyn.async_api.COMPRESS_THRESHOLD', 100))
+        message = json.dumps({'cats': ['cute'] * 100})
+        self.request('POST', '/topic/username')
+        for i in range(3):
+            self.request('POST', '/topic', data=message,
+                         headers={"content-type": "text/plain"})
+        # The client decompresses the body it accepted as gzip
+        response = self.run_async(self.client.request(
+            'GET', '/topic/username', headers={'Accept-Encoding': 'gzip'}))
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual(message, self.run_async(response.json()))
+        status, body = self.request(
+            'GET', '/topic/username', headers={'Accept-Encoding': 'identity'})
+        self.assertEqual(message, json.loads(body.decode('utf-8')))
+        status, body = self.request('GET', '/topic/username?max=10')
+        self.assertEqual([message], json.loads(body.decode('utf-8')))
+
+    def test_message_post_no_subscription(self):
+        status, _ = self.request('POST', '/topic', data='message',
+                                 headers={"content-type": "text/plain"})
+        self.assertEqual(200, status)
+
+
+class TestAsyncMain(base.TestCase):
+
+    def setUp(self):
+        super(TestAsyncMain, self).setUp()
+        if six.PY2:
+            self.skipTest('The asynchronous API requires Python 3')
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        self.config = os.path.join(tempdir, 'api.conf')
+        self.run_app = mock.Mock()
+        self.useFixture(fixtures.MonkeyPatch('aiohttp.web.run_app',
+                                             self.run_app))
+        self.useFixture(fixtures.MonkeyPatch(
+            'sys.argv', ['eowyn-async-api', self.config]))
+        self.addCleanup(setattr, async_api, 'manager', async_api.manager)
+
+    def test_main(self):
+        with open(self.config, 'w') as config:
+            config.write('[default]\nmanager = simple\ndebug = false\n\n'
+                         '[simple]\n\n[server]\nhost = 0.0.0.0\n'
+                         'port = 8080\ngraceful_timeout = 5\n')
+        async_api.main()
+        kwargs = self.run_app.call_args[1]
+        self.assertEqual('0.0.0.0', kwargs['host'])
+        self.assertEqual(8080, kwargs['port'])
+        self.assertEqual(5, kwargs['shutdown_timeout'])
+
+    def test_main_defaults(self):
+        with open(self.config, 'w') as config:
+            config.write('[default]\nmanager = simple\ndebug = false\n\n'
+                         '[simple]\n')
+        async_api.main()
+        kwargs = self.run_app.call_args[1]
+        self.assertEqual(server.DEFAULTS['host'], kwargs['host'])
+        self.assertEqual(server.DEFAULTS['port'], kwargs['port'])
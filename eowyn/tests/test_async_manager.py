@@ -0,0 +1,230 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+
+import six
+import testtools
+
+from eowyn import exceptions as eowyn_exc
+from eowyn.tests import base
+
+if six.PY3:
+    import asyncio
+
+    from eowyn.model import async_manager
+
+
+class TestAsyncSimpleManager(base.TestCase):
+
+    def setUp(self):
+        super(TestAsyncSimpleManager, self).setUp()
+        if six.PY2:
+            self.skipTest('Asynchronous managers require Python 3')
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.mgr = self.get_manager()
+
+    # Options of managers supporting patterns
+    pattern_options = {}
+
+    def get_manager(self, **kwargs):
+        return async_manager.AsyncSimpleManager(**kwargs)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def publish_later(self, topic, message, delay=0.1):
+        self.loop.call_later(delay, asyncio.ensure_future,
+                             self.mgr.publish_message(topic, message))
+
+    def test_create_subscription_exists(self):
+        self.run_async(self.mgr.create_subscription('topic', 'username'))
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionAlreadyExistsException):
+            self.run_async(self.mgr.create_subscription('topic', 'username'))
+
+    def test_create_subscription_invalid_data(self):
+        with testtools.ExpectedException(eowyn_exc.InvalidDataException):
+            self.run_async(self.mgr.create_subscription(None, 'username'))
+
+    def test_create_subscription_reserved(self):
+        with testtools.ExpectedException(eowyn_exc.InvalidDataException):
+            self.run_async(self.mgr.create_subscription('_user', 'username'))
+
+    def test_user_topics(self):
+        self.run_async(self.mgr.create_subscription('topic', 'username'))
+        self.assertEqual(['topic2', 'topic3'], self.run_async(
+            self.mgr.create_subscriptions(
+                'username', ['topic', 'topic2', 'topic3'])))
+        self.assertEqual(['topic', 'topic2', 'topic3'], self.run_async(
+            self.mgr.get_topics('username')))
+        self.assertEqual(['topic', 'topic2', 'topic3'], self.run_async(
+            self.mgr.delete_subscriptions('username')))
+        self.assertEqual([], self.run_async(self.mgr.get_topics('username')))
+        self.assertEqual([], self.run_async(
+            self.mgr.delete_subscriptions('username')))
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            self.run_async(self.mgr.pop_message('topic2', 'username'))
+
+    def test_pop_user_messages(self):
+        self.run_async(self.mgr.create_subscriptions(
+            'username', ['topic', 'topic2', 'topic3']))
+        self.run_async(self.mgr.publish_messages('topic3', [b'm0', b'm1']))
+        self.run_async(self.mgr.publish_message('topic', b'm2'))
+        self.assertEqual([('topic', b'm2'), ('topic3', b'm0')],
+                         self.run_async(
+                             self.mgr.pop_user_messages('username', 2)))
+        self.assertEqual([('topic3', b'm1')], self.run_async(
+            self.mgr.pop_user_messages('username', 10)))
+        with testtools.ExpectedException(eowyn_exc.NoMessageFoundException):
+            self.run_async(self.mgr.pop_user_messages('username', 10))
+
+    def test_pop_user_messages_wait(self):
+        self.run_async(self.mgr.create_subscriptions(
+            'username', ['topic', 'topic2']))
+        self.run_async(self.mgr.create_subscription('topic', 'username2'))
+        self.publish_later('topic2', b'message')
+        start = time.time()
+        self.assertEqual([('topic2', b'message')], self.run_async(
+            self.mgr.pop_user_messages('username', 10, wait=10)))
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual({}, self.mgr.waiters.events)
+
+    def test_pop_user_messages_wait_timeout(self):
+        self.run_async(self.mgr.create_subscription('topic', 'username'))
+        with testtools.ExpectedException(eowyn_exc.NoMessageFoundException):
+            self.run_async(self.mgr.pop_user_messages('username', 10,
+                                                      wait=1))
+
+    def test_delete_subscription(self):
+        self.run_async(self.mgr.create_subscription('topic', 'username'))
+        self.run_async(self.mgr.delete_subscription('topic', 'username'))
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            self.run_async(self.mgr.pop_message('topic', 'username'))
+
+    def test_publish_message_queue_full(self):
+        mgr = self.get_manager(max_length=1, overflow='reject')
+        self.run_async(mgr.create_subscription('topic', 'username'))
+        self.run_async(mgr.publish_message('topic', b'message'))
+        with testtools.ExpectedException(eowyn_exc.QueueFullException):
+            self.run_async(mgr.publish_message('topic', b'message2'))
+        self.assertEqual(1, self.run_async(
+            mgr.get_dropped('topic', 'username')))
+
+    def test_get_queue_depths(self):
+        self.run_async(self.mgr.create_subscription('topic', 'username'))
+        self.run_async(self.mgr.create_subscription('topic', 'username2'))
+        self.run_async(self.mgr.publish_messages('topic', [b'm0', b'm1']))
+        self.run_async(self.mgr.pop_message('topic', 'username'))
+        self.assertEqual({'topic': {'username': 1, 'username2': 2}},
+                         self.run_async(self.mgr.get_queue_depths(10)))
+
+    def test_delete_subscription_non_existent(self):
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            self.run_async(self.mgr.delete_subscription('topic', 'username'))
+
+    def test_publish_message_no_topic(self):
+        with testtools.ExpectedException(eowyn_exc.TopicNotFoundException):
+            self.run_async(self.mgr.publish_message('topic', b'message'))
+
+    def test_pop_message(self):
+        self.run_async(self.mgr.create_subscription('topic', 'username'))
+        self.run_async(self.mgr.publish_message('topic', b'message'))
+        self.assertEqual(b'message', self.run_async(
+            self.mgr.pop_message('topic', 'username')))
+        with testtools.ExpectedException(eowyn_exc.NoMessageFoundException):
+            self.run_async(self.mgr.pop_message('topic', 'username'))
+
+    def test_pop_messages(self):
+        messages = [b'message%d' % i for i in range(5)]
+        self.run_async(self.mgr.create_subscription('topic', 'username'))
+        self.run_async(self.mgr.publish_messages('topic', messages))
+        self.assertEqual(messages[:3], self.run_async(
+            self.mgr.pop_messages('topic', 'username', 3)))
+        self.assertEqual(messages[3:], self.run_async(
+            self.mgr.pop_messages('topic', 'username', 3)))
+
+    def test_pop_messages_with_position(self):
+        self.run_async(self.mgr.create_subscription('topic', 'username'))
+        self.run_async(self.mgr.publish_message('topic', b'message'))
+        popped = self.run_async(self.mgr.pop_messages_with_position(
+            'topic', 'username', 2))
+        if popped is None:
+            self.skipTest('Manager does not track positions')
+        self.assertEqual(([b'message'], self.run_async(
+            self.mgr.get_position('topic', 'username'))), popped)
+        self.publish_later('topic', b'message2')
+        self.assertEqual(([b'message2'], popped[1] + 1), self.run_async(
+            self.mgr.pop_messages_with_position('topic', 'username', 2,
+                                                wait=10)))
+
+    def test_pop_message_no_subscription(self):
+        self.run_async(self.mgr.create_subscription('topic', 'someone_else'))
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            self.run_async(self.mgr.pop_message('topic', 'username', wait=10))
+
+    def test_pop_message_wait(self):
+        self.run_async(self.mgr.create_subscription('topic', 'username'))
+        self.publish_later('topic', b'message')
+        start = time.time()
+        self.assertEqual(b'message', self.run_async(
+            self.mgr.pop_message('topic', 'username', wait=10)))
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual({}, self.mgr.waiters.events)
+
+    def test_pop_message_wait_many(self):
+        usernames = ['username%d' % i for i in range(100)]
+        for username in usernames:
+            self.run_async(self.mgr.create_subscription('topic', username))
+        self.publish_later('topic', b'message')
+        pops = [self.loop.create_task(
+            self.mgr.pop_message('topic', username, wait=10))
+            for username in usernames]
+        messages = self.run_async(asyncio.gather(*pops))
+        self.assertEqual([b'message'] * 100, messages)
+
+    def test_pop_message_wait_pattern(self):
+        mgr = self.get_manager(**self.pattern_options)
+        self.run_async(mgr.create_subscription('topic.>', 'username'))
+        self.loop.call_later(0.1, asyncio.ensure_future,
+                             mgr.publish_message('topic.a', b'message'))
+        self.assertEqual(b'message', self.run_async(
+            mgr.pop_message('topic.>', 'username', wait=10)))
+
+    def test_pop_message_wait_timeout(self):
+        self.run_async(self.mgr.create_subscription('topic', 'username'))
+        start = time.time()
+        with testtools.ExpectedException(eowyn_exc.NoMessageFoundException):
+            self.run_async(self.mgr.pop_message('topic', 'username', wait=1))
+        self.assertGreaterEqual(time.time() - start, 0.9)
+        self.assertEqual({}, self.mgr.waiters.events)
+
+    def test_rewind(self):
+        self.run_async(self.mgr.create_subscription('topic', 'username'))
+        self.run_async(self.mgr.create_subscription('topic', 'username2'))
+        self.run_async(self.mgr.publish_messages(
+            'topic', [b'message', b'message2']))
+        self.run_async(self.mgr.pop_messages('topic', 'username', 2))
+        position = self.run_async(self.mgr.get_position('topic', 'username'))
+        if position is None:
+            self.skipTest('Manager does not track positions')
+        self.assertTrue(self.run_async(
+            self.mgr.rewind('topic', 'username', position - 1)))
+        self.assertEqual(b'message2', self.run_async(
+            self.mgr.pop_message('topic', 'username')))
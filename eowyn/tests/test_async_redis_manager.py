@@ -0,0 +1,68 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import redis
+import six
+
+from eowyn.model import redis_manager
+from eowyn.tests import test_async_manager
+
+if six.PY3:
+    import asyncio
+
+    from eowyn.model import async_redis_manager
+
+
+class TestAsyncRedisManager(test_async_manager.TestAsyncSimpleManager):
+
+    def setUp(self):
+        super(TestAsyncRedisManager, self).setUp()
+        try:
+            self.run_async(self.mgr.store.flushdb())
+        except redis.exceptions.ConnectionError as ce:
+            msg = "Redis server not available: %s" % str(ce)
+            self.skipTest(msg)
+        self.addCleanup(self.run_async, self.mgr.store.flushdb())
+
+    pattern_options = {'patterns': True}
+
+    def get_manager(self, **kwargs):
+        # Test require a local redis server running on the standard port
+        # We use db 1 just in case the local db 0 is used for real data
+        mgr = async_redis_manager.AsyncRedisManager(db=1, **kwargs)
+        self.addCleanup(self.run_async, mgr.store.aclose())
+        return mgr
+
+    def test_pop_message_wait_other_manager(self):
+        # Messages published by another process wake subscribers up
+        other = self.get_manager()
+        self.run_async(self.mgr.create_subscription('topic', 'username'))
+        self.loop.call_later(0.1, asyncio.ensure_future,
+                             other.publish_message('topic', b'message'))
+        self.assertEqual(b'message', self.run_async(
+            self.mgr.pop_message('topic', 'username', wait=10)))
+        self.assertEqual({}, self.mgr._watched)
+
+    def test_pop_user_messages_wait_other_manager(self):
+        # Users are woken up by the publish scripts of other processes
+        other = self.get_manager()
+        self.run_async(self.mgr.create_subscriptions(
+            'username', ['topic', 'topic2']))
+        self.loop.call_later(0.1, asyncio.ensure_future,
+                             other.publish_message('topic2', b'message'))
+        self.assertEqual([('topic2', b'message')], self.run_async(
+            self.mgr.pop_user_messages('username', 10, wait=10)))
+        self.assertEqual({}, self.mgr._watched)
+        self.assertEqual([], self.run_async(self.mgr.store.keys(
+            redis_manager.READY + '*/waiting')))
@@ -0,0 +1,148 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import random
+
+import fixtures
+
+from eowyn.benchmarks import load
+from eowyn.benchmarks import patterns
+from eowyn.benchmarks import run
+from eowyn import exceptions as eowyn_exc
+from eowyn.model import manager
+from eowyn.model import topics
+from eowyn.tests import base
+
+
+class TestBenchmarks(base.TestCase):
+
+    scenario = load.Scenario(topics=3, fanout=2, publishers=2,
+                             subscribers=3, messages=20, size=64,
+                             publish_batch=3, pop_batch=5, timeout=10)
+
+    def check_results(self, results):
+        self.assertEqual(40, results['published'])
+        # Each message is delivered to the two subscribers of its topic
+        self.assertEqual(80, results['delivered'])
+        self.assertEqual(0, results['lost'])
+        self.assertEqual(14, results['latency']['publish']['count'])
+        self.assertEqual(80, results['latency']['delivery']['count'])
+        for statistic in ('mean', 'p50', 'p90', 'p99', 'max'):
+            self.assertGreaterEqual(
+                results['latency']['delivery'][statistic], 0)
+
+    def test_plan(self):
+        scenario = load.Scenario(topics=2, messages=5, publish_batch=2)
+        self.assertEqual([(1, 2), (0, 2), (1, 1)], scenario.plan(1))
+
+    def test_message(self):
+        message = load.make_message(100)
+        self.assertEqual(100, len(message))
+        self.assertAlmostEqual(load.message_time(message),
+                               load.message_time(message.decode('ascii')))
+
+    def test_summarize(self):
+        summary = load.summarize([float(i) for i in range(100, 0, -1)])
+        self.assertEqual({'count': 100, 'mean': 50.5, 'p50': 51.0,
+                          'p90': 91.0, 'p99': 100.0, 'max': 100.0}, summary)
+        self.assertEqual({'count': 0}, load.summarize([]))
+
+    def test_run_manager(self):
+        mgr = manager.SimpleManager()
+        self.check_results(load.run(load.ManagerClient(mgr), self.scenario))
+        # Subscriptions are deleted once done
+        self.assertEqual({}, mgr.topics)
+
+    def test_run_api(self):
+        results = run.benchmark('api', 'simple', {}, self.scenario)
+        self.assertEqual('api', results['target'])
+        self.assertEqual(self.scenario.to_dict(), results['scenario'])
+        self.check_results(results['results'])
+        self.assertEqual({'type': 'dev'}, results['server'])
+
+    def test_run_api_prefork(self):
+        results = run.benchmark('api', 'simple', {}, self.scenario,
+                                server='prefork', threads=4)
+        self.assertEqual({'type': 'prefork', 'workers': 1, 'threads': 4},
+                         results['server'])
+        self.check_results(results['results'])
+
+    def test_run_api_prefork_not_shared(self):
+        self.assertRaises(eowyn_exc.InvalidDataException, run.benchmark,
+                          'api', 'simple', {}, self.scenario,
+                          server='prefork', workers=2)
+
+    def test_compare(self):
+        baseline = {'results': {'throughput': {'publish': 100.0},
+                                'latency': {'pop': {'p99': 0.01}}}}
+        current = {'results': {'throughput': {'publish': 80.0},
+                               'latency': {'pop': {'p99': 0.0105}}}}
+        self.assertEqual(
+            [('throughput.publish', 100.0, 80.0, -0.2, True),
+             ('latency.pop.p99', 0.01, 0.0105, 0.05, False)],
+            [(name, old, new, round(change, 6), regressed)
+             for name, old, new, change, regressed
+             in run.compare(baseline, current)])
+
+    def test_main(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        output = os.path.join(tempdir, 'results.json')
+        args = ['--messages', '10', '--output', output]
+        self.assertEqual(0, run.main(args))
+        with open(output) as results:
+            results = json.load(results)
+        self.assertEqual('simple', results['manager'])
+        self.assertEqual(10, results['results']['delivered'])
+        # Against itself, nothing regressed more than the threshold
+        stderr = open(os.devnull, 'w')
+        self.addCleanup(stderr.close)
+        self.useFixture(fixtures.MonkeyPatch('sys.stderr', stderr))
+        self.assertEqual(0, run.main(args + ['--baseline', output,
+                                             '--threshold', '1000']))
+
+
+class TestPatternBenchmarks(base.TestCase):
+
+    def test_make_patterns(self):
+        rand = random.Random(0)
+        made = patterns.make_patterns(rand, 100, 3, 10, 0.3)
+        self.assertEqual(100, len(set(made)))
+        for pattern in made:
+            self.assertTrue(topics.is_pattern(pattern))
+            topics.validate_pattern(pattern)
+
+    def test_make_patterns_too_many(self):
+        self.assertRaises(ValueError, patterns.make_patterns,
+                          random.Random(0), 100, 2, 3, 0.3)
+
+    def test_scan_match(self):
+        trie = topics.TopicTrie()
+        made = patterns.make_patterns(random.Random(0), 200, 3, 10, 0.3)
+        for pattern in made:
+            trie.add(pattern)
+        # A scan of the patterns matches topics as the trie does
+        for topic in patterns.make_topics(random.Random(1), 20, 3, 10):
+            self.assertEqual(
+                sorted(trie.match(topic)),
+                [p for p in made if patterns._scan_match(p, topic)])
+
+    def test_benchmark(self):
+        results = patterns.benchmark('simple', {}, count=200, depth=3,
+                                     width=10, published=20, scanned=2)
+        self.assertEqual(20, results['results']['latency']['match']['count'])
+        self.assertEqual(2, results['results']['latency']['scan']['count'])
+        self.assertEqual(20,
+                         results['results']['latency']['publish']['count'])
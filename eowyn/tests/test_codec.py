@@ -0,0 +1,69 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import gzip
+import io
+import json
+
+from eowyn import codec
+import eowyn.exceptions as eowyn_exc
+from eowyn.tests import base
+
+
+class TestCodec(base.TestCase):
+
+    message = u'{"cats": ["cute\u00e8", "fluffy"]}'.encode('utf-8') * 100
+
+    def test_check(self):
+        codec.check(self.message)
+        for message in (b'\xffg not gzip', b'message\n\xfe'):
+            self.assertRaises(eowyn_exc.InvalidDataException,
+                              codec.check, message)
+
+    def test_encode_below_threshold(self):
+        self.assertEqual(b'message', codec.encode(b'message', 100))
+        self.assertEqual(self.message, codec.encode(self.message, 0))
+
+    def test_encode_compressed(self):
+        entry = codec.encode(self.message, 100)
+        self.assertTrue(codec.is_compressed(entry))
+        self.assertLess(len(entry), len(self.message) / 10)
+        self.assertEqual(self.message, codec.decode(entry))
+
+    def test_encode_incompressible(self):
+        message = b'abcdefghijklmnopqrstuvwxyz'
+        self.assertEqual(message, codec.encode(message, 10))
+
+    def test_encode_binary(self):
+        message = b'\xff' + b'g' * 200
+        self.assertEqual(message, codec.encode(message, 100))
+
+    def test_decode_plain(self):
+        self.assertFalse(codec.is_compressed(self.message))
+        self.assertEqual(self.message, codec.decode(self.message))
+
+    def test_compressed_body(self):
+        # Compressed entries are the gzip of the JSON of the message
+        entry = codec.encode(self.message, 100)
+        body = gzip.GzipFile(
+            fileobj=io.BytesIO(codec.compressed_body(entry))).read()
+        self.assertEqual(self.message.decode('utf-8'),
+                         json.loads(body.decode('utf-8')))
+
+    def test_accepts_gzip(self):
+        for header in ('gzip', 'deflate, gzip', 'gzip;q=0.5', '*',
+                       'br, gzip; q=1'):
+            self.assertTrue(codec.accepts_gzip(header), header)
+        for header in ('', 'deflate', 'gzip;q=0', 'identity, gzip; q=0.0'):
+            self.assertFalse(codec.accepts_gzip(header), header)
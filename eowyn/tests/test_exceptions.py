@@ -72,6 +72,16 @@ class TestExceptions(base.TestCase):
         exc = eowyn_exc.NoMessageFoundException(foo='bar1')
         self.assertNotIn('bar1', str(exc))
 
+    def test_queue_full_exception(self):
+        exc = eowyn_exc.QueueFullException(
+            username='username1', topic='topic1')
+        self.assertIn('username1', str(exc))
+        self.assertIn('topic1', str(exc))
+
+    def test_queue_full_exception_invalid_param(self):
+        exc = eowyn_exc.QueueFullException(foo='bar1')
+        self.assertNotIn('bar1', str(exc))
+
     def test_invalid_data_exception(self):
         exc = eowyn_exc.InvalidDataException(key='key1', value='value1')
         self.assertIn('key1', str(exc))
@@ -0,0 +1,220 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import functools
+import os
+import threading
+
+import fixtures
+import testtools
+
+from eowyn import exceptions as eowyn_exc
+from eowyn.model import file_manager
+from eowyn.tests import test_simple_manager
+
+
+class TestFileManager(test_simple_manager.TestSimpleManager):
+
+    def setUp(self):
+        super(TestFileManager, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.mgr = self.get_manager()
+        self.data = self.mgr.topics
+
+    def get_manager(self, **kwargs):
+        mgr = file_manager.FileManager(path=self.path, **kwargs)
+        self.addCleanup(mgr.close)
+        return mgr
+
+    def restart(self, **kwargs):
+        self.mgr.close()
+        self.mgr = self.get_manager(**kwargs)
+
+    def get_queue(self, topic, username):
+        state = self.mgr.topics[topic]
+        with state.condition:
+            try:
+                return self.mgr._pop_now(state, topic, username,
+                                         state.end.sequence + 1)[0]
+            except eowyn_exc.NoMessageFoundException:
+                return []
+
+    def get_segments(self, topic):
+        return sorted(os.listdir(self.mgr.topics[topic].directory))
+
+    def test_restart(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        self.mgr.publish_messages('topic', ['message', 'message2'])
+        self.assertEqual('message', self.mgr.pop_message('topic', 'username'))
+        self.restart()
+        self.assertEqual(['message2'],
+                         self.mgr.pop_messages('topic', 'username', 10))
+        self.assertEqual(['message', 'message2'],
+                         self.mgr.pop_messages('topic', 'username2', 10))
+        self.mgr.publish_message('topic', 'message3')
+        self.assertEqual('message3', self.mgr.pop_message('topic', 'username'))
+
+    def test_restart_drops_uncommitted(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+        directory = self.mgr.topics['topic'].directory
+        self.restart()
+        # Something written after the last commit
+        segment = os.path.join(directory, self.get_segments('topic')[-1])
+        with open(segment, 'ab') as f:
+            f.write(b'garbage')
+        os.mkdir(os.path.join(self.path, 'uncommitted'))
+        self.restart()
+        self.assertNotIn('uncommitted', os.listdir(self.path))
+        self.mgr.publish_message('topic', 'message2')
+        self.assertEqual(['message', 'message2'],
+                         self.mgr.pop_messages('topic', 'username', 10))
+
+    def test_restart_deleted_topic(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.delete_subscription('topic', 'username')
+        self.restart()
+        self.assertEqual({}, self.mgr.topics)
+        self.assertEqual([file_manager._INDEX], os.listdir(self.path))
+
+    def test_restart_journal(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        compact = self.mgr._compact
+
+        def _compact(snapshot):
+            self.fail('The index was written again')
+
+        self.mgr._compact = _compact
+        # Moving cursors only appends to the journal
+        self.mgr.publish_messages('topic', ['message', 'message2'])
+        self.assertEqual('message', self.mgr.pop_message('topic', 'username'))
+        self.mgr.publish_message('topic', 'message3')
+        self.assertIn(file_manager._JOURNAL, os.listdir(self.path))
+        self.mgr._compact = compact
+        self.restart()
+        # The journal is folded in the index on start
+        self.assertNotIn(file_manager._JOURNAL, os.listdir(self.path))
+        self.assertEqual(['message2', 'message3'],
+                         self.mgr.pop_messages('topic', 'username', 10))
+        self.assertEqual(['message', 'message2', 'message3'],
+                         self.mgr.pop_messages('topic', 'username2', 10))
+
+    def test_restart_torn_journal(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_messages('topic', ['message', 'message2'])
+        self.assertEqual('message', self.mgr.pop_message('topic', 'username'))
+        self.mgr.close()
+        # A batch not fully written when the process stopped
+        with open(os.path.join(self.path, file_manager._JOURNAL), 'ab') as f:
+            f.write(file_manager._BATCH.pack(64, 0) + b'torn')
+        self.mgr = self.get_manager()
+        self.assertEqual(['message2'],
+                         self.mgr.pop_messages('topic', 'username', 10))
+
+    def test_journal_compaction(self):
+        self.patch(file_manager, '_JOURNAL_SIZE', 256)
+        self.mgr.create_subscription('topic', 'username')
+        for i in range(20):
+            self.mgr.publish_message('topic', 'message%d' % i)
+        # The index was written again once the journal grew too large
+        self.assertGreater(self.mgr._generation, 2)
+        journal = os.path.join(self.path, file_manager._JOURNAL)
+        if os.path.exists(journal):
+            self.assertLessEqual(os.path.getsize(journal), 512)
+        self.restart()
+        self.assertEqual(20, len(self.mgr.pop_messages('topic', 'username',
+                                                       100)))
+
+    def test_publish_message_rolls_segments(self):
+        self.restart(segment_size=64)
+        messages = ['message%d' % i for i in range(100)]
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        for message in messages:
+            self.mgr.publish_message('topic', message)
+        self.assertGreater(len(self.get_segments('topic')), 10)
+        self.assertEqual(messages,
+                         self.mgr.pop_messages('topic', 'username', 100))
+        self.assertEqual(messages[:50],
+                         self.mgr.pop_messages('topic', 'username2', 50))
+        self.restart(segment_size=64)
+        self.assertEqual(messages[50:],
+                         self.mgr.pop_messages('topic', 'username2', 100))
+        # Segments read by all subscribers are deleted on commit, only the
+        # last one read and the one written are left
+        self.mgr.publish_message('topic', 'message')
+        self.assertLessEqual(len(self.get_segments('topic')), 2)
+
+    def test_publish_message_group_commit(self):
+        self.restart(commit_interval=0.05)
+        self.mgr.create_subscription('topic', 'username')
+        commits = []
+        write_index = self.mgr._write_index
+
+        def _write_index(snapshot):
+            commits.append(snapshot)
+            write_index(snapshot)
+
+        self.mgr._write_index = _write_index
+        threads = [threading.Thread(target=functools.partial(
+            self.mgr.publish_message, 'topic', 'message%d' % i))
+            for i in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(50, len(self.mgr.pop_messages('topic', 'username',
+                                                       100)))
+        self.assertLess(len(commits), 10)
+
+    def test_commit_error(self):
+        self.mgr.create_subscription('topic', 'username')
+
+        def _write_index(snapshot):
+            raise IOError('No space left on device')
+
+        self.mgr._write_index = _write_index
+        # Changes waiting for the commit, and those made after it failed,
+        # get its error rather than hanging
+        for _ in range(2):
+            with testtools.ExpectedException(IOError):
+                self.mgr.publish_message('topic', 'message')
+        self.assertFalse(self.mgr._committer.is_alive())
+        self.mgr.close()
+
+    def test_pop_message_not_recorded(self):
+        # The cursor only moves once the change is recorded for a commit
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+
+        def _changed():
+            raise eowyn_exc.EowynException('The manager is closed')
+
+        self.mgr._changed = _changed
+        with testtools.ExpectedException(eowyn_exc.EowynException):
+            self.mgr.pop_message('topic', 'username')
+        self.assertEqual(['message'], self.get_queue('topic', 'username'))
+
+    def test_closed(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.close()
+        with testtools.ExpectedException(eowyn_exc.EowynException):
+            self.mgr.publish_message('topic', 'message')
+        with testtools.ExpectedException(eowyn_exc.EowynException):
+            self.mgr.create_subscription('topic', 'username2')
+        with testtools.ExpectedException(eowyn_exc.EowynException):
+            self.mgr.pop_message('topic', 'username')
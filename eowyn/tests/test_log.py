@@ -0,0 +1,78 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from eowyn.model import log
+from eowyn.tests import base
+
+
+class TestSegmentedLog(base.TestCase):
+
+    def setUp(self):
+        super(TestSegmentedLog, self).setUp()
+        self.log = log.SegmentedLog(segment_size=4)
+
+    def test_append(self):
+        self.log.append('message')
+        self.assertEqual(0, self.log.start)
+        self.assertEqual(1, self.log.end)
+        self.assertEqual(['message'], self.log.read(0))
+
+    def test_read_across_segments(self):
+        messages = ['message%d' % i for i in range(10)]
+        self.log.extend(messages)
+        self.assertEqual(messages, self.log.read(0, 10))
+        self.assertEqual(messages[3:9], self.log.read(3, 6))
+
+    def test_extend(self):
+        self.log.append('first')
+        messages = ['message%d' % i for i in range(10)]
+        self.log.extend(messages)
+        self.assertEqual(11, self.log.end)
+        self.assertEqual(['first'] + messages, self.log.read(0, 11))
+
+    def test_read_end(self):
+        self.log.extend(['message', 'message2'])
+        self.assertEqual(['message2'], self.log.read(1, 10))
+        self.assertEqual([], self.log.read(2))
+
+    def test_add_reader(self):
+        self.log.append('message')
+        self.assertEqual(1, self.log.add_reader())
+
+    def test_move_reader_frees_segments(self):
+        first = self.log.add_reader()
+        second = self.log.add_reader()
+        self.log.extend(['message%d' % i for i in range(10)])
+        self.log.move_reader(first, 9)
+        self.assertEqual(0, self.log.start)
+        self.log.move_reader(second, 5)
+        self.assertEqual(4, self.log.start)
+        self.log.move_reader(5, 10)
+        self.assertEqual(8, self.log.start)
+        self.assertEqual(['message9'], self.log.read(9))
+
+    def test_remove_reader_frees_segments(self):
+        first = self.log.add_reader()
+        second = self.log.add_reader()
+        self.log.extend(['message%d' % i for i in range(10)])
+        self.log.move_reader(first, 10)
+        self.log.remove_reader(second)
+        self.assertEqual(8, self.log.start)
+
+    def test_tail_segment_kept(self):
+        reader = self.log.add_reader()
+        self.log.extend(['message%d' % i for i in range(4)])
+        self.log.move_reader(reader, 4)
+        self.log.append('message4')
+        self.assertEqual(['message4'], self.log.read(4))
@@ -0,0 +1,157 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+
+import fixtures
+import testtools
+
+from eowyn import exceptions as eowyn_exc
+from eowyn import metrics
+from eowyn.model import manager
+from eowyn.tests import base
+
+
+class TestMetrics(base.TestCase):
+
+    def test_counter(self):
+        counter = metrics.Counter('requests_total', 'Requests', ['code'])
+        counter.inc('200')
+        counter.inc('200', amount=2)
+        counter.inc('404')
+        self.assertEqual(['# HELP requests_total Requests',
+                          '# TYPE requests_total counter',
+                          'requests_total{code="200"} 3',
+                          'requests_total{code="404"} 1'],
+                         counter.render())
+
+    def test_counter_no_labels(self):
+        counter = metrics.Counter('messages_total', 'Messages')
+        counter.inc(amount=5)
+        self.assertEqual('messages_total 5', counter.render()[-1])
+
+    def test_counter_threads(self):
+        counter = metrics.Counter('messages_total', 'Messages')
+
+        def inc():
+            for _ in range(1000):
+                counter.inc()
+        threads = [threading.Thread(target=inc) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(8000, counter.series().value)
+
+    def test_gauge(self):
+        gauge = metrics.Gauge('queued', 'Queued', ['topic'])
+        gauge.set(3, 'cats')
+        gauge.set(1, 'cats')
+        self.assertEqual(['# HELP queued Queued', '# TYPE queued gauge',
+                          'queued{topic="cats"} 1'], gauge.render())
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('latency', 'Latency', ['route'],
+                                      buckets=[0.1, 1.0])
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, '/x')
+        self.assertEqual(['# HELP latency Latency',
+                          '# TYPE latency histogram',
+                          'latency_bucket{route="/x",le="0.1"} 2',
+                          'latency_bucket{route="/x",le="1.0"} 3',
+                          'latency_bucket{route="/x",le="+Inf"} 4',
+                          'latency_sum{route="/x"} 2.65',
+                          'latency_count{route="/x"} 4'],
+                         histogram.render())
+
+    def test_escape_labels(self):
+        gauge = metrics.Gauge('queued', 'Queued', ['topic'])
+        gauge.set(1, 'a"b\\c\nd')
+        self.assertEqual('queued{topic="a\\"b\\\\c\\nd"} 1',
+                         gauge.render()[-1])
+
+    def test_render(self):
+        text = metrics.render()
+        self.assertTrue(text.endswith('\n'))
+        for metric in metrics.METRICS:
+            self.assertIn('# TYPE %s %s\n' % (metric.name, metric.kind),
+                          text)
+
+    def test_sample_depths(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'eowyn.metrics._sampled', {'time': None}))
+        mgr = manager.SimpleManager()
+        mgr.create_subscription('topic', 'username')
+        mgr.create_subscription('topic', 'username2')
+        mgr.publish_messages('topic', ['message0', 'message1'])
+        mgr.pop_message('topic', 'username')
+        text = metrics.render(mgr)
+        self.assertIn('eowyn_queued_messages{topic="topic"} 3\n', text)
+        self.assertIn('eowyn_max_queued_messages{topic="topic"} 2\n', text)
+        # Samples are not taken again until they are due
+        mgr.pop_message('topic', 'username2')
+        self.assertIn('eowyn_queued_messages{topic="topic"} 3\n',
+                      metrics.render(mgr))
+        self.assertFalse(metrics.sample_due())
+
+
+class TestManagerInstrumentation(base.TestCase):
+
+    def setUp(self):
+        super(TestManagerInstrumentation, self).setUp()
+        self.mgr = manager.SimpleManager()
+
+    def calls(self, operation, outcome='ok'):
+        return sum(metrics.MANAGER_CALLS.series(
+            'SimpleManager', operation, outcome).counts)
+
+    def test_calls(self):
+        before = self.calls('create_subscription')
+        self.mgr.create_subscription('topic', 'username')
+        # Calls to the overridden methods of the base class are not
+        # measured again
+        self.assertEqual(before + 1, self.calls('create_subscription'))
+
+    def test_calls_outcome(self):
+        outcome = 'SubscriptionNotFoundException'
+        before = self.calls('pop_message', outcome)
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            self.mgr.pop_message('topic', 'username')
+        self.assertEqual(before + 1, self.calls('pop_message', outcome))
+
+    def test_messages(self):
+        published = metrics.PUBLISHED.series()
+        delivered = metrics.DELIVERED.series()
+        before = published.value, delivered.value
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_message('topic', 'message0')
+        self.mgr.publish_messages(topic='topic',
+                                  messages=['message1', 'message2'])
+        self.mgr.pop_message('topic', 'username')
+        self.mgr.pop_messages('topic', 'username', 10)
+        self.assertEqual((before[0] + 3, before[1] + 3),
+                         (published.value, delivered.value))
+
+    def test_messages_not_published(self):
+        published = metrics.PUBLISHED.series()
+        before = published.value
+        with testtools.ExpectedException(eowyn_exc.TopicNotFoundException):
+            self.mgr.publish_message('topic', 'message')
+        self.assertEqual(before, published.value)
+
+    def test_abstract_methods(self):
+        # All the operations every manager implements are measured
+        self.assertLessEqual(manager.Manager.__abstractmethods__,
+                             set(manager.INSTRUMENTED))
@@ -0,0 +1,61 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+
+import fixtures
+import redis
+
+from eowyn import migrate
+from eowyn.tests import base
+
+
+class TestMigrate(base.TestCase):
+
+    def setUp(self):
+        super(TestMigrate, self).setUp()
+        self.stdout = self.useFixture(fixtures.StringStream('stdout'))
+        self.useFixture(fixtures.MonkeyPatch('sys.stdout',
+                                             self.stdout.stream))
+        self.config = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'api.conf')
+
+    def write_config(self, manager, options=''):
+        with open(self.config, 'w') as config:
+            config.write('[default]\nmanager = %s\ndebug = false\n\n'
+                         '[%s]\n%s\n' % (manager, manager, options))
+
+    def output(self):
+        self.stdout.stream.seek(0)
+        return self.stdout.stream.read()
+
+    def test_migrate(self):
+        data = redis.StrictRedis(db=1)
+        try:
+            data.flushdb()
+        except redis.exceptions.ConnectionError as ce:
+            self.skipTest("Redis server not available: %s" % ce)
+        self.addCleanup(data.flushdb)
+        data.sadd('topic', 'username')
+        data.lpush('topic.username', 'message')
+        self.write_config('redis', 'db = 1')
+        self.assertEqual(0, migrate.main(['eowyn-migrate', self.config]))
+        self.assertEqual('Moved 1 queues\n', self.output())
+        self.assertEqual([b'message'], data.lrange('topic/q/username', 0, -1))
+
+    def test_migrate_not_supported(self):
+        self.write_config('simple')
+        self.assertEqual(0, migrate.main(['eowyn-migrate', self.config]))
+        self.assertEqual('Nothing to migrate with the simple manager\n',
+                         self.output())
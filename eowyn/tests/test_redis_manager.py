@@ -12,13 +12,36 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import hashlib
+import threading
+import time
+
+import fixtures
 import redis
 import testtools
 
+from eowyn import exceptions as eowyn_exc
 from eowyn.model import redis_manager
+from eowyn.tests import base
 from eowyn.tests import test_simple_manager
 
 
+def count_round_trips(test):
+    # Every command, or pipeline of commands, sent to the server goes
+    # through a single send_packed_command call on the connection
+    round_trips = []
+    send = redis.connection.Connection.send_packed_command
+
+    def _counting_send(connection, *args, **kwargs):
+        round_trips.append(args)
+        return send(connection, *args, **kwargs)
+
+    test.useFixture(fixtures.MonkeyPatch(
+        'redis.connection.Connection.send_packed_command',
+        _counting_send))
+    return round_trips
+
+
 class TestRedisManager(test_simple_manager.TestSimpleManager):
 
     def setUp(self):
@@ -49,23 +72,24 @@ class TestRedisManager(test_simple_manager.TestSimpleManager):
 
     def test_create_subscription(self):
         self.mgr.create_subscription('topic', 'username')
-        self.assertIn('topic', self.data.keys('*'))
-        self.assertIn('username', self.data.smembers('topic'))
+        self.assertIn(self.mgr._key('topic'), self.data.keys('*'))
+        self.assertIn('username', self.data.smembers(self.mgr._key('topic')))
         self.assertNotIn(self.mgr._queue('topic', 'username'),
                          self.data.keys('*'))
 
     def test_delete_subscription_single(self):
         self.mgr.create_subscription('topic', 'username')
         self.mgr.delete_subscription('topic', 'username')
-        self.assertNotIn('topic', self.data.keys('*'))
+        self.assertNotIn(self.mgr._key('topic'), self.data.keys('*'))
 
     def test_delete_subscription_multiple(self):
         self.mgr.create_subscription('topic', 'username')
         self.mgr.create_subscription('topic', 'username2')
         self.mgr.delete_subscription('topic', 'username')
-        self.assertIn('topic', self.data.keys('*'))
-        self.assertNotIn('username', self.data.smembers('topic'))
-        self.assertIn('username2', self.data.smembers('topic'))
+        self.assertIn(self.mgr._key('topic'), self.data.keys('*'))
+        self.assertNotIn('username',
+                         self.data.smembers(self.mgr._key('topic')))
+        self.assertIn('username2', self.data.smembers(self.mgr._key('topic')))
 
     def test_publish_message(self):
         self.mgr.create_subscription('topic', 'username')
@@ -88,3 +112,737 @@ class TestRedisManager(test_simple_manager.TestSimpleManager):
         message = self.mgr.pop_message('topic', 'username')
         self.assertNotIn('message', self.get_queue('topic', 'username'))
         self.assertEqual('message', message)
+
+    def test_publish_message_fan_out(self):
+        usernames = ['username%d' % i for i in range(100)]
+        for username in usernames:
+            self.mgr.create_subscription('topic', username)
+        self.mgr.publish_message('topic', 'message')
+        for username in usernames:
+            self.assertEqual(['message'], self.get_queue('topic', username))
+
+    def test_publish_message_round_trips(self):
+        self.mgr.create_subscription('topic', 'username')
+        # Make sure the script is loaded before counting
+        self.mgr.publish_message('topic', 'message')
+        round_trips = count_round_trips(self)
+        self.mgr.publish_message('topic', 'message')
+        self.assertEqual(1, len(round_trips))
+        for i in range(100):
+            self.mgr.create_subscription('topic', 'username%d' % i)
+        del round_trips[:]
+        self.mgr.publish_message('topic', 'message')
+        self.assertEqual(1, len(round_trips))
+
+    def test_publish_message_no_topic_round_trips(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+        round_trips = count_round_trips(self)
+        with testtools.ExpectedException(eowyn_exc.TopicNotFoundException):
+            self.mgr.publish_message('topic2', 'message')
+        self.assertEqual(1, len(round_trips))
+
+    def test_pop_message_round_trips(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.pop_message('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+        round_trips = count_round_trips(self)
+        self.mgr.pop_message('topic', 'username')
+        with testtools.ExpectedException(eowyn_exc.NoMessageFoundException):
+            self.mgr.pop_message('topic', 'username')
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            self.mgr.pop_message('topic', 'username2')
+        self.assertEqual(3, len(round_trips))
+
+    def test_subscription_round_trips(self):
+        # Make sure the scripts are loaded before counting
+        self.mgr.create_subscription('topic2', 'username')
+        self.mgr.delete_subscription('topic2', 'username')
+        self.mgr.create_subscription('topic', 'username')
+        round_trips = count_round_trips(self)
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionAlreadyExistsException):
+            self.mgr.create_subscription('topic', 'username')
+        self.mgr.delete_subscription('topic', 'username')
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            self.mgr.delete_subscription('topic', 'username')
+        self.assertEqual(3, len(round_trips))
+
+    def test_user_topics_index(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscriptions('username', ['topic2', 'topic3'])
+        self.mgr.delete_subscription('topic2', 'username')
+        self.assertEqual(set([b'topic', b'topic3']), self.data.smembers(
+            redis_manager._user_key('username')))
+        self.mgr.delete_subscriptions('username')
+        self.assertNotIn(redis_manager._user_key('username'),
+                         self.data.keys('*'))
+
+    def test_user_topics_round_trips(self):
+        # Make sure the scripts are loaded before counting
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.delete_subscription('topic', 'username')
+        round_trips = count_round_trips(self)
+        # Pipelines check that their scripts are loaded first
+        self.mgr.create_subscriptions(
+            'username', ['topic%d' % i for i in range(100)])
+        self.assertEqual(2, len(round_trips))
+        del round_trips[:]
+        self.assertEqual(100, len(self.mgr.get_topics('username')))
+        self.assertEqual(1, len(round_trips))
+        del round_trips[:]
+        self.assertEqual(100, len(self.mgr.delete_subscriptions('username')))
+        self.assertEqual(3, len(round_trips))
+
+    def test_user_ready_topics(self):
+        self.skip_without_user_messages()
+        self.mgr.create_subscriptions('username', ['topic', 'topic2'])
+        self.mgr.publish_message('topic2', 'message')
+        self.assertEqual(set([b'topic2']), self.data.smembers(
+            redis_manager._ready_key('username')))
+        self.mgr.pop_user_messages('username', 10)
+        self.assertNotIn(redis_manager._ready_key('username'),
+                         self.data.keys('*'))
+
+    def test_user_ready_no_waiter(self):
+        # Users are only woken up when they wait
+        self.skip_without_user_messages()
+        self.mgr.create_subscriptions('username', ['topic', 'topic2'])
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.publish_message('topic', 'message2')
+        self.mgr.publish_message('topic2', 'message3')
+        self.assertEqual(set([b'topic', b'topic2']), self.data.smembers(
+            redis_manager._ready_key('username')))
+        self.assertEqual([redis_manager._ready_key('username').encode()],
+                         self.data.keys(redis_manager.READY + '*'))
+
+    def test_pop_user_messages_wait_registered(self):
+        self.skip_without_user_messages()
+        self.mgr.create_subscriptions('username', ['topic', 'topic2'])
+        waiting = redis_manager._ready_key('username') + '/waiting'
+        popped = []
+        waiter = threading.Thread(target=lambda: popped.extend(
+            self.mgr.pop_user_messages('username', 10, wait=10)))
+        waiter.start()
+        deadline = time.time() + 5
+        while not self.data.exists(waiting):
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+        self.mgr.publish_message('topic2', 'message')
+        waiter.join(10)
+        self.assertEqual([('topic2', b'message')], popped)
+        self.assertEqual([], self.data.keys(redis_manager.READY + '*'))
+
+    def test_pop_user_messages_round_trips(self):
+        self.skip_without_user_messages()
+        topics = ['topic%d' % i for i in range(100)]
+        self.mgr.create_subscriptions('username', topics)
+        # Make sure the script is loaded before counting
+        self.mgr.publish_message('topic0', 'topic0')
+        self.mgr.pop_user_messages('username', 1)
+        for topic in topics[::10]:
+            self.mgr.publish_message(topic, topic)
+        round_trips = count_round_trips(self)
+        popped = self.mgr.pop_user_messages('username', 100)
+        self.assertEqual(1, len(round_trips))
+        self.assertEqual(sorted(topics[::10]), [m for _, m in popped])
+
+    def test_delete_subscription_with_messages(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.delete_subscription('topic', 'username')
+        self.assertNotIn(self.mgr._queue('topic', 'username'),
+                         self.data.keys('*'))
+
+    def test_pop_messages_round_trips(self):
+        self.mgr.create_subscription('topic', 'username')
+        for i in range(100):
+            self.mgr.publish_message('topic', 'message%d' % i)
+        self.mgr.pop_messages('topic', 'username', 1)
+        round_trips = count_round_trips(self)
+        messages = self.mgr.pop_messages('topic', 'username', 100)
+        self.assertEqual(1, len(round_trips))
+        self.assertEqual(['message%d' % i for i in range(1, 100)], messages)
+        self.assertNotIn(self.mgr._queue('topic', 'username'),
+                         self.data.keys('*'))
+
+    def test_publish_messages_batch_round_trips(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_messages('topic', ['message'])
+        round_trips = count_round_trips(self)
+        for i in range(100):
+            self.mgr.create_subscription('topic', 'username%d' % i)
+        del round_trips[:]
+        self.mgr.publish_messages('topic', ['message%d' % i
+                                            for i in range(100)])
+        self.assertEqual(1, len(round_trips))
+
+    def test_migrate(self):
+        # Queues of previous versions were topic.username keys, and hold
+        # older messages than the current queues
+        key = self.mgr._key('topic')
+        self.data.sadd(key, 'username', 'username2')
+        self.data.lpush(key + '.username', 'message0', 'message1')
+        self.mgr.publish_message('topic', 'message2')
+        self.assertEqual(1, self.mgr.migrate())
+        self.assertNotIn(key + '.username', self.data.keys('*'))
+        self.assertEqual(['topic'], self.mgr.get_topics('username2'))
+        if not self.mgr.cluster:
+            self.assertTrue(self.data.sismember(
+                redis_manager._ready_key('username'), 'topic'))
+        self.assertEqual(['message0', 'message1', 'message2'],
+                         self.mgr.pop_messages('topic', 'username', 10))
+        self.assertEqual(['message2'],
+                         self.mgr.pop_messages('topic', 'username2', 10))
+        self.assertEqual(0, self.mgr.migrate())
+
+
+class TestRedisManagerRetention(
+        test_simple_manager.TestSimpleManagerRetention):
+
+    def setUp(self):
+        super(TestRedisManagerRetention, self).setUp()
+        self.data = redis.StrictRedis(db=1)
+        try:
+            self.data.flushdb()
+        except redis.exceptions.ConnectionError as ce:
+            self.skipTest("Redis server not available: %s" % ce)
+        self.addCleanup(self.data.flushdb)
+
+    def make_manager(self, **kwargs):
+        return redis_manager.RedisManager(db=1, **kwargs)
+
+    def test_publish_message_round_trips(self):
+        mgr = self.make_manager(max_length=2, max_age=60)
+        self.subscribe(mgr)
+        mgr.publish_message('topic', 'message')
+        mgr.publish_messages('topic', ['message'])
+        round_trips = count_round_trips(self)
+        mgr.publish_message('topic', 'message')
+        mgr.publish_messages('topic', ['message', 'message'])
+        self.assertEqual(2, len(round_trips))
+
+    def test_max_age_times_trimmed(self):
+        mgr = self.make_manager(max_age=0.2)
+        self.subscribe(mgr, ['username'])
+        mgr.publish_messages('topic', ['message0', 'message1', 'message2'])
+        mgr.pop_messages('topic', 'username', 2)
+        mgr.publish_message('topic', 'message3')
+        # The times of popped messages are dropped when publishing
+        self.assertEqual(2, self.data.llen(mgr._queue('topic', 'username') +
+                                           '/times'))
+        time.sleep(0.3)
+        mgr.publish_message('topic', 'message4')
+        self.assertEqual(['message4'],
+                         mgr.pop_messages('topic', 'username', 10))
+        self.assertEqual(2, mgr.get_dropped('topic', 'username'))
+
+    def test_max_age_enabled_later(self):
+        mgr = self.make_manager()
+        self.subscribe(mgr, ['username'])
+        mgr.publish_messages('topic', ['message0', 'message1'])
+        mgr = self.make_manager(max_age=0.2)
+        mgr.publish_message('topic', 'message2')
+        time.sleep(0.3)
+        mgr.publish_message('topic', 'message3')
+        # Messages without a time are older than the expired ones
+        self.assertEqual(['message3'],
+                         mgr.pop_messages('topic', 'username', 10))
+        self.assertEqual(3, mgr.get_dropped('topic', 'username'))
+
+    def test_delete_subscription(self):
+        mgr = self.make_manager(max_length=1, max_age=60)
+        self.subscribe(mgr, ['username'])
+        mgr.publish_messages('topic', ['message0', 'message1'])
+        mgr.delete_subscription('topic', 'username')
+        self.assertEqual([], self.data.keys('*'))
+
+
+class TestRedisManagerLeases(test_simple_manager.TestSimpleManagerLeases):
+
+    def setUp(self):
+        self.data = redis.StrictRedis(db=1)
+        try:
+            self.data.flushdb()
+        except redis.exceptions.ConnectionError as ce:
+            self.skipTest("Redis server not available: %s" % ce)
+        self.addCleanup(self.data.flushdb)
+        super(TestRedisManagerLeases, self).setUp()
+
+    def make_manager(self, **kwargs):
+        return redis_manager.RedisManager(db=1, **kwargs)
+
+    def test_lease_round_trips(self):
+        self.mgr.publish_messages('topic', ['message0', 'message1'])
+        round_trips = count_round_trips(self)
+        leased = self.mgr.lease_messages('topic', 'username', 2, 30)
+        self.mgr.ack_messages('topic', 'username',
+                              [lease for lease, _ in leased])
+        self.assertEqual(2, len(round_trips))
+
+    def test_lease_dedup(self):
+        self.mgr = self.make_manager(dedup_threshold=10)
+        self.mgr.create_subscription('topic', 'username2')
+        message = 'message' * 10
+        self.mgr.publish_message('topic', message)
+        [(lease, leased)] = self.mgr.lease_messages('topic', 'username', 1,
+                                                    30)
+        self.assertEqual(message, leased)
+        self.mgr.pop_message('topic', 'username2')
+        # Leased payloads are kept until acknowledged
+        self.assertTrue(self.data.hgetall('topic/payloads'))
+        self.mgr.ack_messages('topic', 'username', [lease])
+        self.assertEqual({}, self.data.hgetall('topic/payloads'))
+
+    def test_lease_delete_subscription(self):
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.lease_messages('topic', 'username', 1, 30)
+        self.mgr.delete_subscription('topic', 'username')
+        self.assertEqual([], self.data.keys('*'))
+
+    def test_lease_wait_interrupted(self):
+        # A client going away after waiting, before leasing, loses nothing
+        lease = self.mgr._lease_messages
+        calls = []
+
+        def _lease(*args, **kwargs):
+            calls.append(args)
+            if len(calls) > 1:
+                raise redis.exceptions.ConnectionError()
+            return lease(*args, **kwargs)
+        self.mgr._lease_messages = _lease
+        publisher = threading.Timer(0.2, self.mgr.publish_message,
+                                    ('topic', 'message'))
+        publisher.start()
+        self.addCleanup(publisher.join)
+        self.assertRaises(redis.exceptions.ConnectionError,
+                          self.mgr.lease_messages, 'topic', 'username', 1,
+                          30, wait=5)
+        self.mgr._lease_messages = lease
+        [(_, message)] = self.mgr.lease_messages('topic', 'username', 1, 30)
+        self.assertEqual('message', message)
+        self.mgr.delete_subscription('topic', 'username')
+        self.assertEqual([], self.data.keys('*'))
+
+
+class TestRedisManagerPatterns(
+        test_simple_manager.TestSimpleManagerPatterns):
+
+    def setUp(self):
+        self.data = redis.StrictRedis(db=1)
+        try:
+            self.data.flushdb()
+        except redis.exceptions.ConnectionError as ce:
+            self.skipTest("Redis server not available: %s" % ce)
+        self.addCleanup(self.data.flushdb)
+        super(TestRedisManagerPatterns, self).setUp()
+
+    def make_manager(self, **kwargs):
+        return redis_manager.RedisManager(db=1, patterns=True, **kwargs)
+
+    def test_trie(self):
+        self.mgr.create_subscription('orders.*.paris', 'username')
+        self.mgr.create_subscription('orders.*.paris', 'username2')
+        self.mgr.create_subscription('orders.>', 'username')
+        self.assertEqual({b'orders': b'2', b'orders.*': b'1',
+                          b'orders.*.paris': b'1', b'orders.>': b'1'},
+                         self.data.hgetall(redis_manager.PATTERNS))
+        # The trie outlives managers
+        mgr = self.make_manager()
+        mgr.publish_message('orders.eu.paris', 'message')
+        self.assertEqual('message'.encode(), self.mgr.pop_message(
+            'orders.*.paris', 'username2'))
+        self.mgr.delete_subscription('orders.*.paris', 'username')
+        self.mgr.delete_subscription('orders.*.paris', 'username2')
+        self.mgr.delete_subscription('orders.>', 'username')
+        self.assertEqual([], self.data.keys('*'))
+
+    def test_publish_round_trips(self):
+        self.mgr.create_subscription('orders.*.paris', 'username')
+        self.mgr.create_subscription('orders.>', 'username')
+        round_trips = count_round_trips(self)
+        self.mgr.publish_message('orders.eu.paris', 'message')
+        self.assertEqual(1, len(round_trips))
+
+    def test_patterns_disabled(self):
+        mgr = redis_manager.RedisManager(db=1)
+        with testtools.ExpectedException(eowyn_exc.InvalidDataException):
+            mgr.create_subscription('orders.>', 'username')
+
+    def test_patterns_cluster(self):
+        with testtools.ExpectedException(eowyn_exc.InvalidDataException):
+            redis_manager.RedisManager(cluster=True, patterns=True)
+
+
+class TestRedisManagerDedup(TestRedisManager):
+
+    message = 'message' * 100
+
+    def setUp(self):
+        super(TestRedisManagerDedup, self).setUp()
+        self.mgr = redis_manager.RedisManager(db=1, dedup_threshold=100)
+        self.usernames = ['username%d' % i for i in range(3)]
+
+    def subscribe(self):
+        for username in self.usernames:
+            self.mgr.create_subscription('topic', username)
+
+    def payloads(self, topic='topic'):
+        return self.data.hgetall(self.mgr._key(topic) + '/payloads')
+
+    def references(self, topic='topic'):
+        return self.data.hgetall(self.mgr._key(topic) + '/references')
+
+    def test_publish_message_stored_once(self):
+        self.subscribe()
+        self.mgr.publish_message('topic', self.message)
+        self.mgr.publish_message('topic', self.message)
+        self.assertEqual([self.message], list(self.payloads().values()))
+        self.assertEqual(['6'], list(self.references().values()))
+        for username in self.usernames:
+            entries = self.get_queue('topic', username)
+            self.assertEqual(2, len(entries))
+            for entry in entries:
+                self.assertLess(len(entry), 50)
+
+    def test_publish_message_small(self):
+        self.subscribe()
+        self.mgr.publish_message('topic', 'message')
+        self.assertEqual({}, self.payloads())
+        self.assertEqual(['message'], self.get_queue('topic', 'username0'))
+
+    def test_publish_message_single_subscriber(self):
+        self.mgr.create_subscription('topic2', 'username')
+        self.mgr.publish_message('topic2', self.message)
+        self.assertEqual({}, self.payloads('topic2'))
+        self.assertEqual([self.message], self.get_queue('topic2', 'username'))
+
+    def test_pop_message_releases(self):
+        self.subscribe()
+        self.mgr.publish_messages('topic', [self.message, 'message',
+                                            self.message + '2'])
+        self.assertEqual(2, len(self.payloads()))
+        for username in self.usernames[:-1]:
+            self.assertEqual([self.message, 'message', self.message + '2'],
+                             self.mgr.pop_messages('topic', username, 10))
+        self.assertEqual({self.message: '1', self.message + '2': '1'},
+                         dict((self.payloads()[digest], count)
+                              for digest, count
+                              in self.references().items()))
+        self.assertEqual(self.message,
+                         self.mgr.pop_message('topic', self.usernames[-1]))
+        self.assertEqual([self.message + '2'], list(self.payloads().values()))
+        self.mgr.pop_messages('topic', self.usernames[-1], 10)
+        self.assertEqual([], self.data.keys('topic/*'))
+
+    def test_pop_message_marker(self):
+        # Plain messages starting with the marker are not references, even
+        # as long as one, or as one released already
+        self.subscribe()
+        digest = hashlib.sha1(self.message.encode('utf-8')).hexdigest()
+        plain = [b'\xff#' + b'x' * 40, b'\xff#' + digest.encode('ascii'),
+                 b'\xff#']
+        self.mgr.publish_message('topic', self.message)
+        for username in self.usernames:
+            self.mgr.pop_message('topic', username)
+        self.mgr.publish_messages('topic', plain)
+        self.mgr.publish_message('topic', self.message + '2')
+        self.assertEqual(plain + [self.message + '2'],
+                         self.mgr.pop_messages('topic', 'username0', 10))
+        self.assertEqual(['2'], list(self.references().values()))
+        self.publish_later('topic', plain[0])
+        self.assertEqual(plain[0], self.mgr.pop_message('topic', 'username0',
+                                                        wait=10))
+
+    def test_pop_message_wait_releases(self):
+        self.subscribe()
+        self.publish_later('topic', self.message)
+        self.assertEqual(self.message, self.mgr.pop_message(
+            'topic', 'username0', wait=10))
+        self.assertEqual(['2'], list(self.references().values()))
+
+    def test_delete_subscription_releases(self):
+        self.subscribe()
+        self.mgr.publish_message('topic', self.message)
+        for username in self.usernames:
+            self.mgr.delete_subscription('topic', username)
+        self.assertEqual([], self.data.keys('*'))
+
+    def test_retention_releases(self):
+        self.subscribe()
+        self.mgr = redis_manager.RedisManager(db=1, dedup_threshold=100,
+                                              max_length=1)
+        self.mgr.publish_message('topic', self.message)
+        self.mgr.publish_message('topic', self.message + '2')
+        self.assertEqual([self.message + '2'], list(self.payloads().values()))
+        self.assertEqual(['3'], list(self.references().values()))
+
+    def test_memory(self):
+        usernames = ['user%d' % i for i in range(100)]
+        for username in usernames:
+            self.mgr.create_subscription('topic2', username)
+        message = 'x' * 200000
+        self.mgr.publish_message('topic2', message)
+        used = sum(self.data.memory_usage(key)
+                   for key in self.data.keys('*topic2*'))
+        self.assertLess(used, 2 * len(message))
+        for username in usernames:
+            self.assertEqual(message,
+                             self.mgr.pop_message('topic2', username))
+        # Only subscriptions are left
+        self.assertEqual(['topic2'], self.data.keys('*topic2*'))
+
+
+class TestRedisManagerCache(TestRedisManager):
+
+    def setUp(self):
+        super(TestRedisManagerCache, self).setUp()
+        self.mgr = self.make_manager()
+        # A second manager, as run by another process
+        self.mgr2 = self.make_manager()
+
+    def make_manager(self):
+        mgr = redis_manager.RedisManager(db=1, cache_ttl=60)
+        self.addCleanup(mgr.close)
+        self.wait_for(lambda: mgr._cache_ready)
+        return mgr
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail("Condition not met within %ss" % timeout)
+            time.sleep(0.01)
+
+    def sync(self, mgr):
+        # Wait for the manager to receive the changes announced so far,
+        # as announcements are received in order
+        mgr.cache.set('/sync', frozenset(), mgr.cache.token())
+        self.data.publish(redis_manager.SUBSCRIPTIONS_CHANNEL, '/sync')
+        self.wait_for(lambda: '/sync' not in mgr.cache)
+
+    def test_publish_message_no_topic_round_trips(self):
+        with testtools.ExpectedException(eowyn_exc.TopicNotFoundException):
+            self.mgr.publish_message('topic', 'message')
+        round_trips = count_round_trips(self)
+        with testtools.ExpectedException(eowyn_exc.TopicNotFoundException):
+            self.mgr.publish_message('topic', 'message')
+        with testtools.ExpectedException(eowyn_exc.TopicNotFoundException):
+            self.mgr.publish_messages('topic', ['message'])
+        self.assertEqual(0, len(round_trips))
+        self.assertEqual(2, self.mgr.cache.hits)
+        self.assertEqual(1, self.mgr.cache.misses)
+
+    def test_publish_message_round_trips(self):
+        # Once the subscribers are cached, publishing takes a round trip
+        self.mgr.create_subscription('topic', 'username')
+        self.sync(self.mgr)
+        self.mgr.publish_message('topic', 'message')
+        round_trips = count_round_trips(self)
+        self.mgr.publish_message('topic', 'message')
+        self.assertEqual(1, len(round_trips))
+        for i in range(100):
+            self.mgr.create_subscription('topic', 'username%d' % i)
+        self.sync(self.mgr)
+        self.mgr.publish_message('topic', 'message')
+        del round_trips[:]
+        self.mgr.publish_message('topic', 'message')
+        self.assertEqual(1, len(round_trips))
+
+    def test_publish_messages_batch_round_trips(self):
+        self.mgr.create_subscription('topic', 'username')
+        for i in range(100):
+            self.mgr.create_subscription('topic', 'username%d' % i)
+        self.sync(self.mgr)
+        self.mgr.publish_messages('topic', ['message'])
+        round_trips = count_round_trips(self)
+        self.mgr.publish_messages('topic', ['message%d' % i
+                                            for i in range(100)])
+        self.assertEqual(1, len(round_trips))
+
+    def test_pop_message_round_trips(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.sync(self.mgr)
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.pop_message('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+        round_trips = count_round_trips(self)
+        self.mgr.pop_message('topic', 'username')
+        with testtools.ExpectedException(eowyn_exc.NoMessageFoundException):
+            self.mgr.pop_message('topic', 'username')
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            self.mgr.pop_message('topic', 'username2')
+        # No round trip for the missing subscription
+        self.assertEqual(2, len(round_trips))
+
+    def test_cache_lru(self):
+        mgr = redis_manager.RedisManager(db=1, cache_ttl=60, cache_size=2)
+        self.addCleanup(mgr.close)
+        self.wait_for(lambda: mgr._cache_ready)
+        for topic in ('topic1', 'topic2', 'topic1', 'topic3'):
+            with testtools.ExpectedException(
+                    eowyn_exc.TopicNotFoundException):
+                mgr.publish_message(topic, 'message')
+        self.assertIn('topic1', mgr.cache)
+        self.assertNotIn('topic2', mgr.cache)
+        self.assertIn('topic3', mgr.cache)
+
+    def test_cache_ttl(self):
+        mgr = redis_manager.RedisManager(db=1, cache_ttl=0.1)
+        self.addCleanup(mgr.close)
+        self.wait_for(lambda: mgr._cache_ready)
+        with testtools.ExpectedException(eowyn_exc.TopicNotFoundException):
+            mgr.publish_message('topic', 'message')
+        time.sleep(0.2)
+        with testtools.ExpectedException(eowyn_exc.TopicNotFoundException):
+            mgr.publish_message('topic', 'message')
+        self.assertEqual(0, mgr.cache.hits)
+        self.assertEqual(2, mgr.cache.misses)
+
+    def test_create_subscription_invalidates(self):
+        with testtools.ExpectedException(eowyn_exc.TopicNotFoundException):
+            self.mgr2.publish_message('topic', 'message')
+        self.assertIn('topic', self.mgr2.cache)
+        self.mgr.create_subscription('topic', 'username')
+        self.sync(self.mgr2)
+        self.assertNotIn('topic', self.mgr2.cache)
+        self.mgr2.publish_message('topic', 'message')
+        self.assertEqual('message', self.mgr.pop_message('topic', 'username'))
+
+    def test_delete_subscription_invalidates(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.sync(self.mgr2)
+        with testtools.ExpectedException(eowyn_exc.NoMessageFoundException):
+            self.mgr2.pop_message('topic', 'username')
+        self.mgr.delete_subscription('topic', 'username')
+        self.sync(self.mgr2)
+        self.assertNotIn('topic', self.mgr2.cache)
+        round_trips = count_round_trips(self)
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            self.mgr2.pop_message('topic', 'username')
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            self.mgr2.pop_message('topic', 'username')
+        # The subscribers are reloaded once
+        self.assertEqual(1, len(round_trips))
+
+    def test_concurrent_subscribe_publish(self):
+        topics = ['topic%d' % i for i in range(50)]
+        done = threading.Event()
+
+        def publish():
+            # Keep the topics cached on the second manager meanwhile
+            while not done.is_set():
+                for topic in topics:
+                    try:
+                        self.mgr2.publish_message(topic, 'early')
+                    except eowyn_exc.TopicNotFoundException:
+                        pass
+
+        publishers = [threading.Thread(target=publish) for _ in range(4)]
+        for publisher in publishers:
+            publisher.start()
+        for topic in topics:
+            self.mgr.create_subscription(topic, 'username')
+        done.set()
+        for publisher in publishers:
+            publisher.join()
+        # Once changes are received no topic is left stale in the cache
+        self.sync(self.mgr2)
+        for topic in topics:
+            self.mgr2.publish_message(topic, 'last')
+        for topic in topics:
+            messages = self.mgr.pop_messages(topic, 'username', 100000)
+            self.assertEqual('last', messages[-1])
+
+
+class TestRedisManagerHashTags(TestRedisManager):
+    # The cluster key layout, on a standalone Redis
+
+    def setUp(self):
+        super(TestRedisManagerHashTags, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch(
+            'eowyn.model.redis_manager._cluster_client',
+            lambda host, port: self.data))
+        self.mgr = redis_manager.RedisManager(cluster='true')
+
+    def test_keys_hash_tags(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+        self.assertEqual(sorted(['{topic}', '{topic}/q/username',
+                                 'eowyn/users/username']),
+                         sorted(self.data.keys('*')))
+
+    def test_subscription_round_trips(self):
+        # The topics of users are indexed after the scripts
+        self.mgr.create_subscription('topic', 'username')
+        round_trips = count_round_trips(self)
+        self.mgr.delete_subscription('topic', 'username')
+        self.assertEqual(2, len(round_trips))
+
+    def test_user_topics_round_trips(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.delete_subscription('topic', 'username')
+        round_trips = count_round_trips(self)
+        self.mgr.create_subscriptions(
+            'username', ['topic%d' % i for i in range(100)])
+        self.mgr.delete_subscriptions('username')
+        self.assertEqual(7, len(round_trips))
+
+
+class TestRedisManagerCluster(base.TestCase):
+    # Test require a local redis cluster, with a node on port 7000
+
+    def setUp(self):
+        super(TestRedisManagerCluster, self).setUp()
+        try:
+            self.mgr = redis_manager.RedisManager(port=7000, cluster=True)
+            self.mgr.store.flushall()
+        except ImportError as ie:
+            self.skipTest("Redis cluster client not available: %s" % ie)
+        except redis.exceptions.RedisError as re:
+            self.skipTest("Redis cluster not available: %s" % re)
+        self.addCleanup(self.mgr.store.flushall)
+        if not hasattr(self.mgr.store, 'nodes_manager'):
+            self.skipTest("Tests use the redis-py cluster client")
+
+    def test_topic_keys_same_node(self):
+        self.mgr.create_subscription('topic', 'username')
+        slot = self.mgr.store.keyslot(self.mgr._key('topic'))
+        self.assertEqual(slot, self.mgr.store.keyslot(
+            self.mgr._queue('topic', 'username')))
+
+    def test_topics_spread(self):
+        nodes = set()
+        for i in range(100):
+            topic = 'topic%d' % i
+            self.mgr.create_subscription(topic, 'username')
+            nodes.add(self.mgr.store.nodes_manager.get_node_from_slot(
+                self.mgr.store.keyslot(self.mgr._key(topic))).name)
+        self.assertEqual(len(self.mgr.store.get_primaries()), len(nodes))
+
+    def test_publish_pop(self):
+        for i in range(10):
+            topic = 'topic%d' % i
+            self.mgr.create_subscription(topic, 'username')
+            self.mgr.create_subscription(topic, 'username2')
+            self.mgr.publish_message(topic, 'message')
+            self.mgr.publish_messages(topic, ['message2', 'message3'])
+            self.assertEqual([b'message', b'message2', b'message3'],
+                             self.mgr.pop_messages(topic, 'username', 10))
+            self.mgr.delete_subscription(topic, 'username2')
+            with testtools.ExpectedException(
+                    eowyn_exc.SubscriptionNotFoundException):
+                self.mgr.pop_message(topic, 'username2')
+
+    def test_pop_message_wait(self):
+        self.mgr.create_subscription('topic', 'username')
+        threading.Timer(0.1, self.mgr.publish_message,
+                        args=('topic', 'message')).start()
+        self.assertEqual(b'message',
+                         self.mgr.pop_message('topic', 'username', wait=10))
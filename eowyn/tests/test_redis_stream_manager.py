@@ -0,0 +1,120 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import redis
+import testtools
+
+from eowyn.model import redis_stream_manager
+from eowyn.tests import test_simple_manager
+
+
+class TestRedisStreamManager(test_simple_manager.TestSimpleManager):
+
+    def setUp(self):
+        super(TestRedisStreamManager, self).setUp()
+        # Test require a local redis server running on the standard port
+        # We use db 1 just in case the local db 0 is used for real data
+        self.mgr = redis_stream_manager.RedisStreamManager(db=1)
+        self.data = self.mgr.store
+        try:
+            self.data.flushdb()
+            version = self.data.info()['redis_version']
+        except redis.exceptions.ConnectionError as ce:
+            msg = "Redis server not available: %s" % str(ce)
+            raise testtools.TestCase.skipException(msg)
+        if tuple(map(int, version.split('.')[:2])) < (6, 2):
+            msg = "Redis server %s does not support streams trimming" % version
+            raise testtools.TestCase.skipException(msg)
+
+    def tearDown(self):
+        super(TestRedisStreamManager, self).tearDown()
+        self.data.flushdb()
+
+    def get_stream(self, topic):
+        stream = self.mgr._keys(topic)[1]
+        return [entry[1]['message'] for entry in self.data.xrange(stream)]
+
+    def test_create_subscription(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.assertIn(b'eowyn/cursors/topic', self.data.keys('*'))
+        self.assertEqual(0, self.data.zscore('eowyn/cursors/topic',
+                                             'username'))
+
+    def test_delete_subscription_single(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.delete_subscription('topic', 'username')
+        self.assertEqual([], self.data.keys('*'))
+
+    def test_delete_subscription_multiple(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        self.mgr.delete_subscription('topic', 'username')
+        self.assertIn(b'eowyn/cursors/topic', self.data.keys('*'))
+        self.assertIsNone(self.data.zscore('eowyn/cursors/topic',
+                                           'username'))
+        self.assertIsNotNone(self.data.zscore('eowyn/cursors/topic',
+                                              'username2'))
+
+    def test_delete_subscription_trims_stream(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.pop_message('topic', 'username2')
+        self.assertEqual(['message'], self.get_stream('topic'))
+        self.mgr.delete_subscription('topic', 'username')
+        self.assertEqual([], self.get_stream('topic'))
+
+    def test_publish_message(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        self.mgr.publish_message('topic', 'message')
+        # The message is stored once, regardless of the subscribers
+        self.assertEqual(['message'], self.get_stream('topic'))
+
+    def test_publish_messages(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.publish_message('topic', 'message2')
+        self.assertEqual(['message', 'message2'], self.get_stream('topic'))
+
+    def test_pop_message(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+        message = self.mgr.pop_message('topic', 'username')
+        self.assertNotIn('message', self.get_stream('topic'))
+        self.assertEqual('message', message)
+
+    def test_pop_message_trims_consumed(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.publish_message('topic', 'message2')
+        self.mgr.pop_message('topic', 'username')
+        self.mgr.pop_message('topic', 'username')
+        self.assertEqual(['message', 'message2'], self.get_stream('topic'))
+        self.mgr.pop_message('topic', 'username2')
+        self.assertEqual(['message2'], self.get_stream('topic'))
+        self.mgr.pop_message('topic', 'username2')
+        self.assertEqual([], self.get_stream('topic'))
+
+    def test_topic_keys_distinct(self):
+        # Topics named after the keys of another topic have their own keys
+        names = ['topic', 'topic.stream', 'topic.sequence',
+                 'eowyn/streams/topic']
+        for topic in names:
+            self.mgr.create_subscription(topic, 'username')
+            self.mgr.publish_message(topic, topic)
+        for topic in names:
+            self.assertEqual(topic, self.mgr.pop_message(topic, 'username'))
@@ -0,0 +1,282 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import signal
+import threading
+import time
+
+import fixtures
+import mock
+from six.moves import http_client
+import testtools
+import werkzeug
+
+from eowyn import api
+from eowyn import exceptions as eowyn_exc
+from eowyn.model import managers
+from eowyn import server
+from eowyn.tests import base
+
+
+# Newer versions of werkzeug do not define a version
+WERKZEUG = tuple(int(v) for v in getattr(werkzeug, '__version__',
+                                         '3.0').split('.')[:2])
+
+
+def pid_app(environ, start_response):
+    # Tells which process served the request
+    body = str(os.getpid()).encode('ascii')
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+class TestLoadOptions(base.TestCase):
+
+    def test_defaults(self):
+        self.assertEqual(server.DEFAULTS, server.load_options({}))
+
+    def test_options(self):
+        options = server.load_options({'host': '0.0.0.0', 'port': '8080',
+                                       'workers': '4', 'keep_alive': '5',
+                                       'unknown': 'ignored'})
+        self.assertEqual('0.0.0.0', options['host'])
+        self.assertEqual(8080, options['port'])
+        self.assertEqual(4, options['workers'])
+        self.assertEqual(5, options['keep_alive'])
+        self.assertNotIn('unknown', options)
+
+    def test_invalid_options(self):
+        for section in ({'port': 'http'}, {'workers': '0'},
+                        {'threads': '-1'}, {'backlog': '0'}):
+            with testtools.ExpectedException(
+                    eowyn_exc.InvalidDataException):
+                server.load_options(section)
+
+
+class TestPooledWSGIServer(base.TestCase):
+
+    def setUp(self):
+        super(TestPooledWSGIServer, self).setUp()
+        listener = server.listen('127.0.0.1', 0, 16)
+        self.server = server.PooledWSGIServer(pid_app, listener, 2, 1)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.stop, 1)
+        self.addCleanup(self.server.shutdown)
+
+    def connect(self):
+        connection = http_client.HTTPConnection('127.0.0.1',
+                                                self.server.server_port,
+                                                timeout=5)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_serve(self):
+        connection = self.connect()
+        connection.request('GET', '/')
+        response = connection.getresponse()
+        self.assertEqual(200, response.status)
+        self.assertEqual(str(os.getpid()).encode('ascii'), response.read())
+
+    def test_keep_alive(self):
+        if WERKZEUG >= (2, 1):
+            self.skipTest('werkzeug closes all connections')
+        connection = self.connect()
+        for body in (None, b'unread', b''):
+            connection.request('POST', '/', body)
+            response = connection.getresponse()
+            self.assertEqual(200, response.status)
+            self.assertIsNone(response.getheader('Connection'))
+            response.read()
+            # The connection is reused rather than closed, bodies left
+            # unread by the app are drained
+            self.assertIsNotNone(connection.sock)
+
+    def test_concurrent_connections(self):
+        # More connections than threads are served, as connections kept
+        # alive are closed when others wait
+        connections = [self.connect() for _ in range(4)]
+        for _ in range(2):
+            for connection in connections:
+                try:
+                    connection.request('GET', '/')
+                    response = connection.getresponse()
+                except (http_client.HTTPException, IOError):
+                    connection.close()
+                    connection.request('GET', '/')
+                    response = connection.getresponse()
+                self.assertEqual(200, response.status)
+                response.read()
+
+    def test_stop_streams(self):
+        # Streams hold all the threads, stopping neither waits for a thread
+        # to be free, nor for the clients to close the streams
+        self.server.app = api.app
+        self.useFixture(fixtures.MonkeyPatch(
+            'eowyn.api.manager', managers.get_manager(name='simple')))
+        self.useFixture(fixtures.MonkeyPatch('eowyn.api.MAX_WAIT', 1))
+        responses = []
+        for username in ('username', 'username2'):
+            api.manager.create_subscription('topic', username)
+            connection = self.connect()
+            connection.request('GET', '/topic/%s/stream' % username)
+            responses.append(connection.getresponse())
+            self.assertEqual(200, responses[-1].status)
+        self.server.shutdown()
+        start = time.time()
+        self.server.stop(10)
+        self.assertLess(time.time() - start, 5)
+        self.assertFalse(any(t.is_alive() for t in self.server._threads))
+        # The streams ended, after their keep-alive comments
+        for response in responses:
+            self.assertTrue(response.read().endswith(b':\n\n'))
+
+
+class TestMaster(base.TestCase):
+
+    def setUp(self):
+        super(TestMaster, self).setUp()
+        self.listener = server.listen('127.0.0.1', 0, 16)
+        self.addCleanup(self.listener.close)
+        self.port = self.listener.getsockname()[1]
+
+    def start(self, make_app, workers=2):
+        options = dict(server.DEFAULTS, workers=workers, threads=2,
+                       graceful_timeout=2)
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, 2)
+                code = server.Master(self.listener, make_app, options).run()
+            finally:
+                os._exit(code)
+        self.addCleanup(self.kill, pid)
+        return pid
+
+    def kill(self, pid):
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+    def wait(self, pid, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                return os.WEXITSTATUS(status)
+            time.sleep(0.05)
+        self.fail('The master did not exit')
+
+    def get_pid(self):
+        connection = http_client.HTTPConnection('127.0.0.1', self.port,
+                                                timeout=5)
+        try:
+            connection.request('GET', '/')
+            return int(connection.getresponse().read())
+        finally:
+            connection.close()
+
+    def test_serve_and_stop(self):
+        master = self.start(lambda: pid_app)
+        pids = set(self.get_pid() for _ in range(10))
+        self.assertNotIn(master, pids)
+        self.assertNotIn(os.getpid(), pids)
+        os.kill(master, signal.SIGTERM)
+        self.assertEqual(0, self.wait(master))
+
+    def test_reload(self):
+        master = self.start(lambda: pid_app, workers=1)
+        old = self.get_pid()
+        os.kill(master, signal.SIGHUP)
+        deadline = time.time() + 10
+        # Requests are served throughout, by the new worker eventually
+        while self.get_pid() == old:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+        # The old worker is gone
+        for _ in range(100):
+            try:
+                os.kill(old, 0)
+            except OSError:
+                break
+            time.sleep(0.05)
+        else:
+            self.fail('The old worker is still running')
+        os.kill(master, signal.SIGTERM)
+        self.assertEqual(0, self.wait(master))
+
+    def test_boot_error(self):
+        def make_app():
+            raise eowyn_exc.InvalidManagerException(manager='unknown')
+        master = self.start(make_app)
+        self.assertEqual(server.BOOT_ERROR, self.wait(master))
+
+
+class TestMain(base.TestCase):
+
+    def setUp(self):
+        super(TestMain, self).setUp()
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        self.config = os.path.join(tempdir, 'api.conf')
+        self.serve = mock.Mock(return_value=0)
+        self.useFixture(fixtures.MonkeyPatch('eowyn.server.serve',
+                                             self.serve))
+        self.run = mock.Mock()
+        self.useFixture(fixtures.MonkeyPatch('eowyn.api.app.run', self.run))
+        self.useFixture(fixtures.MonkeyPatch('sys.argv',
+                                             ['eowyn-api', self.config]))
+        self.addCleanup(setattr, api, 'manager', api.manager)
+
+    def write_config(self, manager='simple', debug='false', server=''):
+        with open(self.config, 'w') as config:
+            config.write('[default]\nmanager = %s\ndebug = %s\n\n'
+                         '[%s]\n\n[server]\n%s\n' % (manager, debug,
+                                                     manager, server))
+
+    def test_main_prefork(self):
+        self.write_config(server='port = 8080\nthreads = 4')
+        self.assertRaises(SystemExit, api.main)
+        self.assertFalse(self.run.called)
+        make_app, options = self.serve.call_args[0]
+        self.assertEqual(8080, options['port'])
+        self.assertEqual(4, options['threads'])
+        # The manager is only created by workers
+        api.manager = None
+        self.assertIs(api.app, make_app())
+        self.assertIsNotNone(api.manager)
+
+    def test_main_debug(self):
+        self.write_config(debug='true')
+        api.main()
+        self.run.assert_called_once_with(debug=True)
+        self.assertFalse(self.serve.called)
+
+    def test_main_workers_not_shared(self):
+        self.write_config(server='workers = 2')
+        self.assertRaises(eowyn_exc.InvalidDataException, api.main)
+        self.assertFalse(self.serve.called)
+
+    def test_main_workers_shared(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'eowyn.model.managers.is_shared', lambda name: True))
+        self.write_config(server='workers = 2')
+        self.assertRaises(SystemExit, api.main)
+        self.assertEqual(2, self.serve.call_args[0][1]['workers'])
@@ -0,0 +1,265 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import threading
+import time
+
+import redis
+
+from eowyn.model import redis_manager
+from eowyn.model import sharded_redis_manager
+from eowyn.tests import base
+from eowyn.tests import test_simple_manager
+
+
+class TestHashRing(base.TestCase):
+
+    def setUp(self):
+        super(TestHashRing, self).setUp()
+        self.keys = ['topic%d' % i for i in range(10000)]
+
+    def test_get_spread(self):
+        ring = sharded_redis_manager.HashRing(['a', 'b', 'c', 'd'])
+        counts = collections.Counter(ring.get(key) for key in self.keys)
+        for node in ['a', 'b', 'c', 'd']:
+            self.assertGreater(counts[node], len(self.keys) * 0.15)
+            self.assertLess(counts[node], len(self.keys) * 0.35)
+
+    def test_add_moves_bounded_fraction(self):
+        ring = sharded_redis_manager.HashRing(['a', 'b', 'c'])
+        before = dict((key, ring.get(key)) for key in self.keys)
+        ring.add('d')
+        moved = [key for key in self.keys if ring.get(key) != before[key]]
+        # Keys only move to the new node, about a quarter of them
+        self.assertEqual(set(['d']), set(ring.get(key) for key in moved))
+        self.assertLess(len(moved), len(self.keys) * 0.35)
+
+    def test_remove(self):
+        ring = sharded_redis_manager.HashRing(['a', 'b', 'c'])
+        before = dict((key, ring.get(key)) for key in self.keys)
+        ring.add('d')
+        ring.remove('d')
+        self.assertEqual(before,
+                         dict((key, ring.get(key)) for key in self.keys))
+
+
+class TestShardedRedisManager(test_simple_manager.TestSimpleManager):
+
+    def setUp(self):
+        super(TestShardedRedisManager, self).setUp()
+        # Test require a local redis server running on the standard port,
+        # shards are dbs 1 to 3
+        self.mgr = sharded_redis_manager.ShardedRedisManager(
+            shards='localhost:6379/1, localhost:6379/2')
+        self.stores = [redis.StrictRedis(db=db) for db in (1, 2, 3)]
+        try:
+            for store in self.stores:
+                store.flushdb()
+        except redis.exceptions.ConnectionError as ce:
+            self.skipTest("Redis server not available: %s" % ce)
+        for store in self.stores:
+            self.addCleanup(store.flushdb)
+
+    def get_queue(self, topic, username):
+        # Queues are pushed on the left, oldest messages are on the right
+        shard = self.mgr._shard(topic)
+        return shard.store.lrange(shard._queue(topic, username), 0, -1)[::-1]
+
+    def get_topics(self):
+        return [key for store in self.stores for key in store.keys('*')
+                if redis_manager._is_topic_key(key) and
+                store.type(key) in (b'set', 'set')]
+
+    def test_create_subscription(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.assertEqual(['topic'], self.get_topics())
+
+    def test_delete_subscription_single(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.delete_subscription('topic', 'username')
+        self.assertEqual([], self.get_topics())
+
+    def test_delete_subscription_multiple(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        self.mgr.delete_subscription('topic', 'username')
+        self.assertEqual(['topic'], self.get_topics())
+
+    def test_migrate(self):
+        # Each shard moves the legacy queues of its topics
+        topics = ['topic%d' % i for i in range(20)]
+        for topic in topics:
+            store = self.mgr._shard(topic).store
+            store.sadd(topic, 'username')
+            store.lpush(topic + '.username', topic)
+        self.assertEqual(20, self.mgr.migrate())
+        for topic in topics:
+            self.assertEqual(topic, self.mgr.pop_message(topic, 'username'))
+        self.assertEqual(sorted(topics), self.mgr.get_topics('username'))
+
+    def test_topics_spread(self):
+        for i in range(20):
+            self.mgr.create_subscription('topic%d' % i, 'username')
+        self.assertTrue(self.stores[0].keys('*'))
+        self.assertTrue(self.stores[1].keys('*'))
+
+    def test_add_shard(self):
+        topics = ['topic%d' % i for i in range(50)]
+        for topic in topics:
+            self.mgr.create_subscription(topic, 'username')
+            self.mgr.create_subscription(topic, 'username2')
+            self.mgr.publish_message(topic, topic)
+            self.mgr.pop_message(topic, 'username2')
+            self.mgr.publish_message(topic, topic + '.2')
+        self.mgr.add_shard('localhost:6379/3')
+        # Some topics moved to the new shard, along with their messages
+        self.assertTrue(self.stores[2].keys('*'))
+        for topic in topics:
+            self.assertEqual([topic, topic + '.2'],
+                             self.mgr.pop_messages(topic, 'username', 10))
+            self.assertEqual([topic + '.2'],
+                             self.mgr.pop_messages(topic, 'username2', 10))
+
+    def test_add_shard_concurrent(self):
+        # Messages published while topics move are neither lost, nor sent
+        # to a shard which is not registered yet
+        topics = ['topic%d' % i for i in range(50)]
+        self.mgr.create_subscriptions('username', topics)
+        stop = threading.Event()
+        published = collections.Counter()
+        errors = []
+
+        def publish():
+            try:
+                while not stop.is_set():
+                    for topic in topics:
+                        self.mgr.publish_message(topic, topic)
+                        published[topic] += 1
+            except Exception as exc:
+                errors.append(exc)
+        publisher = threading.Thread(target=publish)
+        publisher.start()
+        self.addCleanup(publisher.join)
+        time.sleep(0.05)
+        self.mgr.add_shard('localhost:6379/3')
+        time.sleep(0.05)
+        stop.set()
+        publisher.join()
+        self.assertEqual([], errors)
+        self.assertTrue(self.stores[2].keys('*'))
+        for topic in topics:
+            self.assertEqual(
+                published[topic],
+                len(self.mgr.pop_messages(topic, 'username', 100000)))
+
+    def test_add_shard_user_topics(self):
+        topics = ['topic%d' % i for i in range(50)]
+        self.mgr.create_subscriptions('username', topics)
+        self.mgr.add_shard('localhost:6379/3')
+        # The index of the topics of the user moves along with them
+        self.assertEqual(sorted(topics), self.mgr.get_topics('username'))
+        self.assertEqual(sorted(topics),
+                         self.mgr.delete_subscriptions('username'))
+        self.assertEqual([], self.get_topics())
+        for store in self.stores:
+            self.assertEqual([], store.keys('*'))
+
+    def test_add_shard_retention(self):
+        self.mgr = sharded_redis_manager.ShardedRedisManager(
+            shards='localhost:6379/1, localhost:6379/2', max_length=1,
+            max_age=60)
+        topics = ['topic%d' % i for i in range(50)]
+        for topic in topics:
+            self.mgr.create_subscription(topic, 'username')
+            self.mgr.publish_messages(topic, [topic, topic + '.2'])
+        self.mgr.add_shard('localhost:6379/3')
+        # Counters and times of messages move with the topics
+        self.assertIn(b'topic', b' '.join(self.stores[2].keys('*/*')))
+        for topic in topics:
+            self.assertEqual(1, self.mgr.get_dropped(topic, 'username'))
+            self.assertEqual([topic + '.2'],
+                             self.mgr.pop_messages(topic, 'username', 10))
+
+    def test_add_shard_dedup(self):
+        self.mgr = sharded_redis_manager.ShardedRedisManager(
+            shards='localhost:6379/1, localhost:6379/2', dedup_threshold=1)
+        topics = ['topic%d' % i for i in range(50)]
+        for topic in topics:
+            self.mgr.create_subscription(topic, 'username')
+            self.mgr.create_subscription(topic, 'username2')
+            self.mgr.publish_message(topic, topic)
+        self.mgr.add_shard('localhost:6379/3')
+        # Payloads move with the topics
+        self.assertIn(b'payloads', b' '.join(self.stores[2].keys('*/*')))
+        for topic in topics:
+            self.assertEqual(topic, self.mgr.pop_message(topic, 'username'))
+            self.assertEqual(topic, self.mgr.pop_message(topic, 'username2'))
+
+    def test_add_shard_leases(self):
+        topics = ['topic%d' % i for i in range(50)]
+        leases = {}
+        for topic in topics:
+            self.mgr.create_subscription(topic, 'username')
+            self.mgr.publish_messages(topic, [topic, topic + '.2'])
+            leases[topic] = self.mgr.lease_messages(topic, 'username', 1,
+                                                    30)[0][0]
+        self.mgr.add_shard('localhost:6379/3')
+        # Leases move with the topics
+        self.assertIn(b'leased', b' '.join(self.stores[2].keys('*/*')))
+        for topic in topics:
+            self.assertEqual(1, self.mgr.ack_messages(topic, 'username',
+                                                      [leases[topic]]))
+            self.assertEqual(
+                [topic + '.2'],
+                [m for _, m in self.mgr.lease_messages(topic, 'username',
+                                                       10, 30)])
+
+
+class TestShardedRedisManagerLeases(
+        test_simple_manager.TestSimpleManagerLeases):
+
+    def setUp(self):
+        self.stores = [redis.StrictRedis(db=db) for db in (1, 2)]
+        try:
+            for store in self.stores:
+                store.flushdb()
+        except redis.exceptions.ConnectionError as ce:
+            self.skipTest("Redis server not available: %s" % ce)
+        for store in self.stores:
+            self.addCleanup(store.flushdb)
+        super(TestShardedRedisManagerLeases, self).setUp()
+
+    def make_manager(self, **kwargs):
+        return sharded_redis_manager.ShardedRedisManager(
+            shards='localhost:6379/1, localhost:6379/2', **kwargs)
+
+
+class TestShardedRedisManagerRetention(
+        test_simple_manager.TestSimpleManagerRetention):
+
+    def setUp(self):
+        super(TestShardedRedisManagerRetention, self).setUp()
+        self.stores = [redis.StrictRedis(db=db) for db in (1, 2)]
+        try:
+            for store in self.stores:
+                store.flushdb()
+        except redis.exceptions.ConnectionError as ce:
+            self.skipTest("Redis server not available: %s" % ce)
+        for store in self.stores:
+            self.addCleanup(store.flushdb)
+
+    def make_manager(self, **kwargs):
+        return sharded_redis_manager.ShardedRedisManager(
+            shards='localhost:6379/1, localhost:6379/2', **kwargs)
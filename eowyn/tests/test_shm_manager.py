@@ -0,0 +1,184 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import multiprocessing
+import os
+
+import fixtures
+import testtools
+
+from eowyn import exceptions as eowyn_exc
+from eowyn.model import records
+from eowyn.model import shm_manager
+from eowyn.tests import test_simple_manager
+
+
+def _publish(path, topic, publisher, count):
+    # Publish from a separate process, with its own manager
+    mgr = shm_manager.ShmManager(path=path, size=256)
+    for i in range(count):
+        mgr.publish_message(topic, '%d-%d' % (publisher, i))
+
+
+def _crash(path, topic):
+    # Die while appending a message, holding the lock of the topic
+    mgr = shm_manager.ShmManager(path=path)
+    with mgr._topic(topic) as (_, region):
+        region.append(records.encode('partial')[:6])
+        region.end -= 2
+        os._exit(1)
+
+
+class TestShmManager(test_simple_manager.TestSimpleManager):
+
+    def setUp(self):
+        super(TestShmManager, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.mgr = self.get_manager()
+        self.data = self.mgr
+
+    def get_manager(self, size=65536):
+        return shm_manager.ShmManager(path=self.path, size=size)
+
+    def get_queue(self, topic, username):
+        with self.mgr._topic(topic) as (_, region):
+            position = region.find(shm_manager._digest(username))[0]
+            return region.read(region.get_offset(position), region.end)[0]
+
+    def get_files(self):
+        return [f for f in os.listdir(self.path) if not f.startswith('.')]
+
+    def run_process(self, target, *args):
+        process = multiprocessing.Process(target=target,
+                                          args=(self.path,) + args)
+        process.start()
+        return process
+
+    def test_create_subscription(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.assertEqual(1, len(self.get_files()))
+        self.assertEqual([], self.get_queue('topic', 'username'))
+
+    def test_delete_subscription_single(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.delete_subscription('topic', 'username')
+        self.assertEqual([], self.get_files())
+
+    def test_delete_subscription_multiple(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        self.mgr.delete_subscription('topic', 'username')
+        self.assertEqual(1, len(self.get_files()))
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            self.mgr.pop_message('topic', 'username')
+        with testtools.ExpectedException(
+                eowyn_exc.NoMessageFoundException):
+            self.mgr.pop_message('topic', 'username2')
+
+    def test_pop_message_bytes_and_text(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_messages('topic', [b'bytes', u'text\u00e8'])
+        messages = self.mgr.pop_messages('topic', 'username', 2)
+        self.assertEqual([b'bytes', u'text\u00e8'], messages)
+        self.assertIsInstance(messages[1], type(u''))
+
+    def test_publish_message_grows_log(self):
+        self.mgr = self.get_manager(size=64)
+        messages = ['message%d' % i for i in range(100)]
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        for message in messages:
+            self.mgr.publish_message('topic', message)
+        self.assertEqual(messages,
+                         self.mgr.pop_messages('topic', 'username', 100))
+        self.assertEqual(messages[:50],
+                         self.mgr.pop_messages('topic', 'username2', 50))
+        self.mgr.publish_messages('topic', messages)
+        self.assertEqual(messages[50:] + messages,
+                         self.mgr.pop_messages('topic', 'username2', 200))
+
+    def test_publish_message_drops_read_messages(self):
+        self.mgr = self.get_manager(size=64)
+        self.mgr.create_subscription('topic', 'username')
+        for i in range(100):
+            self.mgr.publish_message('topic', 'message%d' % i)
+            self.assertEqual('message%d' % i,
+                             self.mgr.pop_message('topic', 'username'))
+        with self.mgr._topic('topic') as (_, region):
+            self.assertEqual(64, region.capacity)
+
+    def test_create_subscription_grows_table(self):
+        usernames = ['username%d' % i for i in range(100)]
+        for username in usernames:
+            self.mgr.create_subscription('topic', username)
+        self.mgr.publish_message('topic', 'message')
+        for username in usernames:
+            self.assertEqual('message',
+                             self.mgr.pop_message('topic', username))
+
+    def test_shared_between_managers(self):
+        other = self.get_manager()
+        self.mgr.create_subscription('topic', 'username')
+        other.publish_message('topic', 'message')
+        self.assertEqual('message', self.mgr.pop_message('topic', 'username'))
+        # The topic is dropped and created again by the other manager
+        self.mgr.delete_subscription('topic', 'username')
+        other.create_subscription('topic', 'username2')
+        self.mgr.publish_message('topic', 'message2')
+        self.assertEqual('message2', other.pop_message('topic', 'username2'))
+
+    def test_shared_after_rebuild(self):
+        other = self.get_manager()
+        self.mgr.create_subscription('topic', 'username')
+        other.publish_message('topic', 'message')
+        # Replace the file of the topic, while the other manager has it open
+        for i in range(100):
+            self.mgr.create_subscription('topic', 'username%d' % i)
+        other.publish_message('topic', 'message2')
+        self.assertEqual(['message', 'message2'],
+                         self.mgr.pop_messages('topic', 'username', 10))
+
+    def test_publish_message_processes(self):
+        publishers = 4
+        count = 200
+        self.mgr.create_subscription('topic', 'username')
+        processes = [self.run_process(_publish, 'topic', publisher, count)
+                     for publisher in range(publishers)]
+        received = []
+        while len(received) < publishers * count:
+            received.extend(self.mgr.pop_messages('topic', 'username', 100,
+                                                  wait=10))
+        for process in processes:
+            process.join(10)
+            self.assertEqual(0, process.exitcode)
+        # No message is lost nor duplicated, and messages from each
+        # publisher arrive in order
+        for publisher in range(publishers):
+            self.assertEqual(
+                ['%d-%d' % (publisher, i) for i in range(count)],
+                [m for m in received if m.startswith('%d-' % publisher)])
+        self.assertEqual(publishers * count, len(received))
+
+    def test_recover_after_crash(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+        process = self.run_process(_crash, 'topic')
+        process.join(10)
+        self.assertEqual(1, process.exitcode)
+        # The partial message is dropped, the others are still there
+        self.assertEqual(['message'],
+                         self.mgr.pop_messages('topic', 'username', 10))
+        self.mgr.publish_message('topic', 'message2')
+        self.assertEqual('message2', self.mgr.pop_message('topic', 'username'))
@@ -12,9 +12,15 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import functools
+import threading
+import time
+
+import mock
 import testtools
 
 from eowyn import exceptions as eowyn_exc
+from eowyn import metrics
 from eowyn.model import manager
 from eowyn.tests import base
 
@@ -24,14 +30,18 @@ class TestSimpleManager(base.TestCase):
     def setUp(self):
         super(TestSimpleManager, self).setUp()
         self.mgr = manager.SimpleManager()
-        self.data = self.mgr.subscriptions
+        self.data = self.mgr.topics
+
+    def get_queue(self, topic, username):
+        state = self.data[topic]
+        offset = state.subscriptions[username]
+        return state.log.read(offset, state.log.end)
 
     def test_create_subscription(self):
         self.mgr.create_subscription('topic', 'username')
         self.assertIn('topic', self.data.keys())
-        self.assertIn('username', self.data['topic'])
-        with testtools.ExpectedException(IndexError):
-            self.data['topic']['username'].pop()
+        self.assertIn('username', self.data['topic'].subscriptions)
+        self.assertEqual([], self.get_queue('topic', 'username'))
 
     def test_create_subscription_exists(self):
         self.mgr.create_subscription('topic', 'username')
@@ -42,11 +52,22 @@ class TestSimpleManager(base.TestCase):
     def test_create_subscription_invalid_data(self):
         for args in [(None, 'username'),
                      ('topic', None),
-                     (None, None)]:
+                     (None, None),
+                     ('_user', 'username')]:
             with testtools.ExpectedException(
                     eowyn_exc.InvalidDataException):
                 self.mgr.create_subscription(*args)
 
+    def test_create_subscription_nested(self):
+        # Queues of a topic do not collide with the topics below it
+        self.mgr.create_subscription('topic', 'sub')
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.create_subscription('topic.sub', 'username')
+        self.mgr.publish_message('topic.sub', 'message2')
+        self.assertEqual('message', self.mgr.pop_message('topic', 'sub'))
+        self.assertEqual('message2',
+                         self.mgr.pop_message('topic.sub', 'username'))
+
     def test_delete_subscription_single(self):
         self.mgr.create_subscription('topic', 'username')
         self.mgr.delete_subscription('topic', 'username')
@@ -57,8 +78,8 @@ class TestSimpleManager(base.TestCase):
         self.mgr.create_subscription('topic', 'username2')
         self.mgr.delete_subscription('topic', 'username')
         self.assertIn('topic', self.data.keys())
-        self.assertNotIn('username', self.data['topic'].keys())
-        self.assertIn('username2', self.data['topic'].keys())
+        self.assertNotIn('username', self.data['topic'].subscriptions)
+        self.assertIn('username2', self.data['topic'].subscriptions)
 
     def test_delete_subscription_non_existent(self):
         self.mgr.create_subscription('topic', 'username')
@@ -79,14 +100,16 @@ class TestSimpleManager(base.TestCase):
     def test_publish_message(self):
         self.mgr.create_subscription('topic', 'username')
         self.mgr.publish_message('topic', 'message')
-        self.assertEqual(1, self.data['topic']['username'].count('message'))
+        self.assertEqual(
+            1, self.get_queue('topic', 'username').count('message'))
 
     def test_publish_messages(self):
         self.mgr.create_subscription('topic', 'username')
         self.mgr.publish_message('topic', 'message')
         self.mgr.publish_message('topic', 'message2')
-        self.assertEqual(1, self.data['topic']['username'].count('message'))
-        self.assertEqual('message', self.data['topic']['username'].pop())
+        self.assertEqual(
+            1, self.get_queue('topic', 'username').count('message'))
+        self.assertEqual('message', self.get_queue('topic', 'username')[0])
 
     def test_publish_message_no_topic(self):
         with testtools.ExpectedException(eowyn_exc.TopicNotFoundException):
@@ -100,13 +123,64 @@ class TestSimpleManager(base.TestCase):
                     eowyn_exc.InvalidDataException):
                 self.mgr.publish_message(*args)
 
+    def test_publish_messages_batch(self):
+        messages = ['message%d' % i for i in range(5)]
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        self.mgr.publish_message('topic', 'first')
+        self.mgr.publish_messages('topic', messages)
+        for username in ['username', 'username2']:
+            self.assertEqual(['first'] + messages,
+                             self.mgr.pop_messages('topic', username, 10))
+
+    def test_publish_messages_batch_large(self):
+        messages = ['message%d' % i for i in range(2500)]
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_messages('topic', messages)
+        self.assertEqual(messages,
+                         self.mgr.pop_messages('topic', 'username', 2500))
+
+    def test_publish_messages_batch_no_topic(self):
+        with testtools.ExpectedException(eowyn_exc.TopicNotFoundException):
+            self.mgr.publish_messages('topic', ['message'])
+
+    def test_publish_messages_batch_invalid_data(self):
+        for args in [(None, ['message']),
+                     ('topic', None),
+                     ('topic', []),
+                     ('topic', ['message', None])]:
+            with testtools.ExpectedException(
+                    eowyn_exc.InvalidDataException):
+                self.mgr.publish_messages(*args)
+
     def test_pop_message(self):
         self.mgr.create_subscription('topic', 'username')
         self.mgr.publish_message('topic', 'message')
         message = self.mgr.pop_message('topic', 'username')
-        self.assertNotIn('message', self.data['topic']['username'])
+        self.assertNotIn('message', self.get_queue('topic', 'username'))
         self.assertEqual('message', message)
 
+    def test_pop_message_many_subscribers(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.publish_message('topic', 'message2')
+        for username in ['username', 'username2']:
+            self.assertEqual('message',
+                             self.mgr.pop_message('topic', username))
+            self.assertEqual('message2',
+                             self.mgr.pop_message('topic', username))
+
+    def test_pop_message_subscribed_after_publish(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.create_subscription('topic', 'username2')
+        self.mgr.publish_message('topic', 'message2')
+        self.assertEqual('message2', self.mgr.pop_message('topic',
+                                                          'username2'))
+        self.assertEqual('message', self.mgr.pop_message('topic',
+                                                         'username'))
+
     def test_pop_message_no_message(self):
         self.mgr.create_subscription('topic', 'username')
         with testtools.ExpectedException(eowyn_exc.NoMessageFoundException):
@@ -123,6 +197,163 @@ class TestSimpleManager(base.TestCase):
                 eowyn_exc.SubscriptionNotFoundException):
             self.mgr.pop_message('topic', 'username')
 
+    def test_pop_messages(self):
+        messages = ['message%d' % i for i in range(5)]
+        self.mgr.create_subscription('topic', 'username')
+        for message in messages:
+            self.mgr.publish_message('topic', message)
+        self.assertEqual(messages[:3],
+                         self.mgr.pop_messages('topic', 'username', 3))
+        self.assertEqual(messages[3:],
+                         self.mgr.pop_messages('topic', 'username', 3))
+        with testtools.ExpectedException(eowyn_exc.NoMessageFoundException):
+            self.mgr.pop_messages('topic', 'username', 3)
+
+    def test_pop_messages_with_position(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_messages('topic', ['message0', 'message1',
+                                            'message2'])
+        popped = self.mgr.pop_messages_with_position('topic', 'username', 2)
+        if popped is None:
+            self.skipTest('Manager does not track positions')
+        self.assertEqual((['message0', 'message1'],
+                          self.mgr.get_position('topic', 'username')),
+                         popped)
+        self.assertEqual((['message2'], popped[1] + 1),
+                         self.mgr.pop_messages_with_position(
+                             'topic', 'username', 2))
+        with testtools.ExpectedException(eowyn_exc.NoMessageFoundException):
+            self.mgr.pop_messages_with_position('topic', 'username', 2)
+
+    def test_pop_messages_many_subscribers(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.publish_message('topic', 'message2')
+        self.assertEqual(['message'],
+                         self.mgr.pop_messages('topic', 'username', 1))
+        self.assertEqual(['message', 'message2'],
+                         self.mgr.pop_messages('topic', 'username2', 5))
+        self.assertEqual(['message2'],
+                         self.mgr.pop_messages('topic', 'username', 5))
+
+    def test_pop_messages_no_subscription(self):
+        self.mgr.create_subscription('topic', 'someone_else')
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            self.mgr.pop_messages('topic', 'username', 1)
+
+    def test_pop_messages_invalid_data(self):
+        for args in [(None, 'username', 1),
+                     ('topic', None, 1),
+                     ('topic', 'username', 0),
+                     ('topic', 'username', None),
+                     ('topic', 'username', '1')]:
+            with testtools.ExpectedException(
+                    eowyn_exc.InvalidDataException):
+                self.mgr.pop_messages(*args)
+
+    def publish_later(self, topic, message, delay=0.1):
+        publisher = threading.Timer(delay, self.mgr.publish_message,
+                                    args=(topic, message))
+        publisher.start()
+        self.addCleanup(publisher.join)
+
+    def test_pop_message_wait(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.publish_later('topic', 'message')
+        start = time.time()
+        self.assertEqual('message',
+                         self.mgr.pop_message('topic', 'username', wait=10))
+        self.assertLess(time.time() - start, 10)
+
+    def test_pop_message_wait_timeout(self):
+        self.mgr.create_subscription('topic', 'username')
+        start = time.time()
+        with testtools.ExpectedException(eowyn_exc.NoMessageFoundException):
+            self.mgr.pop_message('topic', 'username', wait=1)
+        self.assertGreaterEqual(time.time() - start, 0.9)
+
+    def test_pop_message_wait_no_subscription(self):
+        self.mgr.create_subscription('topic', 'someone_else')
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            self.mgr.pop_message('topic', 'username', wait=10)
+
+    def test_pop_messages_wait(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.publish_later('topic', 'message')
+        self.assertEqual(['message'],
+                         self.mgr.pop_messages('topic', 'username', 5,
+                                               wait=10))
+
+    def test_pop_messages_wait_available(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.publish_message('topic', 'message2')
+        self.assertEqual(['message', 'message2'],
+                         self.mgr.pop_messages('topic', 'username', 5,
+                                               wait=10))
+
+    def test_pop_message_wait_invalid_data(self):
+        self.mgr.create_subscription('topic', 'username')
+        for wait in [-1, None, '1']:
+            with testtools.ExpectedException(
+                    eowyn_exc.InvalidDataException):
+                self.mgr.pop_message('topic', 'username', wait=wait)
+
+    def test_rewind(self):
+        self.mgr.create_subscription('topic', 'username')
+        # Messages are kept for a subscriber that did not receive them
+        self.mgr.create_subscription('topic', 'username2')
+        self.mgr.publish_messages('topic', ['message', 'message2'])
+        self.mgr.pop_messages('topic', 'username', 2)
+        position = self.mgr.get_position('topic', 'username')
+        if position is None:
+            self.skipTest('Manager does not track positions')
+        self.assertTrue(self.mgr.rewind('topic', 'username', position - 1))
+        self.assertEqual(position - 1,
+                         self.mgr.get_position('topic', 'username'))
+        self.assertEqual(['message2'],
+                         self.mgr.pop_messages('topic', 'username', 2))
+
+    def test_rewind_forward(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.publish_messages('topic', ['message', 'message2'])
+        position = self.mgr.get_position('topic', 'username')
+        if position is None:
+            self.skipTest('Manager does not track positions')
+        self.assertFalse(self.mgr.rewind('topic', 'username', position + 1))
+        self.assertEqual('message', self.mgr.pop_message('topic', 'username'))
+
+    def test_rewind_consumed(self):
+        self.mgr.create_subscription('topic', 'username')
+        messages = ['message%d' % i for i in range(2000)]
+        self.mgr.publish_messages('topic', messages)
+        self.mgr.pop_messages('topic', 'username', 2000)
+        position = self.mgr.get_position('topic', 'username')
+        if position is None:
+            self.skipTest('Manager does not track positions')
+        # Messages received by all subscribers are gone
+        self.assertFalse(self.mgr.rewind('topic', 'username', 0))
+
+    def test_rewind_no_subscription(self):
+        self.mgr.create_subscription('topic', 'someone_else')
+        if self.mgr.get_position('topic', 'someone_else') is None:
+            self.skipTest('Manager does not track positions')
+        for method, args in [(self.mgr.get_position, ()),
+                             (self.mgr.rewind, (0,))]:
+            with testtools.ExpectedException(
+                    eowyn_exc.SubscriptionNotFoundException):
+                method('topic', 'username', *args)
+
+    def test_rewind_invalid_data(self):
+        self.mgr.create_subscription('topic', 'username')
+        for position in [-1, None, '1']:
+            with testtools.ExpectedException(
+                    eowyn_exc.InvalidDataException):
+                self.mgr.rewind('topic', 'username', position)
+
     def test_pop_message_invalid_data(self):
         for args in [(None, 'username'),
                      ('topic', None),
@@ -130,3 +361,616 @@ class TestSimpleManager(base.TestCase):
             with testtools.ExpectedException(
                     eowyn_exc.InvalidDataException):
                 self.mgr.pop_message(*args)
+
+    def skip_without_user_topics(self):
+        if self.mgr.get_topics('username') is None:
+            self.skipTest('Manager does not index the topics of users')
+
+    def test_create_subscriptions(self):
+        self.skip_without_user_topics()
+        self.mgr.create_subscription('topic', 'username')
+        self.assertEqual(['topic2', 'topic3'], self.mgr.create_subscriptions(
+            'username', ['topic', 'topic2', 'topic3', 'topic2']))
+        self.assertEqual(['topic', 'topic2', 'topic3'],
+                         self.mgr.get_topics('username'))
+        self.mgr.publish_message('topic3', 'message')
+        self.assertEqual('message', self.mgr.pop_message('topic3',
+                                                         'username'))
+
+    def test_create_subscriptions_invalid_data(self):
+        self.skip_without_user_topics()
+        for args in [('username', []),
+                     (None, ['topic']),
+                     ('username', ['topic', None])]:
+            with testtools.ExpectedException(
+                    eowyn_exc.InvalidDataException):
+                self.mgr.create_subscriptions(*args)
+        self.assertEqual([], self.mgr.get_topics('username'))
+
+    def test_get_topics(self):
+        self.skip_without_user_topics()
+        self.assertEqual([], self.mgr.get_topics('username'))
+        self.mgr.create_subscription('topic2', 'username')
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic3', 'username2')
+        self.assertEqual(['topic', 'topic2'],
+                         self.mgr.get_topics('username'))
+        self.mgr.delete_subscription('topic2', 'username')
+        self.assertEqual(['topic'], self.mgr.get_topics('username'))
+        self.mgr.delete_subscription('topic', 'username')
+        self.assertEqual([], self.mgr.get_topics('username'))
+        self.assertEqual(['topic3'], self.mgr.get_topics('username2'))
+
+    def test_delete_subscriptions(self):
+        self.skip_without_user_topics()
+        self.mgr.create_subscriptions('username', ['topic', 'topic2'])
+        self.mgr.create_subscription('topic', 'username2')
+        self.mgr.publish_message('topic', 'message')
+        self.assertEqual(['topic', 'topic2'],
+                         self.mgr.delete_subscriptions('username'))
+        self.assertEqual([], self.mgr.get_topics('username'))
+        self.assertEqual([], self.mgr.delete_subscriptions('username'))
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            self.mgr.pop_message('topic', 'username')
+        self.assertEqual('message', self.mgr.pop_message('topic',
+                                                         'username2'))
+
+    def skip_without_user_messages(self):
+        try:
+            if self.mgr.pop_user_messages('username', 1) is None:
+                self.skipTest('Manager does not pop from all topics')
+        except eowyn_exc.NoMessageFoundException:
+            pass
+
+    def test_pop_user_messages(self):
+        self.skip_without_user_messages()
+        for topic in ('topic', 'topic2', 'topic3'):
+            self.mgr.create_subscription(topic, 'username')
+        self.mgr.create_subscription('topic2', 'username2')
+        self.mgr.publish_messages('topic3', ['message0', 'message1'])
+        self.mgr.publish_message('topic', 'message2')
+        self.mgr.publish_message('topic2', 'message3')
+        self.mgr.pop_message('topic2', 'username')
+        self.assertEqual([('topic', 'message2'), ('topic3', 'message0'),
+                          ('topic3', 'message1')],
+                         self.mgr.pop_user_messages('username', 10))
+        with testtools.ExpectedException(
+                eowyn_exc.NoMessageFoundException):
+            self.mgr.pop_user_messages('username', 10)
+        self.assertEqual([('topic2', 'message3')],
+                         self.mgr.pop_user_messages('username2', 10))
+
+    def test_pop_user_messages_max(self):
+        self.skip_without_user_messages()
+        self.mgr.create_subscriptions('username', ['topic', 'topic2'])
+        self.mgr.publish_messages('topic', ['message0', 'message1'])
+        self.mgr.publish_message('topic2', 'message2')
+        self.assertEqual([('topic', 'message0')],
+                         self.mgr.pop_user_messages('username', 1))
+        self.assertEqual([('topic', 'message1'), ('topic2', 'message2')],
+                         self.mgr.pop_user_messages('username', 2))
+
+    def test_pop_user_messages_deleted(self):
+        self.skip_without_user_messages()
+        self.mgr.create_subscriptions('username', ['topic', 'topic2'])
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.delete_subscription('topic', 'username')
+        with testtools.ExpectedException(
+                eowyn_exc.NoMessageFoundException):
+            self.mgr.pop_user_messages('username', 10)
+
+    def test_pop_user_messages_wait(self):
+        self.skip_without_user_messages()
+        self.mgr.create_subscriptions('username', ['topic', 'topic2'])
+        threading.Timer(0.1, self.mgr.publish_message,
+                        args=('topic2', 'message')).start()
+        self.assertEqual([('topic2', 'message')],
+                         self.mgr.pop_user_messages('username', 10, wait=10))
+
+    def test_pop_user_messages_invalid_data(self):
+        for args in [(None, 1), ('username', 0), ('username', 1, -1)]:
+            with testtools.ExpectedException(
+                    eowyn_exc.InvalidDataException):
+                self.mgr.pop_user_messages(*args)
+
+    def test_get_queue_depths(self):
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        self.mgr.create_subscription('topic2', 'username')
+        self.mgr.publish_messages('topic', ['message0', 'message1'])
+        self.mgr.pop_message('topic', 'username')
+        depths = self.mgr.get_queue_depths(10)
+        if depths is None:
+            self.skipTest('Manager does not sample queue depths')
+        self.assertEqual({'topic': {'username': 1, 'username2': 2},
+                          'topic2': {'username': 0}}, depths)
+
+    def test_get_queue_depths_limit(self):
+        for i in range(5):
+            self.mgr.create_subscription('topic%d' % i, 'username')
+        depths = self.mgr.get_queue_depths(3)
+        if depths is None:
+            self.skipTest('Manager does not sample queue depths')
+        self.assertEqual(3, len(depths))
+
+
+class TestSimpleManagerLog(base.TestCase):
+
+    def setUp(self):
+        super(TestSimpleManagerLog, self).setUp()
+        self.mgr = manager.SimpleManager()
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username2')
+        self.log = self.mgr.topics['topic'].log
+
+    def test_publish_message_shared(self):
+        self.mgr.publish_message('topic', 'message')
+        # The message is stored once, regardless of the subscribers
+        self.assertEqual(1, self.log.end)
+        for username in ['username', 'username2']:
+            self.assertEqual('message',
+                             self.mgr.pop_message('topic', username))
+
+    def test_pop_message_frees_log(self):
+        segment_size = self.log.segment_size
+        for i in range(segment_size * 2):
+            self.mgr.publish_message('topic', 'message%d' % i)
+        for i in range(segment_size):
+            self.mgr.pop_message('topic', 'username')
+        self.assertEqual(0, self.log.start)
+        for i in range(segment_size):
+            self.mgr.pop_message('topic', 'username2')
+        self.assertEqual(segment_size, self.log.start)
+
+    def test_delete_subscription_frees_log(self):
+        segment_size = self.log.segment_size
+        for i in range(segment_size * 2):
+            self.mgr.publish_message('topic', 'message%d' % i)
+        for i in range(segment_size):
+            self.mgr.pop_message('topic', 'username2')
+        self.assertEqual(0, self.log.start)
+        self.mgr.delete_subscription('topic', 'username')
+        self.assertEqual(segment_size, self.log.start)
+
+
+class TestSimpleManagerRetention(base.TestCase):
+
+    def make_manager(self, **kwargs):
+        return manager.SimpleManager(**kwargs)
+
+    def subscribe(self, mgr, usernames=('username', 'username2')):
+        for username in usernames:
+            mgr.create_subscription('topic', username)
+
+    def test_max_length_drop_oldest(self):
+        mgr = self.make_manager(max_length=3)
+        self.subscribe(mgr)
+        for i in range(5):
+            mgr.publish_message('topic', 'message%d' % i)
+        self.assertEqual(['message2', 'message3', 'message4'],
+                         mgr.pop_messages('topic', 'username', 10))
+        self.assertEqual(2, mgr.get_dropped('topic', 'username'))
+        mgr.publish_messages('topic', ['message5', 'message6'])
+        self.assertEqual(['message4', 'message5', 'message6'],
+                         mgr.pop_messages('topic', 'username2', 10))
+        self.assertEqual(4, mgr.get_dropped('topic', 'username2'))
+        self.assertEqual(['message5', 'message6'],
+                         mgr.pop_messages('topic', 'username', 10))
+        self.assertEqual(2, mgr.get_dropped('topic', 'username'))
+
+    def test_max_length_batch(self):
+        mgr = self.make_manager(max_length=2)
+        self.subscribe(mgr, ['username'])
+        mgr.publish_messages('topic', ['message%d' % i for i in range(5)])
+        self.assertEqual(['message3', 'message4'],
+                         mgr.pop_messages('topic', 'username', 10))
+        self.assertEqual(3, mgr.get_dropped('topic', 'username'))
+
+    def test_max_length_reject(self):
+        mgr = self.make_manager(max_length=2, overflow='reject')
+        self.subscribe(mgr)
+        mgr.publish_messages('topic', ['message0', 'message1'])
+        mgr.pop_message('topic', 'username')
+        with testtools.ExpectedException(eowyn_exc.QueueFullException,
+                                         '.*username2.*'):
+            mgr.publish_message('topic', 'message2')
+        with testtools.ExpectedException(eowyn_exc.QueueFullException):
+            mgr.publish_messages('topic', ['message2', 'message3'])
+        # Rejected messages are not delivered to any subscriber, and are
+        # dropped for the full queues only
+        self.assertEqual(['message1'],
+                         mgr.pop_messages('topic', 'username', 10))
+        self.assertEqual(2, mgr.get_dropped('topic', 'username'))
+        self.assertEqual(3, mgr.get_dropped('topic', 'username2'))
+        mgr.pop_message('topic', 'username2')
+        mgr.publish_message('topic', 'message4')
+        self.assertEqual(['message1', 'message4'],
+                         mgr.pop_messages('topic', 'username2', 10))
+
+    def test_dropped_metric(self):
+        mgr = self.make_manager(max_length=1)
+        self.subscribe(mgr)
+        dropped = metrics.DROPPED.series()
+        before = dropped.value
+        mgr.publish_messages('topic', ['message0', 'message1', 'message2'])
+        self.assertEqual(before + 4, dropped.value)
+
+    def test_max_age(self):
+        mgr = self.make_manager(max_age=0.2)
+        self.subscribe(mgr)
+        mgr.publish_messages('topic', ['message0', 'message1'])
+        mgr.pop_message('topic', 'username')
+        time.sleep(0.3)
+        mgr.publish_message('topic', 'message2')
+        self.assertEqual(['message2'],
+                         mgr.pop_messages('topic', 'username', 10))
+        self.assertEqual(['message2'],
+                         mgr.pop_messages('topic', 'username2', 10))
+        self.assertEqual(1, mgr.get_dropped('topic', 'username'))
+        self.assertEqual(2, mgr.get_dropped('topic', 'username2'))
+
+    def test_topic_retention(self):
+        mgr = self.make_manager(max_length=1,
+                                topic_retention='topic max_length=2\n')
+        self.subscribe(mgr, ['username'])
+        mgr.create_subscription('topic2', 'username')
+        for i in range(3):
+            mgr.publish_message('topic', 'message%d' % i)
+            mgr.publish_message('topic2', 'message%d' % i)
+        self.assertEqual(['message1', 'message2'],
+                         mgr.pop_messages('topic', 'username', 10))
+        self.assertEqual(['message2'],
+                         mgr.pop_messages('topic2', 'username', 10))
+
+    def test_no_retention(self):
+        mgr = self.make_manager()
+        self.subscribe(mgr)
+        for i in range(100):
+            mgr.publish_message('topic', 'message%d' % i)
+        self.assertEqual(100, len(mgr.pop_messages('topic', 'username',
+                                                   1000)))
+        self.assertEqual(0, mgr.get_dropped('topic', 'username'))
+
+    def test_get_dropped_no_subscription(self):
+        mgr = self.make_manager(max_length=1)
+        self.subscribe(mgr, ['username'])
+        mgr.publish_messages('topic', ['message0', 'message1'])
+        mgr.delete_subscription('topic', 'username')
+        with testtools.ExpectedException(
+                eowyn_exc.SubscriptionNotFoundException):
+            mgr.get_dropped('topic', 'username')
+        # Counters start over with a new subscription
+        self.subscribe(mgr, ['username'])
+        self.assertEqual(0, mgr.get_dropped('topic', 'username'))
+
+    def test_invalid_retention(self):
+        for kwargs in ({'max_length': 'a'}, {'max_age': -1},
+                       {'overflow': 'block'},
+                       {'topic_retention': 'topic max_size=1'}):
+            with testtools.ExpectedException(
+                    eowyn_exc.InvalidDataException):
+                self.make_manager(**kwargs)
+
+
+class TestSimpleManagerLeases(base.TestCase):
+
+    def setUp(self):
+        super(TestSimpleManagerLeases, self).setUp()
+        self.mgr = self.make_manager()
+        self.mgr.create_subscription('topic', 'username')
+
+    def make_manager(self, **kwargs):
+        return manager.SimpleManager(**kwargs)
+
+    def messages(self, leased):
+        return [message for _, message in leased]
+
+    def test_lease_messages(self):
+        self.mgr.publish_messages('topic', ['message0', 'message1',
+                                            'message2'])
+        first = self.mgr.lease_messages('topic', 'username', 2, 30)
+        self.assertEqual(['message0', 'message1'], self.messages(first))
+        # Leased messages are not leased again until their leases expire
+        second = self.mgr.lease_messages('topic', 'username', 2, 30)
+        self.assertEqual(['message2'], self.messages(second))
+        leases = [lease for lease, _ in first + second]
+        self.assertEqual(3, len(set(leases)))
+        self.assertEqual(3, self.mgr.ack_messages('topic', 'username',
+                                                  leases))
+        self.assertEqual(0, self.mgr.ack_messages('topic', 'username',
+                                                  leases))
+        with testtools.ExpectedException(eowyn_exc.NoMessageFoundException):
+            self.mgr.lease_messages('topic', 'username', 2, 30)
+
+    def test_lease_expired(self):
+        self.mgr.publish_messages('topic', ['message0', 'message1'])
+        expired = self.mgr.lease_messages('topic', 'username', 1, 1)[0][0]
+        time.sleep(1.1)
+        # Messages of expired leases come first, under new leases
+        leased = self.mgr.lease_messages('topic', 'username', 2, 30)
+        self.assertEqual(['message0', 'message1'], self.messages(leased))
+        self.assertNotIn(expired, [lease for lease, _ in leased])
+        self.assertEqual(0, self.mgr.ack_messages('topic', 'username',
+                                                  [expired]))
+        self.assertEqual(1, self.mgr.ack_messages('topic', 'username',
+                                                  [leased[0][0]]))
+
+    def test_lease_wait(self):
+        threading.Timer(0.1, self.mgr.publish_message,
+                        ['topic', 'message']).start()
+        leased = self.mgr.lease_messages('topic', 'username', 1, 30, wait=5)
+        self.assertEqual(['message'], self.messages(leased))
+
+    def test_lease_wait_expiry(self):
+        self.mgr.publish_message('topic', 'message')
+        self.mgr.lease_messages('topic', 'username', 1, 1)
+        start = time.time()
+        leased = self.mgr.lease_messages('topic', 'username', 1, 30, wait=5)
+        self.assertEqual(['message'], self.messages(leased))
+        self.assertLess(time.time() - start, 3)
+
+    def test_lease_wait_timeout(self):
+        with testtools.ExpectedException(eowyn_exc.NoMessageFoundException):
+            self.mgr.lease_messages('topic', 'username', 1, 30, wait=1)
+
+    def test_lease_pop(self):
+        # Popping and leasing share the messages of the subscription
+        self.mgr.publish_messages('topic', ['message0', 'message1'])
+        self.assertEqual('message0', self.mgr.pop_message('topic',
+                                                          'username'))
+        self.assertEqual(['message1'], self.messages(
+            self.mgr.lease_messages('topic', 'username', 5, 30)))
+
+    def test_lease_no_subscription(self):
+        for method, args in [(self.mgr.lease_messages, (1, 30)),
+                             (self.mgr.ack_messages, (['1'],))]:
+            with testtools.ExpectedException(
+                    eowyn_exc.SubscriptionNotFoundException):
+                method('topic', 'username2', *args)
+
+    def test_lease_deleted_subscription(self):
+        self.mgr.publish_message('topic', 'message')
+        lease = self.mgr.lease_messages('topic', 'username', 1, 30)[0][0]
+        self.mgr.delete_subscription('topic', 'username')
+        self.mgr.create_subscription('topic', 'username')
+        # Leases go along with the subscription
+        self.assertEqual(0, self.mgr.ack_messages('topic', 'username',
+                                                  [lease]))
+
+    def test_lease_invalid_data(self):
+        for args in [(0, 30), (1, 0), (1, None), ('1', 30)]:
+            with testtools.ExpectedException(
+                    eowyn_exc.InvalidDataException):
+                self.mgr.lease_messages('topic', 'username', *args)
+        for leases in [[], None, [1]]:
+            with testtools.ExpectedException(
+                    eowyn_exc.InvalidDataException):
+                self.mgr.ack_messages('topic', 'username', leases)
+
+    def test_lease_concurrent(self):
+        messages = ['message%d' % i for i in range(200)]
+        self.mgr.publish_messages('topic', messages)
+        consumed = []
+
+        def consume():
+            while True:
+                try:
+                    leased = self.mgr.lease_messages('topic', 'username',
+                                                     7, 30)
+                except eowyn_exc.NoMessageFoundException:
+                    return
+                self.mgr.ack_messages('topic', 'username',
+                                      [lease for lease, _ in leased])
+                consumed.extend(self.messages(leased))
+        threads = [threading.Thread(target=consume) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        # Each message is leased to exactly one consumer
+        self.assertEqual(sorted(messages), sorted(consumed))
+
+
+class TestSimpleManagerPatterns(base.TestCase):
+
+    def setUp(self):
+        super(TestSimpleManagerPatterns, self).setUp()
+        self.mgr = self.make_manager()
+
+    def make_manager(self, **kwargs):
+        return manager.SimpleManager(**kwargs)
+
+    def test_create_subscriptions_patterns(self):
+        self.mgr.create_subscriptions('username', ['orders.>', 'orders.eu'])
+        self.mgr.publish_message('orders.eu', 'message')
+        self.assertEqual('message', self.mgr.pop_message('orders.>',
+                                                         'username'))
+        self.assertEqual('message', self.mgr.pop_message('orders.eu',
+                                                         'username'))
+        self.mgr.delete_subscriptions('username')
+        with testtools.ExpectedException(eowyn_exc.TopicNotFoundException):
+            self.mgr.publish_message('orders.us', 'message')
+
+    def test_pop_user_messages_pattern(self):
+        self.mgr.create_subscriptions('username', ['orders.>', 'orders.eu'])
+        self.mgr.publish_message('orders.eu', 'message')
+        popped = self.mgr.pop_user_messages('username', 10)
+        if popped is None:
+            self.skipTest('Manager does not pop from all topics')
+        self.assertEqual([('orders.>', 'message'), ('orders.eu', 'message')],
+                         popped)
+
+    def test_publish_to_patterns(self):
+        self.mgr.create_subscription('orders.*.paris', 'username')
+        self.mgr.create_subscription('orders.>', 'username')
+        self.mgr.create_subscription('orders.eu.paris', 'username2')
+        self.mgr.publish_message('orders.eu.paris', 'message0')
+        self.mgr.publish_messages('orders.us', ['message1', 'message2'])
+        self.assertEqual(['message0'], self.mgr.pop_messages(
+            'orders.*.paris', 'username', 10))
+        self.assertEqual(['message0', 'message1', 'message2'],
+                         self.mgr.pop_messages('orders.>', 'username', 10))
+        self.assertEqual(['message0'], self.mgr.pop_messages(
+            'orders.eu.paris', 'username2', 10))
+
+    def test_pattern_wildcard_username(self):
+        # Queues of topics do not collide with patterns
+        self.mgr.create_subscription('orders.*', 'username')
+        self.mgr.create_subscription('orders', '*')
+        self.mgr.publish_message('orders', 'message0')
+        self.mgr.publish_message('orders.eu', 'message1')
+        self.assertEqual('message0', self.mgr.pop_message('orders', '*'))
+        self.assertEqual('message1', self.mgr.pop_message('orders.*',
+                                                          'username'))
+
+    def test_publish_no_match(self):
+        self.mgr.create_subscription('orders.*', 'username')
+        for topic in ('orders', 'orders.eu.paris', 'logs.eu'):
+            with testtools.ExpectedException(
+                    eowyn_exc.TopicNotFoundException):
+                self.mgr.publish_message(topic, 'message')
+
+    def test_publish_to_pattern(self):
+        self.mgr.create_subscription('orders.*', 'username')
+        with testtools.ExpectedException(eowyn_exc.InvalidDataException):
+            self.mgr.publish_message('orders.*', 'message')
+        with testtools.ExpectedException(eowyn_exc.InvalidDataException):
+            self.mgr.publish_messages('orders.>', ['message'])
+
+    def test_invalid_pattern(self):
+        for pattern in ('orders.>.paris', 'orders.eu*'):
+            with testtools.ExpectedException(
+                    eowyn_exc.InvalidDataException):
+                self.mgr.create_subscription(pattern, 'username')
+
+    def test_delete_pattern_subscription(self):
+        self.mgr.create_subscription('orders.>', 'username')
+        self.mgr.create_subscription('orders.>', 'username2')
+        self.mgr.delete_subscription('orders.>', 'username')
+        self.mgr.publish_message('orders.eu', 'message')
+        self.mgr.delete_subscription('orders.>', 'username2')
+        with testtools.ExpectedException(eowyn_exc.TopicNotFoundException):
+            self.mgr.publish_message('orders.eu', 'message')
+
+    def test_pattern_wait(self):
+        self.mgr.create_subscription('orders.>', 'username')
+        threading.Timer(0.1, self.mgr.publish_message,
+                        ['orders.eu', 'message']).start()
+        self.assertEqual('message', self.mgr.pop_message('orders.>',
+                                                         'username', 2))
+
+    def test_pattern_retention(self):
+        # Queues of patterns follow the retention of the topic, and full
+        # queues reject the messages from all queues
+        self.mgr = self.make_manager(
+            topic_retention='orders.eu max_length=1 overflow=reject')
+        self.mgr.create_subscription('orders.eu', 'username')
+        self.mgr.create_subscription('orders.>', 'username')
+        self.mgr.publish_message('orders.eu', 'message0')
+        self.mgr.pop_message('orders.eu', 'username')
+        with testtools.ExpectedException(eowyn_exc.QueueFullException):
+            self.mgr.publish_message('orders.eu', 'message1')
+        self.assertEqual(['message0'], self.mgr.pop_messages(
+            'orders.>', 'username', 10))
+        with testtools.ExpectedException(eowyn_exc.NoMessageFoundException):
+            self.mgr.pop_message('orders.eu', 'username')
+
+
+class TestSimpleManagerThreads(base.TestCase):
+
+    def setUp(self):
+        super(TestSimpleManagerThreads, self).setUp()
+        self.mgr = manager.SimpleManager()
+
+    def run_threads(self, targets):
+        threads = [threading.Thread(target=target) for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+            self.assertFalse(thread.is_alive())
+
+    def test_publish_pop_concurrent(self):
+        topics = ['topic%d' % i for i in range(4)]
+        usernames = ['username%d' % i for i in range(2)]
+        publishers = 2
+        count = 500
+        for topic in topics:
+            for username in usernames:
+                self.mgr.create_subscription(topic, username)
+        received = dict(((topic, username), []) for topic in topics
+                        for username in usernames)
+
+        def publish(topic, publisher):
+            for i in range(count):
+                self.mgr.publish_message(topic, (publisher, i))
+
+        def pop(topic, username):
+            messages = received[(topic, username)]
+            while len(messages) < count * publishers:
+                messages.extend(self.mgr.pop_messages(
+                    topic, username, 10, wait=10))
+
+        # Other subscribers come and go while messages are published
+        def churn(topic):
+            for i in range(count):
+                self.mgr.create_subscription(topic, 'churn')
+                self.mgr.delete_subscription(topic, 'churn')
+
+        targets = []
+        for topic in topics:
+            targets.append(functools.partial(churn, topic))
+            for publisher in range(publishers):
+                targets.append(functools.partial(publish, topic, publisher))
+            for username in usernames:
+                targets.append(functools.partial(pop, topic, username))
+        self.run_threads(targets)
+        # No message is lost nor duplicated, and messages from each
+        # publisher arrive in order
+        for messages in received.values():
+            for publisher in range(publishers):
+                self.assertEqual(
+                    [(publisher, i) for i in range(count)],
+                    [m for m in messages if m[0] == publisher])
+            self.assertEqual(count * publishers, len(messages))
+
+    def test_pop_user_messages_wait_notified(self):
+        # Publishing only wakes up the users of the topic, when the first
+        # of their topics gets ready
+        self.mgr.create_subscription('topic', 'username')
+        self.mgr.create_subscription('topic2', 'username2')
+        popped = []
+        waiter = threading.Thread(target=lambda: popped.extend(
+            self.mgr.pop_user_messages('username', 10, wait=10)))
+        waiter.start()
+        deadline = time.time() + 5
+        while 'username' not in self.mgr._waiting:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+        condition = self.mgr._waiting['username']
+        with mock.patch.object(condition, 'notify_all',
+                               wraps=condition.notify_all) as notify_all:
+            self.mgr.publish_message('topic2', 'message')
+            self.assertFalse(notify_all.called)
+            self.mgr.publish_message('topic', 'message')
+            waiter.join(10)
+        notify_all.assert_called_once_with()
+        self.assertEqual([('topic', 'message')], popped)
+        self.assertEqual({}, self.mgr._waiting)
+
+    def test_create_delete_concurrent(self):
+        usernames = ['username%d' % i for i in range(8)]
+
+        def subscribe(username):
+            for i in range(200):
+                self.mgr.create_subscription('topic', username)
+                try:
+                    self.mgr.publish_message('topic', 'message')
+                except eowyn_exc.TopicNotFoundException:
+                    pass
+                self.mgr.delete_subscription('topic', username)
+
+        self.run_threads([functools.partial(subscribe, username)
+                          for username in usernames])
+        self.assertEqual({}, self.mgr.topics)
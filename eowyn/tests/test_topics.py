@@ -0,0 +1,83 @@
+# Copyright 2015 Andrea Frittoli <andrea.frittoli@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import testtools
+
+from eowyn import exceptions as eowyn_exc
+from eowyn.model import topics
+from eowyn.tests import base
+
+
+class TestPatterns(base.TestCase):
+
+    def test_is_pattern(self):
+        for pattern in ('*', '>', 'orders.*', 'orders.>', '*.eu.paris'):
+            self.assertTrue(topics.is_pattern(pattern))
+        for topic in ('orders', 'orders.eu', 'orders*', 'a>b'):
+            self.assertFalse(topics.is_pattern(topic))
+
+    def test_validate_pattern(self):
+        for pattern in ('*', '>', 'orders.*.paris', 'orders.*.>'):
+            topics.validate_pattern(pattern)
+        for pattern in ('orders.>.paris', '>.*', 'orders.eu*', 'orders.*>'):
+            with testtools.ExpectedException(
+                    eowyn_exc.InvalidDataException):
+                topics.validate_pattern(pattern)
+
+
+class TestTopicTrie(base.TestCase):
+
+    def setUp(self):
+        super(TestTopicTrie, self).setUp()
+        self.trie = topics.TopicTrie()
+        for pattern in ('orders.*.paris', 'orders.eu.>', 'orders.>',
+                        '*.eu.*', '*', 'logs.*.*'):
+            self.trie.add(pattern)
+
+    def test_match(self):
+        self.assertEqual(
+            ['*.eu.*', 'orders.*.paris', 'orders.>', 'orders.eu.>'],
+            sorted(self.trie.match('orders.eu.paris')))
+        self.assertEqual(['orders.>'], self.trie.match('orders.us'))
+        self.assertEqual(['*'], self.trie.match('orders'))
+        self.assertEqual(['logs.*.*'], self.trie.match('logs.a.b'))
+        self.assertEqual([], self.trie.match('logs.a'))
+        self.assertEqual([], self.trie.match('logs.a.b.c'))
+
+    def test_match_rest(self):
+        # The multi-level wildcard matches one segment or more
+        self.assertIn('orders.eu.>', self.trie.match('orders.eu.a.b.c'))
+        self.assertNotIn('orders.eu.>', self.trie.match('orders.eu'))
+
+    def test_add_twice(self):
+        self.trie.add('orders.>')
+        self.assertEqual(6, len(self.trie))
+        self.assertEqual(['orders.>'], self.trie.match('orders.us'))
+
+    def test_remove(self):
+        self.trie.remove('orders.>')
+        self.assertEqual([], self.trie.match('orders.us'))
+        self.assertIn('orders.eu.>', self.trie.match('orders.eu.x'))
+        # Removing unknown patterns, or prefixes of patterns, does nothing
+        self.trie.remove('orders.>')
+        self.trie.remove('orders.eu')
+        self.trie.remove('unknown.*')
+        self.assertEqual(5, len(self.trie))
+
+    def test_remove_prunes(self):
+        for pattern in ('orders.*.paris', 'orders.eu.>', 'orders.>',
+                        '*.eu.*', '*', 'logs.*.*'):
+            self.trie.remove(pattern)
+        self.assertEqual(0, len(self.trie))
+        self.assertEqual({}, self.trie._root.children)